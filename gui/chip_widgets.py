@@ -1,35 +1,104 @@
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
-from qtpy.QtCore import Qt, Signal  # type: ignore
-from qtpy.QtWidgets import QApplication, QGridLayout, QLabel, QPushButton, QWidget
+from qtpy.QtCore import QRect, QSize, Qt, Signal  # type: ignore
+from qtpy.QtGui import QColor, QFont, QPainter, QPen
+from qtpy.QtWidgets import QWidget
 
-from gui.utils import update_button_style
-from model.chip import Chip
+from gui.utils import cell_colors
+from model.chip import ChangeSet, Chip
 
+CellState = Tuple[bool, str, str]
 
-class ChipGridWidget(QWidget):
+
+class PaintedGridWidget(QWidget):
+    """
+    Draws chip cells directly with QPainter instead of one styled button per
+    cell. Subclasses keep a cache of the last drawn state per cell, so that
+    update_widget only schedules repaints for cells that actually changed.
+    """
+
+    spacing = 2
+    border_width = 3
+    beam_color = QColor("#0050ff")
+
+    def __init__(self, parent=None, button_size=40):
+        super().__init__(parent=parent)
+        self.button_size = button_size
+        self.pitch = button_size + self.spacing
+        self.cell_font = QFont(self.font())
+        self.cell_font.setPixelSize(14)
+        self._colors: Dict[CellState, Tuple[QColor, QColor]] = {}
+
+    def colors(self, state: CellState) -> Tuple[QColor, QColor]:
+        if state not in self._colors:
+            base_color, border_color = cell_colors(*state)
+            self._colors[state] = (QColor(base_color), QColor(border_color))
+        return self._colors[state]
+
+    def draw_cell(self, painter: QPainter, rect: QRect, state: CellState, text=""):
+        base_color, border_color = self.colors(state)
+        painter.fillRect(rect, border_color)
+        inner = rect.adjusted(
+            self.border_width, self.border_width, -self.border_width, -self.border_width
+        )
+        painter.fillRect(inner, base_color)
+        if text:
+            painter.setPen(QPen(Qt.GlobalColor.black))
+            painter.drawText(rect, Qt.AlignmentFlag.AlignCenter, text)
+
+    def draw_beam(self, painter: QPainter, rect: QRect):
+        # Outline of the cell under the beam
+        painter.setPen(QPen(self.beam_color, 2))
+        painter.drawRect(rect.adjusted(1, 1, -1, -1))
+
+
+class ChipGridWidget(PaintedGridWidget):
     # Chip Grid
     last_selected_signal = Signal(tuple)
 
     def __init__(self, chip: Chip, parent=None, button_size=40):
-        super().__init__(parent=parent)
-        self.chip_grid = QGridLayout()
-        self.button_size = button_size
+        super().__init__(parent=parent, button_size=button_size)
         self.chip = chip
         self.last_selected = (0, 0)
+        self._cell_states: Dict[Tuple[int, int], CellState] = {}
+        # Block under the beam
+        self.beam_block: Optional[Tuple[int, int]] = None
+        self.setFixedSize(self.sizeHint())
+
+    def sizeHint(self) -> QSize:
+        return QSize(self.chip.columns * self.pitch, self.chip.rows * self.pitch)
+
+    def cell_rect(self, i: int, j: int) -> QRect:
+        return QRect(j * self.pitch, i * self.pitch, self.button_size, self.button_size)
+
+    def cell_state(self, i: int, j: int) -> CellState:
+        block = self.chip.blocks[i][j]
+        return (block.selected, block.queued, block.exposed)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setFont(self.cell_font)
+        area = event.rect()
         for i in range(self.chip.rows):
             for j in range(self.chip.columns):
-                block_address = f"{chr(65+i)}{j+1}"
-                btn = QPushButton(block_address)
-                btn.setFixedSize(button_size, button_size)
-                btn.setFlat(True)  # Add this line to make the button appear flat
-                btn.clicked.connect(
-                    lambda _, x=i, y=j: self.select_block(
-                        x, y, QApplication.keyboardModifiers()
-                    )
-                )
-                self.chip_grid.addWidget(btn, i, j)
-        self.setLayout(self.chip_grid)
+                rect = self.cell_rect(i, j)
+                if not area.intersects(rect):
+                    continue
+                state = self.cell_state(i, j)
+                self._cell_states[(i, j)] = state
+                self.draw_cell(painter, rect, state, f"{chr(65+i)}{j+1}")
+                if (i, j) == self.beam_block:
+                    self.draw_beam(painter, rect)
+
+    def mousePressEvent(self, event):
+        i = event.pos().y() // self.pitch
+        j = event.pos().x() // self.pitch
+        if (
+            0 <= i < self.chip.rows
+            and 0 <= j < self.chip.columns
+            and self.cell_rect(i, j).contains(event.pos())
+        ):
+            self.select_block(i, j, event.modifiers())
 
     def select_block(self, x: int, y: int, modifiers):
         # Start by deselecting all rows of all blocks
@@ -57,61 +126,93 @@ class ChipGridWidget(QWidget):
         # self.update_widget()
 
     def update_widget(self):
-        # update chip grid
+        # Only repaint blocks whose state differs from what was last drawn
         for i in range(self.chip.rows):
             for j in range(self.chip.columns):
-                btn = self.chip_grid.itemAtPosition(i, j).widget()
-                block = self.chip.blocks[i][j]
-                btn = update_button_style(
-                    btn,
-                    self.button_size,
-                    block.selected,
-                    block.queued,
-                    block.exposed,
-                )
-
-
-class BlockGridWidget(QWidget):
+                if self._cell_states.get((i, j)) != self.cell_state(i, j):
+                    self.update(self.cell_rect(i, j))
+
+    def apply_changes(self, changes: ChangeSet):
+        for i, j, row in changes:
+            if row is None:
+                self.update(self.cell_rect(i, j))
+
+    def set_beam_location(self, location: Optional[str]):
+        block = (ord(location[0]) - 65, int(location[1]) - 1) if location else None
+        if block == self.beam_block:
+            return
+        for cell in (self.beam_block, block):
+            if cell is not None:
+                self.update(self.cell_rect(*cell))
+        self.beam_block = block
+
+
+class BlockGridWidget(PaintedGridWidget):
     def __init__(self, chip: Chip, parent=None, button_size=40):
-        super().__init__(parent=parent)
+        super().__init__(parent=parent, button_size=button_size)
         # Block Grid
         self.chip = chip
-        self.block_grid = QGridLayout()
-        self.block_buttons = {}
         self.last_selected = (0, 0)
         self.last_selected_row = 0
-        self.button_size = button_size
-        rows = self.chip.blocks[0][0].num_rows
-        cols = self.chip.blocks[0][0].num_cols
-        for i in range(rows + 1):  # Additional row for labels
-            for j in range(cols + 1):  # Additional column for labels
-                if i == 0 and j > 0:  # Top labels
-                    label = QLabel(str(j))
-                    label.setStyleSheet("font-size: 14px")  # Set font size
-                    self.block_grid.addWidget(label, i, j)
-                elif j == 0 and i > 0:  # Side labels
-                    label_button = QPushButton(chr(96 + i))
-                    label_button.setFixedSize(button_size, button_size)
-                    label_button.setFlat(
-                        True
-                    )  # Add this line to make the button appear flat
-                    label_button.clicked.connect(
-                        lambda _, x=i - 1: self.select_row(
-                            x, QApplication.keyboardModifiers()
-                        )
-                    )
-                    self.block_grid.addWidget(label_button, i, j)
-                elif i > 0 and j > 0:  # Block buttons
-                    btn = QPushButton()  # No address on button
-                    btn.setFixedSize(button_size, button_size)
-                    btn.setFlat(True)  # Add this line to make the button appear flat
-                    self.block_buttons[(i, j)] = btn
-                    self.block_grid.addWidget(btn, i, j)
-
-        self.setLayout(self.block_grid)
+        self.rows = self.chip.blocks[0][0].num_rows
+        self.cols = self.chip.blocks[0][0].num_cols
+        self._row_states: Dict[int, CellState] = {}
+        # (block, row, column) of the aperture under the beam
+        self.beam_aperture: Optional[Tuple[Tuple[int, int], int, int]] = None
+        self.setFixedSize(self.sizeHint())
+
+    def sizeHint(self) -> QSize:
+        # Additional row and column for labels
+        return QSize((self.cols + 1) * self.pitch, (self.rows + 1) * self.pitch)
+
+    def cell_rect(self, i: int, j: int) -> QRect:
+        """Rect of grid position (i, j), row and column 0 hold the labels"""
+        return QRect(j * self.pitch, i * self.pitch, self.button_size, self.button_size)
+
+    def row_rect(self, row: int) -> QRect:
+        return QRect(0, (row + 1) * self.pitch, self.width(), self.pitch)
+
+    def row_state(self, row: int) -> CellState:
+        block_row = self.chip.blocks[self.last_selected[0]][self.last_selected[1]].rows[
+            row
+        ]
+        return (block_row.selected, block_row.queued, block_row.exposed)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setFont(self.cell_font)
+        area = event.rect()
+        painter.setPen(QPen(Qt.GlobalColor.black))
+        for j in range(1, self.cols + 1):  # Top labels
+            rect = self.cell_rect(0, j)
+            if area.intersects(rect):
+                painter.drawText(rect, Qt.AlignmentFlag.AlignCenter, str(j))
+        for row in range(self.rows):
+            if not area.intersects(self.row_rect(row)):
+                continue
+            state = self.row_state(row)
+            self._row_states[row] = state
+            # Side label followed by the apertures of the row
+            self.draw_cell(painter, self.cell_rect(row + 1, 0), state, chr(97 + row))
+            for j in range(1, self.cols + 1):
+                rect = self.cell_rect(row + 1, j)
+                if area.intersects(rect):
+                    self.draw_cell(painter, rect, state)
+        if self.beam_aperture and self.beam_aperture[0] == self.last_selected:
+            _, row, col = self.beam_aperture
+            self.draw_beam(painter, self.cell_rect(row + 1, col + 1))
+
+    def mousePressEvent(self, event):
+        # Rows are selected from their side label only, like the label
+        # buttons this grid replaced
+        row = event.pos().y() // self.pitch - 1
+        if 0 <= row < self.rows and self.cell_rect(row + 1, 0).contains(event.pos()):
+            self.select_row(row, event.modifiers())
 
     def set_last_selected(self, last_selected: Tuple[int, int]):
         self.last_selected = last_selected
+        if self.beam_aperture:
+            self.update(self.row_rect(self.beam_aperture[1]))
 
     def select_row(self, x, modifiers):
         # Deselect all blocks except for the parent block of the selected rows
@@ -146,35 +247,27 @@ class BlockGridWidget(QWidget):
         self.update_widget()
 
     def update_widget(self):
-        # update block grid
-        rows = self.chip.blocks[0][0].num_rows
-        cols = self.chip.blocks[0][0].num_cols
-        for i in range(rows + 1):
-            for j in range(cols + 1):
-                if (i, j) in self.block_buttons:
-                    btn = self.block_buttons[(i, j)]
-                    row = self.chip.blocks[self.last_selected[0]][
-                        self.last_selected[1]
-                    ].rows[i - 1]
-                    self.block_buttons[(i, j)] = update_button_style(
-                        btn,
-                        self.button_size,
-                        row.selected,
-                        row.queued,
-                        row.exposed,
-                    )
-                elif i == 0 and j > 0:
-                    label = self.block_grid.itemAtPosition(i, j).widget()
-                    label.setStyleSheet("font-size: 14px")
-                elif j == 0 and i > 0:
-                    label_button = self.block_grid.itemAtPosition(i, j).widget()
-                    row = self.chip.blocks[self.last_selected[0]][
-                        self.last_selected[1]
-                    ].rows[i - 1]
-                    self.block_buttons[(i, j)] = update_button_style(
-                        label_button,
-                        self.button_size,
-                        row.selected,
-                        row.queued,
-                        row.exposed,
-                    )
+        # Only repaint rows whose state differs from what was last drawn
+        for row in range(self.rows):
+            if self._row_states.get(row) != self.row_state(row):
+                self.update(self.row_rect(row))
+
+    def apply_changes(self, changes: ChangeSet):
+        for i, j, row in changes:
+            if row is not None and (i, j) == self.last_selected:
+                self.update(self.row_rect(row))
+
+    def set_beam_location(self, location: Optional[str]):
+        aperture = None
+        if location:
+            aperture = (
+                (ord(location[0]) - 65, int(location[1]) - 1),
+                ord(location[2]) - 97,
+                ord(location[3]) - 97,
+            )
+        if aperture == self.beam_aperture:
+            return
+        for cell in (self.beam_aperture, aperture):
+            if cell is not None and cell[0] == self.last_selected:
+                self.update(self.row_rect(cell[1]))
+        self.beam_aperture = aperture
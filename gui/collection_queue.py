@@ -1,14 +1,24 @@
 from typing import Any, Dict, List, Tuple
 
+import numpy as np
+
 from qtpy.QtCore import QAbstractListModel, QModelIndex, Qt
-from qtpy.QtWidgets import QListView, QPushButton, QTextEdit, QVBoxLayout, QWidget, QHBoxLayout
+from qtpy.QtWidgets import QListView, QPushButton, QVBoxLayout, QWidget, QHBoxLayout
 
-from model.chip import Chip
+from model.chip import Chip, block_index, row_index
 from model.comm_protocol import (
     ClearQueue,
+    CollectApertures,
+    CollectionStatus,
+    EmergencyStop,
+    PauseQueue,
+    ResumeQueue,
     CollectNeighborhood,
     CollectQueue,
     CollectRow,
+    CollectSelection,
+    StateSnapshot,
+    unpack_indices,
 )
 
 from .utils import (
@@ -17,6 +27,7 @@ from .utils import (
     send_message_to_server,
 )
 from .websocket_client import WebSocketClient
+from .widgets import StatusLogWidget
 
 
 class CollectionQueue(QAbstractListModel):
@@ -38,13 +49,26 @@ class CollectionQueue(QAbstractListModel):
         self.queue.append(item)
         self.endInsertRows()
 
+    def add_items(self, items):
+        if not items:
+            return
+        first = self.rowCount(QModelIndex())
+        self.beginInsertRows(QModelIndex(), first, first + len(items) - 1)
+        self.queue.extend(items)
+        self.endInsertRows()
+
     def clear_queue(self):
+        self.set_queue([])
+
+    def set_queue(self, items):
         self.beginResetModel()
-        self.queue.clear()
+        self.queue = list(items)
         self.endResetModel()
 
     def removeRow(self, row: int) -> bool:
-        self.beginRemoveRows(QModelIndex(), self.rowCount(row), self.rowCount(row))
+        if not 0 <= row < len(self.queue):
+            return False
+        self.beginRemoveRows(QModelIndex(), row, row)
         self.queue.pop(row)
         self.endRemoveRows()
         return True
@@ -56,7 +80,7 @@ class CollectionQueueWidget(QWidget):
         chip: Chip,
         last_selected: Tuple[int, int],
         collection_parameters: Dict[str, Any],
-        status_window: QTextEdit,
+        status_window: StatusLogWidget,
         websocket_client: WebSocketClient,
     ):
         self.chip = chip
@@ -64,6 +88,9 @@ class CollectionQueueWidget(QWidget):
         self.collection_parameters = collection_parameters
         self.status_window = status_window
         self.websocket_client = websocket_client
+        # Mirror of the server state, the queue is held by the model and the
+        # exposed apertures by the chip
+        self.running: CollectRow | CollectNeighborhood | CollectApertures | None = None
         super().__init__()
         self.setLayout(QVBoxLayout())
         self._init_ui()
@@ -92,51 +119,58 @@ class CollectionQueueWidget(QWidget):
         self.collect_queue_button.clicked.connect(self.collect_queue)
         button_layout.addWidget(self.collect_queue_button)
 
+        # Pause/resume queue Button, a running scan pauses between lines
+        self.paused = False
+        self.pause_queue_button = QPushButton("Pause queue")
+        self.pause_queue_button.clicked.connect(self.toggle_pause)
+        button_layout.addWidget(self.pause_queue_button)
+
+        # Emergency stop Button
+        self.emergency_stop_button = QPushButton("Emergency stop")
+        self.emergency_stop_button.setStyleSheet("border: 2px solid red;")
+        self.emergency_stop_button.clicked.connect(self.emergency_stop)
+        button_layout.addWidget(self.emergency_stop_button)
+
     def set_last_selected(self, last_selected: Tuple[int, int]):
         self.last_selected = last_selected
 
     # Add selected blocks and rows to queue
     def add_to_queue(self):
+        # Queued state is shown once the server acknowledges the request
         last_block = self.chip.blocks[self.last_selected[0]][self.last_selected[1]]
         selected_rows = [row for row in last_block.rows if row.selected]
         wait_time = int(self.collection_parameters["exposure_time"]["widget"].text())
-        if selected_rows:  # last selected block contains selected rows
-            for row in selected_rows:
-                row.queued = "queued"
-                send_message_to_server(
-                    self.websocket_client,
-                    create_add_to_queue_request(
-                        CollectRow(
-                            location=row.address,
-                            wait_time=wait_time,
-                        ),
-                        client_id=self.websocket_client.uuid,
-                    ),
-                )
-
-            last_block.queued = "partially queued"
-            if all(
-                row.queued == "queued" for row in last_block.rows[:-1]
-            ):  # exclude label row
-                last_block.queued = "queued"
+        if self.chip.aperture_selection.any():  # apertures picked on the heatmap
+            selection = CollectSelection.from_indices(
+                "aperture",
+                np.flatnonzero(self.chip.aperture_selection).tolist(),
+                wait_time,
+            )
+        elif selected_rows:  # last selected block contains selected rows
+            selection = CollectSelection.from_indices(
+                "row", [row_index(row.address) for row in selected_rows], wait_time
+            )
         else:  # last selected block does not contain selected rows
-            for block_row in self.chip.blocks:
-                for block in block_row:
-                    if block.selected:
-                        block.queued = "queued"
-                        for row in block.rows:
-                            row.queued = "queued"
-
-                        send_message_to_server(
-                            self.websocket_client,
-                            create_add_to_queue_request(
-                                CollectNeighborhood(
-                                    location=block.address, wait_time=wait_time
-                                ),
-                                client_id=self.websocket_client.uuid,
-                            ),
-                        )
-        self.update()
+            selected_blocks = [
+                block_index(block.address)
+                for block_row in self.chip.blocks
+                for block in block_row
+                if block.selected
+            ]
+            if not selected_blocks:
+                self.status_window.append("Nothing selected to queue", severity="warning")
+                return
+            selection = CollectSelection.from_indices(
+                "block", selected_blocks, wait_time
+            )
+
+        # One round trip regardless of how much of the chip is selected
+        send_message_to_server(
+            self.websocket_client,
+            create_add_to_queue_request(
+                selection, client_id=self.websocket_client.uuid
+            ),
+        )
 
     # Clear the queue
     def clear_queue(self):
@@ -146,13 +180,6 @@ class CollectionQueueWidget(QWidget):
                 ClearQueue(), client_id=self.websocket_client.uuid
             ),
         )
-        for block_row in self.chip.blocks:
-            for block in block_row:
-                block.queued = "not queued"
-                for row in block.rows:
-                    row.queued = "not queued"
-        self.collection_queue.clear_queue()
-        self.update()
 
     def collect_queue(self):
         send_message_to_server(
@@ -161,52 +188,63 @@ class CollectionQueueWidget(QWidget):
                 CollectQueue(), client_id=self.websocket_client.uuid
             ),
         )
-        while self.collection_queue.queue:
-            container_address = self.collection_queue.queue.pop(0)
-            if isinstance(container_address, CollectNeighborhood):  # it's a block
-                self.collect_block(container_address)
-            else:  # it's a row
-                self.collect_row(container_address)
-        self.update()
-
-    def collect_row(self, data: CollectRow):
-        row_address = data.location
-        x = ord(row_address[0]) - 65
-        y = int(row_address[1]) - 1
-        row_id = ord(row_address[2]) - 97
-        row = self.chip.blocks[x][y].rows[row_id]
-        row.exposed = "exposed"
-        row.queued = "not queued"
-        exposure_time = self.collection_parameters["exposure_time"]["widget"].text()
-        exposure_time_label = self.collection_parameters["exposure_time"]["label"]
-        self.status_window.append(
-            f"Collecting row {row_address} with {exposure_time_label} = {exposure_time}"
+
+    def toggle_pause(self):
+        send_message_to_server(
+            self.websocket_client,
+            create_execute_action_request(
+                ResumeQueue() if self.paused else PauseQueue(),
+                client_id=self.websocket_client.uuid,
+            ),
         )
 
-        block = self.chip.blocks[x][y]
-        if block.exposed == "not exposed":
-            block.exposed = "partially exposed"
-        if all(
-            row.exposed == "exposed" for row in block.rows[:-1]
-        ):  # exclude label row
-            block.exposed = "exposed"
-        if all(
-            row.queued == "not queued" for row in block.rows[:-1]
-        ):  # exclude label row
-            block.queued = "not queued"
-
-    def collect_block(self, data: CollectNeighborhood):
-        block_address = data.location
-        x = ord(block_address[0]) - 65
-        y = int(block_address[1:]) - 1
-        block = self.chip.blocks[x][y]
-        block.exposed = "exposed"
-        block.queued = "not queued"
-        for row in block.rows:
-            row.exposed = "exposed"
-            row.queued = "not queued"
-        exposure_time = self.collection_parameters["exposure_time"]["widget"].text()
-        exposure_time_label = self.collection_parameters["exposure_time"]["label"]
-        self.status_window.append(
-            f"Collecting block {block_address} with {exposure_time_label} = {exposure_time}"
+    def emergency_stop(self):
+        send_message_to_server(
+            self.websocket_client,
+            create_execute_action_request(
+                EmergencyStop(), client_id=self.websocket_client.uuid
+            ),
         )
+
+    def set_paused(self, paused: bool):
+        self.paused = paused
+        self.pause_queue_button.setText("Resume queue" if paused else "Pause queue")
+
+    def apply_snapshot(self, snapshot: StateSnapshot):
+        self.set_paused(snapshot.paused)
+        self.collection_queue.set_queue(snapshot.queue)
+        self.running = snapshot.running
+        self.chip.change_name(snapshot.chip_name)
+        exposed = np.zeros(self.chip.aperture_shape, dtype=bool)
+        if snapshot.exposed:
+            exposed.flat[unpack_indices(snapshot.exposed)] = True
+        self.refresh_chip_state(exposed)
+
+    def apply_collection_status(self, status: CollectionStatus):
+        if status.state == "running":
+            # Items are collected from the front of the queue
+            self.collection_queue.removeRow(0)
+            self.running = status.item
+        elif status.state == "skipped":
+            self.collection_queue.removeRow(0)
+        else:
+            self.running = None
+        exposed = self.chip.aperture_exposed.copy()
+        if status.exposed:
+            exposed.flat[unpack_indices(status.exposed)] = True
+        self.refresh_chip_state(exposed)
+
+    def refresh_chip_state(self, exposed: np.ndarray | None = None):
+        items = list(self.collection_queue.queue)
+        if self.running is not None:
+            items.append(self.running)
+        queued = []
+        queued_apertures = np.zeros(self.chip.aperture_shape, dtype=bool)
+        for item in items:
+            if isinstance(item, CollectApertures):
+                queued_apertures.flat[item.indices()] = True
+            else:
+                queued.append(item.location)
+        if exposed is None:
+            exposed = self.chip.aperture_exposed
+        self.chip.set_collection_state(queued, exposed, queued_apertures)
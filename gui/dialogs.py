@@ -1,5 +1,5 @@
-from qtpy.QtCore import QUrl
-from qtpy.QtGui import QDesktopServices
+from qtpy.QtCore import QRegularExpression, QUrl
+from qtpy.QtGui import QDesktopServices, QRegularExpressionValidator
 from qtpy.QtWidgets import (
     QApplication,
     QDialog,
@@ -19,6 +19,10 @@ class LoadChipDialog(QDialog):
 
         layout = QVBoxLayout()
         self.name_edit = QLineEdit()
+        # The server names the chip's files after it
+        self.name_edit.setValidator(
+            QRegularExpressionValidator(QRegularExpression(r"[A-Za-z0-9_-]+"), self.name_edit)
+        )
         layout.addWidget(self.name_edit)
 
         self.ok_button = QPushButton("OK")
@@ -0,0 +1,99 @@
+import time
+
+from qtpy.QtCore import QElapsedTimer, QObject, QTimer
+from qtpy.QtGui import QGuiApplication
+from qtpy.QtWidgets import QDockWidget
+
+
+class FrameRateGovernor(QObject):
+    """
+    Picks the microscope frame rate from what the operator can see and how
+    busy the GUI is. Acquisition is paused while the dock is hidden, behind
+    another tab, minimized or floated off screen. The rate drops to
+    busy_fps when the event loop falls behind, and goes back to full_fps
+    for boost_seconds after every click to center.
+    """
+
+    def __init__(
+        self,
+        microscope,
+        dock: QDockWidget,
+        full_fps=30,
+        busy_fps=10,
+        boost_seconds=5.0,
+        lag_threshold_ms=50,
+        parent=None,
+    ):
+        super().__init__(parent)
+        self.microscope = microscope
+        self.dock = dock
+        self.full_fps = full_fps
+        self.busy_fps = busy_fps
+        self.boost_seconds = boost_seconds
+        self.lag_threshold_ms = lag_threshold_ms
+        self.boost_until = 0.0
+        self.lag_ms = 0.0
+        self.acquiring = True
+        self.fps = full_fps
+
+        self.dock.visibilityChanged.connect(self.update)
+        self.dock.topLevelChanged.connect(self.update)
+
+        # Event loop lag is how late a periodic timer fires
+        self.lag_interval_ms = 100
+        self.lag_clock = QElapsedTimer()
+        self.lag_clock.start()
+        self.lag_timer = QTimer(self)
+        self.lag_timer.setInterval(self.lag_interval_ms)
+        self.lag_timer.timeout.connect(self.measure_lag)
+        self.lag_timer.start()
+
+    def measure_lag(self):
+        lag = max(0, self.lag_clock.restart() - self.lag_interval_ms)
+        # Smoothed so that a single slow repaint does not change the rate
+        self.lag_ms = 0.8 * self.lag_ms + 0.2 * lag
+        self.update()
+
+    def boost(self):
+        self.boost_until = time.monotonic() + self.boost_seconds
+        self.update()
+        QTimer.singleShot(int(self.boost_seconds * 1000) + 50, self.update)
+
+    def visible(self) -> bool:
+        if self.dock.visibleRegion().isEmpty() or self.dock.window().isMinimized():
+            return False
+        if self.dock.isFloating():
+            center = self.dock.frameGeometry().center()
+            return QGuiApplication.screenAt(center) is not None
+        return True
+
+    def target_fps(self) -> int:
+        if not self.visible():
+            return 0
+        if time.monotonic() < self.boost_until:
+            return self.full_fps
+        if self.lag_ms > self.lag_threshold_ms:
+            return self.busy_fps
+        return self.full_fps
+
+    def update(self):
+        fps = self.target_fps()
+        if fps == 0:
+            if self.acquiring:
+                self.acquiring = False
+                self.microscope.acquire(False)
+            return
+        if fps != self.fps:
+            self.fps = fps
+            # The microscope only hands fps to its video thread when
+            # acquisition starts, a running stream is changed directly
+            self.microscope.fps = fps
+            self.microscope.videoThread.setFPS(fps)
+        if not self.acquiring:
+            self.acquiring = True
+            self.microscope.acquire(True)
+
+    def stop(self):
+        self.lag_timer.stop()
+        self.acquiring = False
+        self.microscope.acquire(False)
@@ -13,7 +13,6 @@ from qtpy.QtWidgets import (
     QLineEdit,
     QMainWindow,
     QPushButton,
-    QTextEdit,
     QVBoxLayout,
     QWidget,
     QAction
@@ -21,23 +20,41 @@ from qtpy.QtWidgets import (
 
 from gui.chip_widgets import BlockGridWidget, ChipGridWidget
 from gui.collection_queue import CollectionQueueWidget
-from gui.dialogs import LoginDialog, GovernorStateMachineDialog
+from gui.frame_rate_governor import FrameRateGovernor
+from gui.dialogs import LoadChipDialog, LoginDialog, GovernorStateMachineDialog
 from gui.utils import create_execute_action_request, send_message_to_server
 from gui.websocket_client import WebSocketClient
-from gui.widgets import ControlPanelWidget
-from model.chip import Chip
+from gui.widgets import ChipHeatmapWidget, ControlPanelWidget, StatusLogWidget
+from model.chip import ChangeSet, Chip
 from model.comm_protocol import (
     ClearQueue,
     ClickToCenter,
+    CollectApertures,
+    CollectionStatus,
+    EmergencyStop,
+    PauseQueue,
+    ResumeQueue,
     CollectNeighborhood,
     CollectRow,
     ErrorResponse,
     ExecuteActionResponse,
+    FiducialStatus,
+    HitMap,
+    HitMapResponse,
+    LoadChip,
     Message,
     PayloadType,
     PointDelta,
+    PositionResponse,
+    Prescreen,
+    PrescreenResult,
     QueueActionResponse,
+    QueuedItems,
     RemoveFromQueue,
+    RequestSnapshot,
+    SnapshotResponse,
+    StagePosition,
+    StateSnapshot,
     StatusResponse,
     VideoDimensions,
 )
@@ -49,8 +66,13 @@ class MainWindow(QMainWindow):
 
         self.setAttribute(QtCore.Qt.WidgetAttribute.WA_DeleteOnClose)
         self.chip = chip
+        # Chip changes are coalesced and delivered once per event loop turn
+        self.chip.set_scheduler(lambda flush: QtCore.QTimer.singleShot(0, flush))
+        self.chip.subscribe(self.apply_chip_changes)
         self.config = config
         self.server_url = f'{config["server"]["url"]}:{config["server"]["port"]}'
+        # Set while waiting for a snapshot after missing a state update
+        self.snapshot_requested = False
 
         self.websocket_client = WebSocketClient(server_url=self.server_url)
         self.websocket_client.message_received.connect(self.handle_server_response)
@@ -62,11 +84,18 @@ class MainWindow(QMainWindow):
         self.governor_state_dialog_open_action = QAction("&Governor State", self)
         self.tool_bar.addAction(self.governor_state_dialog_open_action)
         self.governor_state_dialog_open_action.triggered.connect(self.open_governor_dialog)
+        self.load_chip_action = QAction("&Load Chip", self)
+        self.tool_bar.addAction(self.load_chip_action)
+        self.load_chip_action.triggered.connect(self.open_load_chip_dialog)
+        self.prescreen_action = QAction("&Pre-screen", self)
+        self.tool_bar.addAction(self.prescreen_action)
+        self.prescreen_action.triggered.connect(self.prescreen_selected_blocks)
 
         self.create_chip_grid_widget()
         self.create_qmicroscope_widget()
         self.create_control_panel_widget()
         self.create_block_grid_widget()
+        self.create_chip_heatmap_widget()
 
         # Setting the main layout
         main_widget = QWidget()
@@ -82,6 +111,34 @@ class MainWindow(QMainWindow):
         self.governor_dialog.show()
 
 
+    def open_load_chip_dialog(self):
+        dialog = LoadChipDialog(self)
+        dialog.setWindowTitle("Load Chip")
+        dialog.name_edit.setText(self.chip.name)
+        if dialog.exec() and dialog.name_edit.text().strip():
+            send_message_to_server(
+                self.websocket_client,
+                create_execute_action_request(
+                    LoadChip(name=dialog.name_edit.text().strip()),
+                    self.websocket_client.uuid,
+                ),
+            )
+
+    def prescreen_selected_blocks(self):
+        locations = [
+            block.address
+            for block_row in self.chip.blocks
+            for block in block_row
+            if block.selected
+        ]
+        if not locations:
+            row, column = self.last_selected
+            locations = [self.chip.blocks[row][column].address]
+        send_message_to_server(
+            self.websocket_client,
+            create_execute_action_request(Prescreen(locations=locations), self.websocket_client.uuid),
+        )
+
     def create_chip_grid_widget(self):
         self.chip_grid = ChipGridWidget(
             chip=self.chip, button_size=self.config["chip_grid"]["button_size"]
@@ -122,16 +179,41 @@ class MainWindow(QMainWindow):
         )
         self.block_grid_dock.setWidget(self.block_grid)
 
+    def create_chip_heatmap_widget(self):
+        self.chip_heatmap = ChipHeatmapWidget(self.chip)
+        self.chip_heatmap_dock = QDockWidget("Chip apertures", self)
+        self.chip_heatmap_dock.setFeatures(
+            QDockWidget.DockWidgetFeature.DockWidgetFloatable
+            | QDockWidget.DockWidgetFeature.DockWidgetMovable
+        )
+        self.chip_heatmap_dock.setAllowedAreas(
+            QtCore.Qt.DockWidgetArea.LeftDockWidgetArea
+            | QtCore.Qt.DockWidgetArea.RightDockWidgetArea
+        )
+        self.addDockWidget(
+            QtCore.Qt.DockWidgetArea.RightDockWidgetArea, self.chip_heatmap_dock
+        )
+        self.tabifyDockWidget(self.block_grid_dock, self.chip_heatmap_dock)
+        self.block_grid_dock.raise_()
+        self.chip_heatmap_dock.setWidget(self.chip_heatmap)
+
     def create_qmicroscope_widget(self):
         # Setup Q microscope
         plugins = [C2CPlugin, CrossHairPlugin, MouseWheelCameraZoomPlugin]
         self.microscope = Microscope(self, viewport=False, plugins=plugins)  # type: ignore
         self.microscope.scale = [0, 400]
-        self.microscope.fps = 30
+        microscope_config = self.config.get("microscope", {})
+        self.microscope.fps = microscope_config.get("fps", 30)
         # Adding camera urls to MouseWheelCameraZoomPlugin
-        self.microscope.plugins["MouseWheelCameraZoomPlugin"].urls = self.config[
-            "sample_cam"
-        ]["urls"]
+        camera_urls = self.config["sample_cam"]["urls"]
+        if self.config["sample_cam"].get("use_relay", False):
+            # The server pulls each camera once and shares it between GUIs,
+            # it serves the cameras in the order of sample_cam urls
+            camera_urls = [
+                f"http://{self.server_url}/camera/{index}/stream"
+                for index in range(len(camera_urls))
+            ]
+        self.microscope.plugins["MouseWheelCameraZoomPlugin"].urls = camera_urls
         # C2CPlugin provides pixel co-ordinates of click, and zoom level
         self.microscope.plugins["C2CPlugin"].clicked_signal.clicked.connect(
             self.click_to_center
@@ -150,6 +232,15 @@ class MainWindow(QMainWindow):
             QtCore.Qt.DockWidgetArea.LeftDockWidgetArea, self.microscope_dock
         )
         self.microscope_dock.setWidget(self.microscope)
+        self.frame_rate_governor = FrameRateGovernor(
+            self.microscope,
+            self.microscope_dock,
+            full_fps=microscope_config.get("fps", 30),
+            busy_fps=microscope_config.get("busy_fps", 10),
+            boost_seconds=microscope_config.get("boost_seconds", 5.0),
+            lag_threshold_ms=microscope_config.get("lag_threshold_ms", 50),
+            parent=self,
+        )
 
     def create_control_panel_widget(self):
         # Left Layout (Queue List, Action Buttons, and Status Window)
@@ -178,8 +269,8 @@ class MainWindow(QMainWindow):
             param_info["widget"] = param_field
 
         # F0 to F2 buttons
-        fidu_buttons = ControlPanelWidget(websocket_client=self.websocket_client)
-        left_layout.addWidget(fidu_buttons)
+        self.fiducial_panel = ControlPanelWidget(websocket_client=self.websocket_client)
+        left_layout.addWidget(self.fiducial_panel)
 
         self.control_panel_dock = QDockWidget("Control Panel", self)
         self.control_panel_dock.setFeatures(
@@ -198,8 +289,10 @@ class MainWindow(QMainWindow):
         self.control_panel_dock.setWidget(self.control_panel_widget)
 
         # Status window
-        self.status_window = QTextEdit()
-        self.status_window.setReadOnly(True)
+        self.status_window = StatusLogWidget(
+            capacity=self.config.get("status_log", {}).get("capacity", 5000),
+            flush_rate=self.config.get("status_log", {}).get("flush_rate", 10),
+        )
         self.status_label = QLabel("Status:")
         left_layout.addWidget(self.status_label)
         left_layout.addWidget(self.status_window)
@@ -227,11 +320,15 @@ class MainWindow(QMainWindow):
         connection_label_layouts.addWidget(self.connection_status_value_label)
         connection_label_layouts.addWidget(self.reconnect_button)
         left_layout.addLayout(connection_label_layouts)
+        self.stage_position_label = QLabel("Stage: unknown")
+        left_layout.addWidget(self.stage_position_label)
 
         # Push the layouts up by adding stretch at the end
         left_layout.addStretch()
 
     def click_to_center(self, data):
+        # Full frame rate while the operator is centering
+        self.frame_rate_governor.boost()
         y_delta = data["y_pixel_delta"]
         x_delta = data["x_pixel_delta"]
         pd = PointDelta(x_delta=x_delta, y_delta=y_delta)
@@ -265,7 +362,14 @@ class MainWindow(QMainWindow):
         )
 
     def clean_up(self):
-        self.microscope.acquire(False)
+        self.frame_rate_governor.stop()
+        self.websocket_client.stop()
+
+    def changeEvent(self, event) -> None:
+        if event.type() == QtCore.QEvent.Type.WindowStateChange:
+            # Pauses the microscope while minimized
+            self.frame_rate_governor.update()
+        super().changeEvent(event)
 
     def closeEvent(self, event) -> None:
         self.clean_up()
@@ -277,31 +381,85 @@ class MainWindow(QMainWindow):
         self.collection_queue_widget.set_last_selected(value)
         self.update()
 
+    def in_sequence(self, seq: int) -> bool:
+        """
+        Whether a state update follows the last one applied. Updates already
+        covered by the snapshot are skipped, a gap asks for a new snapshot
+        """
+        last_seq = self.websocket_client.last_seq
+        if last_seq is None or seq <= last_seq:
+            # Waiting for the snapshot, or already included in it
+            return False
+        if seq != last_seq + 1:
+            if not self.snapshot_requested:
+                self.snapshot_requested = True
+                send_message_to_server(
+                    self.websocket_client,
+                    create_execute_action_request(
+                        RequestSnapshot(last_seq=last_seq),
+                        self.websocket_client.uuid,
+                    ),
+                )
+            return False
+        self.websocket_client.last_seq = seq
+        return True
+
+    def apply_snapshot(self, snapshot: StateSnapshot):
+        self.collection_queue_widget.apply_snapshot(snapshot)
+        self.fiducial_panel.set_fiducial_state(snapshot.fiducials)
+        self.chip_heatmap.apply_hit_map(snapshot.hits, replace=True)
+        self.chip_heatmap.apply_prescreen(snapshot.screened, snapshot.filled)
+        self.websocket_client.last_seq = snapshot.seq
+        self.snapshot_requested = False
+        self.chip_grid_dock.setWindowTitle(f"Current chip: {self.chip.name}")
+
     def handle_server_response(self, message: Message):
         if isinstance(message, Message):
-            if isinstance(message.metadata, QueueActionResponse):
+            if message.metadata.seq is not None and not self.in_sequence(
+                message.metadata.seq
+            ):
+                return
+            if isinstance(message.metadata, PositionResponse):
+                if isinstance(message.payload, StagePosition):
+                    self.set_stage_position(message.payload)
+            elif isinstance(message.metadata, HitMapResponse):
+                if isinstance(message.payload, HitMap):
+                    self.chip_heatmap.apply_hit_map(message.payload)
+            elif isinstance(message.metadata, SnapshotResponse):
+                if isinstance(message.payload, StateSnapshot):
+                    self.apply_snapshot(message.payload)
+                if message.metadata.status_msg:
+                    self.status_window.append(
+                        f"{message.metadata.timestamp.strftime('%H:%M:%S')} : {message.metadata.status_msg}"
+                    )
+            elif isinstance(message.metadata, QueueActionResponse):
                 self.handle_queue_action(message.metadata, message.payload)
             elif isinstance(message.metadata, ExecuteActionResponse):
                 self.status_window.append(
                     f"{message.metadata.timestamp.strftime('%H:%M:%S')} : {message.metadata.status_msg}"
                 )
             elif isinstance(message.metadata, ErrorResponse):
-                self.status_window.setTextColor(QtCore.Qt.GlobalColor.red)
                 self.status_window.append(
-                    f"{message.metadata.timestamp.strftime('%H:%M:%S')} : {message.metadata.status_msg}"
+                    f"{message.metadata.timestamp.strftime('%H:%M:%S')} : {message.metadata.status_msg}",
+                    severity="error",
                 )
-                self.status_window.setTextColor(QtCore.Qt.GlobalColor.black)
             elif isinstance(message.metadata, StatusResponse):
+                if isinstance(message.payload, FiducialStatus):
+                    self.fiducial_panel.set_fiducial_state(message.payload.fiducials)
+                elif isinstance(message.payload, PrescreenResult):
+                    self.chip_heatmap.apply_prescreen_result(message.payload)
                 self.status_window.append(
                     f"{message.metadata.timestamp.strftime('%H:%M:%S')} : {message.metadata.status_msg}"
                 )
             else:
                 self.status_window.append(
-                    f"{message.metadata.timestamp.strftime('%H:%M:%S')} : Unhandled response - {message.metadata.__class__.__name__}"
+                    f"{message.metadata.timestamp.strftime('%H:%M:%S')} : Unhandled response - {message.metadata.__class__.__name__}",
+                    severity="warning",
                 )
         else:
             self.status_window.append(
-                f"{datetime.now()} : Unhandled response - {message}"
+                f"{datetime.now()} : Unhandled response - {message}",
+                severity="warning",
             )
 
     def handle_queue_action(
@@ -311,16 +469,43 @@ class MainWindow(QMainWindow):
             self.status_window.append(
                 f"{metadata.timestamp.strftime('%H:%M:%S')} : {metadata.status_msg}"
             )
-        if isinstance(payload, (CollectNeighborhood, CollectRow)):
+        if isinstance(payload, (CollectNeighborhood, CollectRow, CollectApertures)):
             self.collection_queue_widget.collection_queue.add_to_queue(payload)
+        elif isinstance(payload, QueuedItems):
+            self.collection_queue_widget.collection_queue.add_items(payload.items)
         elif isinstance(payload, ClearQueue):
             self.collection_queue_widget.collection_queue.clear_queue()
         elif isinstance(payload, RemoveFromQueue):
             self.collection_queue_widget.collection_queue.removeRow(payload.index)
+        elif isinstance(payload, CollectionStatus):
+            self.collection_queue_widget.apply_collection_status(payload)
+            return
+        elif isinstance(payload, (PauseQueue, ResumeQueue, EmergencyStop)):
+            self.collection_queue_widget.set_paused(not isinstance(payload, ResumeQueue))
+            return
         else:
             self.status_window.append(
-                f"{metadata.timestamp.strftime('%H:%M:%S')} : Unhandled queue action - {payload.__class__.__name__}"
+                f"{metadata.timestamp.strftime('%H:%M:%S')} : Unhandled queue action - {payload.__class__.__name__}",
+                severity="warning",
             )
+            return
+        self.collection_queue_widget.refresh_chip_state()
+        # Queued apertures are not tracked by blocks and rows
+        self.chip_heatmap.refresh()
+
+    def set_stage_position(self, position: StagePosition):
+        self.stage_position_label.setText(
+            f"Stage: x={position.x:.1f}, y={position.y:.1f}, z={position.z:.1f}"
+            f" ({position.location or 'off aperture'})"
+        )
+        self.chip_grid.set_beam_location(position.location)
+        self.block_grid.set_beam_location(position.location)
+        self.chip_heatmap.set_beam_location(position.location)
+
+    def apply_chip_changes(self, changes: ChangeSet):
+        self.chip_grid.apply_changes(changes)
+        self.block_grid.apply_changes(changes)
+        self.chip_heatmap.refresh()
 
     def update(self):
         # update chip label
@@ -335,4 +520,4 @@ class MainWindow(QMainWindow):
         self.block_grid.update_widget()
 
     def reconnect(self):
-        self.websocket_client.start()
+        self.websocket_client.reconnect()
@@ -2,22 +2,19 @@ import asyncio
 import getpass
 from uuid import UUID
 
-from qtpy.QtWidgets import QWidget
-
 from model.comm_protocol import ExecuteRequest, Message, PayloadType, QueueRequest
 
 from .websocket_client import WebSocketClient
 
 
-def update_button_style(
-    button: QWidget,
-    size: int,
+def cell_colors(
     selected=False,
     queued="not queued",
     exposed="not exposed",
-) -> QWidget:
-    # Define base style
-    style = f"font-size: 14px; min-width: {size}px; min-height: {size}px;"
+) -> "tuple[str, str]":
+    """
+    Returns the (fill, border) colors used to draw a block or row
+    """
     base_color = "#ffffff"  # Base color for unselected state
     border_color = "#ffffff"  # Base border color for unselected state
 
@@ -55,14 +52,12 @@ def update_button_style(
             ]
         )
 
-    style += f"background-color: {base_color}; border: 3px solid {border_color};"
-    button.setStyleSheet(style)
-    return button
+    return base_color, border_color
 
 
 def send_message_to_server(client: WebSocketClient, message: Message):
     asyncio.run_coroutine_threadsafe(
-        client.send(message.model_dump_json()),
+        client.send(message),
         client.loop,
     )
 
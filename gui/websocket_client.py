@@ -1,56 +1,180 @@
 import asyncio
 import getpass
+import random
+import time
+from collections import deque
 from uuid import uuid4
 
 import websockets
 from fastapi.exceptions import WebSocketRequestValidationError
-from pydantic import TypeAdapter
 from PyQt5.QtCore import QObject
 from qtpy.QtCore import QThread, Signal  # type: ignore
 
-from model.comm_protocol import Message
+from model.comm_protocol import (
+    Message,
+    RequestSnapshot,
+    decode_message,
+    encode_message,
+    supported_subprotocols,
+)
 
 
 class WebSocketClient(QThread):
     message_received = Signal(object)
     connection_status = Signal(object)
+
+    # Only view requests are kept for a reconnect. Every other request
+    # moves, starts or stops hardware or changes the queue, and is only
+    # meaningful while the operator is watching: it is dropped when there is
+    # no connection, or when it could not be sent within command_ttl
+    buffered_payloads = (RequestSnapshot,)
+
     def __init__(
-        self, parent: QObject | None = None, server_url="localhost:8000"
+        self,
+        parent: QObject | None = None,
+        server_url="localhost:8000",
+        min_backoff=0.5,
+        max_backoff=30.0,
+        ping_interval=5.0,
+        outbound_limit=1000,
+        command_ttl=2.0,
     ) -> None:
         super().__init__(parent)
         self.server_url = server_url
         self.uuid = uuid4()
-        self.message_ta = TypeAdapter(Message)
+        # Negotiated with the server on connect, None means JSON
+        self.subprotocol = None
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval
+        self.command_ttl = command_ttl
+        self.websocket = None
+        # Sequence number of the last state update applied by the GUI, None
+        # until the snapshot the server sends on connect has been applied
+        self.last_seq: int | None = None
 
+        # Created up front so messages can be queued before the thread runs
+        self.loop = asyncio.new_event_loop()
+        # Messages and the monotonic time they were queued
+        self.outbound: deque[tuple[Message, float]] = deque(maxlen=outbound_limit)
+        self.outbound_ready = asyncio.Event()
+        self.reconnect_now = asyncio.Event()
+        self.stopping = False
 
     async def connect(self):
-        try:
-            self.websocket = await websockets.connect(  # type: ignore
-                f"ws://{self.server_url}/gui/ws/{self.uuid}/{getpass.getuser()}"
-            )
-            self.connection_status.emit("Connected")
-            await self.listen()
-        except ConnectionRefusedError:
-            self.message_received.emit('{"error": "Connection refused"}')
-            self.connection_status.emit("Disconnected")
-        except WebSocketRequestValidationError:
-            self.message_received.emit('{"error": "Connection could not be validated"}')
-            self.connection_status.emit("Disconnected")
-        except Exception as e:
-            self.message_received.emit(f'{{"error": "Unknown error : {e}"}}')
+        attempt = 0
+        while not self.stopping:
+            try:
+                async with websockets.connect(  # type: ignore
+                    f"ws://{self.server_url}/gui/ws/{self.uuid}/{getpass.getuser()}",
+                    subprotocols=supported_subprotocols(),
+                    ping_interval=self.ping_interval,
+                    ping_timeout=self.ping_interval,
+                ) as websocket:
+                    self.websocket = websocket
+                    self.subprotocol = websocket.subprotocol
+                    attempt = 0
+                    self.last_seq = None
+                    self.connection_status.emit("Connected")
+                    # Whichever ends first ends the connection, a failed
+                    # send is raised here like a failed receive
+                    tasks = {
+                        asyncio.create_task(self.drain_outbound(websocket)),
+                        asyncio.create_task(self.listen()),
+                    }
+                    try:
+                        done, _ = await asyncio.wait(
+                            tasks, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for task in done:
+                            task.result()
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                        self.websocket = None
+            except ConnectionRefusedError:
+                self.message_received.emit('{"error": "Connection refused"}')
+            except WebSocketRequestValidationError:
+                self.message_received.emit('{"error": "Connection could not be validated"}')
+            except Exception as e:
+                self.message_received.emit(f'{{"error": "Unknown error : {e}"}}')
+            if self.stopping:
+                break
+
+            # Exponential backoff with jitter, so that a server restart is
+            # not met by every GUI reconnecting at the same instant
+            backoff = min(self.max_backoff, self.min_backoff * 2**attempt)
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+            attempt += 1
             self.connection_status.emit("Disconnected")
+            try:
+                await asyncio.wait_for(self.reconnect_now.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.reconnect_now.clear()
+            self.connection_status.emit("Reconnecting")
 
     async def listen(self):
-        while True:
-            message = await self.websocket.recv()
-            message = self.message_ta.validate_json(message)
+        async for message in self.websocket:
+            try:
+                message = decode_message(message)
+            except Exception as e:
+                self.message_received.emit(f'{{"error": "Could not decode message : {e}"}}')
+                continue
             self.message_received.emit(message)
 
-    async def send(self, message):
+    async def drain_outbound(self, websocket):
+        while True:
+            await self.outbound_ready.wait()
+            while self.outbound:
+                message, queued = self.outbound[0]
+                if (
+                    not self.buffered(message)
+                    and time.monotonic() - queued > self.command_ttl
+                ):
+                    self.outbound.popleft()
+                    self.report_dropped(
+                        message, f"not sent within {self.command_ttl:g} s"
+                    )
+                    continue
+                # Only dropped from the buffer once it has been sent
+                await websocket.send(encode_message(message, self.subprotocol))
+                self.outbound.popleft()
+            self.outbound_ready.clear()
+
+    def buffered(self, message: Message) -> bool:
+        return message.payload is None or isinstance(
+            message.payload, self.buffered_payloads
+        )
+
+    def report_dropped(self, message: Message, reason: str):
+        self.message_received.emit(
+            f'{{"error": "Dropped {message.payload.payload_type}, {reason}"}}'
+        )
+
+    async def send(self, message: Message):
         print(f"sending message: {message}")
-        await self.websocket.send(message)
+        if self.websocket is None and not self.buffered(message):
+            self.report_dropped(message, "not connected")
+            return
+        self.outbound.append((message, time.monotonic()))
+        self.outbound_ready.set()
+
+    def reconnect(self):
+        """
+        Skips the remaining backoff delay
+        """
+        self.loop.call_soon_threadsafe(self.reconnect_now.set)
+
+    def stop(self):
+        def _stop():
+            self.stopping = True
+            self.reconnect_now.set()
+            if self.websocket is not None:
+                asyncio.ensure_future(self.websocket.close())
+
+        self.loop.call_soon_threadsafe(_stop)
 
     def run(self):
-        self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
         self.loop.run_until_complete(self.connect())
@@ -1,2 +1,4 @@
 from .nudge_widget import NudgeWidget
 from .control_panel import ControlPanelWidget
+from .chip_heatmap import ChipHeatmapWidget
+from .status_log import StatusLogWidget
@@ -0,0 +1,254 @@
+import numpy as np
+from qtpy import QtCore
+from qtpy.QtCore import QPointF, QRectF, Signal  # type: ignore
+from qtpy.QtGui import QColor, QImage, QPainter, QPainterPath, QPen, QPixmap
+from qtpy.QtWidgets import (
+    QGraphicsPathItem,
+    QGraphicsPixmapItem,
+    QGraphicsScene,
+    QGraphicsView,
+)
+
+from gui.utils import cell_colors
+from model.comm_protocol import HitMap, PrescreenResult, unpack_indices
+from model.chip import (
+    APERTURE_SELECTED,
+    EXPOSED,
+    QUEUED,
+    SELECTED,
+    Chip,
+    aperture_position,
+    location_slices,
+)
+
+
+def state_color_table() -> "list[int]":
+    """
+    Color lookup table indexed by the aperture state flags of model.chip
+    """
+    table = []
+    for flags in range(APERTURE_SELECTED * 2):
+        base_color, border_color = cell_colors(
+            bool(flags & SELECTED),
+            "queued" if flags & QUEUED else "not queued",
+            "exposed" if flags & EXPOSED else "not exposed",
+        )
+        # A single pixel has no border, queued apertures that are not yet
+        # exposed take the queued color instead
+        color = QColor(border_color if flags & QUEUED and not flags & EXPOSED else base_color)
+        if flags & APERTURE_SELECTED:
+            color = color.darker(160)
+        table.append(color.rgb())
+    return table
+
+
+class ChipHeatmapWidget(QGraphicsView):
+    """
+    Whole chip view at aperture resolution. The chip state array is mapped
+    to an indexed QImage through a color table, so a refresh costs one
+    NumPy pass regardless of the number of apertures.
+
+    Hits found by the online hit finder are overlaid in red, more opaque
+    the more spots were found. Apertures the optical pre-screen found empty
+    are greyed out.
+
+    Mouse wheel zooms, right or middle drag pans, left drag selects a
+    rectangle and shift + left drag a lasso. Holding control adds to the
+    current selection.
+    """
+
+    aperture_selection_changed = Signal(object)
+
+    def __init__(self, chip: Chip, parent=None):
+        super().__init__(parent)
+        self.chip = chip
+        self.color_table = state_color_table()
+        self.setScene(QGraphicsScene(self))
+        self.pixmap_item = QGraphicsPixmapItem()
+        self.scene().addItem(self.pixmap_item)
+        self.hit_item = QGraphicsPixmapItem()
+        self.hit_item.setZValue(0.5)
+        self.scene().addItem(self.hit_item)
+        # Spot count per aperture, -1 where nothing was analysed
+        self.hits = np.full(self.chip.aperture_shape, -1, dtype=np.int32)
+        self.min_spots = 10
+        self.screened_empty = np.zeros(self.chip.aperture_shape, dtype=bool)
+        self.selection_item = QGraphicsPathItem()
+        pen = QPen(QtCore.Qt.GlobalColor.blue)
+        pen.setCosmetic(True)
+        self.selection_item.setPen(pen)
+        self.selection_item.setZValue(1)
+        self.scene().addItem(self.selection_item)
+        self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
+        self.setMouseTracking(False)
+
+        self.selection_path: QPainterPath | None = None
+        self.selection_start: QPointF | None = None
+        self.lasso = False
+        self.pan_start = None
+        # (row, column) on the raster of the aperture under the beam
+        self.beam_position: tuple[int, int] | None = None
+        self.refresh()
+        self.fit()
+
+    def fit(self):
+        self.fitInView(self.pixmap_item, QtCore.Qt.AspectRatioMode.KeepAspectRatio)
+
+    def refresh(self):
+        states = np.ascontiguousarray(self.chip.aperture_states())
+        height, width = states.shape
+        image = QImage(states.data, width, height, width, QImage.Format.Format_Indexed8)
+        image.setColorTable(self.color_table)
+        # fromImage copies, so the NumPy buffer does not need to outlive it
+        self.pixmap_item.setPixmap(QPixmap.fromImage(image))
+
+    def apply_hit_map(self, hit_map: HitMap | None, replace=False):
+        """
+        Applies the spot counts of a hit map broadcast, or replaces all of
+        them with the hit map of a snapshot
+        """
+        if replace:
+            self.hits.fill(-1)
+        if hit_map is not None:
+            self.min_spots = hit_map.min_spots
+            self.hits.flat[unpack_indices(hit_map.apertures)] = hit_map.spots
+        self.refresh_overlay()
+
+    def apply_prescreen(self, screened: str, filled: str):
+        """
+        Replaces the pre-screen results with the masks of a snapshot
+        """
+        self.screened_empty.fill(False)
+        if screened:
+            self.screened_empty.flat[unpack_indices(screened)] = True
+        if filled:
+            self.screened_empty.flat[unpack_indices(filled)] = False
+        self.refresh_overlay()
+
+    def apply_prescreen_result(self, result: PrescreenResult):
+        self.screened_empty[location_slices(result.location)] = True
+        if result.filled:
+            self.screened_empty.flat[unpack_indices(result.filled)] = False
+        self.refresh_overlay()
+
+    def refresh_overlay(self):
+        height, width = self.hits.shape
+        # Opacity grows from a quarter at min_spots to full at 4 x min_spots
+        alpha = np.clip(self.hits / max(4 * self.min_spots, 1), 0.25, 1.0)
+        alpha = np.where(self.hits >= self.min_spots, alpha * 255, 0).astype(np.uint32)
+        pixels = (alpha << 24) | 0xE02020
+        pixels[self.screened_empty & (alpha == 0)] = 0xA0606060
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint32)
+        image = QImage(pixels.data, width, height, width * 4, QImage.Format.Format_ARGB32)
+        self.hit_item.setPixmap(QPixmap.fromImage(image))
+
+    def drawForeground(self, painter: QPainter, rect: QRectF):
+        # Block boundaries
+        pen = QPen(QtCore.Qt.GlobalColor.gray)
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        height, width = self.chip.aperture_shape
+        for x in range(0, width + 1, self.chip.block_cols):
+            painter.drawLine(QPointF(x, 0), QPointF(x, height))
+        for y in range(0, height + 1, self.chip.block_rows):
+            painter.drawLine(QPointF(0, y), QPointF(width, y))
+        if self.beam_position is not None:
+            pen = QPen(QColor("#0050ff"), 2)
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            y, x = self.beam_position
+            painter.drawRect(QRectF(x - 1, y - 1, 3, 3))
+
+    def set_beam_location(self, location: str | None):
+        position = aperture_position(location) if location else None
+        if position != self.beam_position:
+            self.beam_position = position
+            self.viewport().update()
+
+    def wheelEvent(self, event):
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        self.scale(factor, factor)
+
+    def mousePressEvent(self, event):
+        if event.button() in (
+            QtCore.Qt.MouseButton.RightButton,
+            QtCore.Qt.MouseButton.MiddleButton,
+        ):
+            self.pan_start = event.pos()
+        elif event.button() == QtCore.Qt.MouseButton.LeftButton:
+            self.lasso = bool(event.modifiers() & QtCore.Qt.KeyboardModifier.ShiftModifier)
+            self.selection_start = self.mapToScene(event.pos())
+            self.selection_path = QPainterPath(self.selection_start)
+
+    def mouseMoveEvent(self, event):
+        if self.pan_start is not None:
+            delta = event.pos() - self.pan_start
+            self.pan_start = event.pos()
+            self.horizontalScrollBar().setValue(
+                self.horizontalScrollBar().value() - delta.x()
+            )
+            self.verticalScrollBar().setValue(
+                self.verticalScrollBar().value() - delta.y()
+            )
+        elif self.selection_path is not None:
+            point = self.mapToScene(event.pos())
+            if self.lasso:
+                self.selection_path.lineTo(point)
+            else:
+                self.selection_path = QPainterPath()
+                self.selection_path.addRect(
+                    QRectF(self.selection_start, point).normalized()
+                )
+            self.selection_item.setPath(self.selection_path)
+
+    def mouseReleaseEvent(self, event):
+        if self.pan_start is not None:
+            self.pan_start = None
+            return
+        if self.selection_path is None:
+            return
+        if self.lasso:
+            self.selection_path.closeSubpath()
+            mask = self.path_mask(self.selection_path)
+        else:
+            mask = self.rect_mask(
+                QRectF(self.selection_start, self.mapToScene(event.pos())).normalized()
+            )
+        if event.modifiers() & QtCore.Qt.KeyboardModifier.ControlModifier:
+            mask |= self.chip.aperture_selection
+        self.selection_path = None
+        self.selection_item.setPath(QPainterPath())
+        self.set_aperture_selection(mask)
+
+    def rect_mask(self, rect: QRectF) -> np.ndarray:
+        # An aperture is selected when its center lies inside the rectangle
+        height, width = self.chip.aperture_shape
+        x0 = int(np.clip(np.ceil(rect.left() - 0.5), 0, width))
+        x1 = int(np.clip(np.floor(rect.right() - 0.5) + 1, 0, width))
+        y0 = int(np.clip(np.ceil(rect.top() - 0.5), 0, height))
+        y1 = int(np.clip(np.floor(rect.bottom() - 0.5) + 1, 0, height))
+        mask = np.zeros(self.chip.aperture_shape, dtype=bool)
+        mask[y0:y1, x0:x1] = True
+        return mask
+
+    def path_mask(self, path: QPainterPath) -> np.ndarray:
+        # Rasterize the lasso at aperture resolution, without antialiasing a
+        # pixel is filled when its center lies inside the path
+        height, width = self.chip.aperture_shape
+        image = QImage(width, height, QImage.Format.Format_Grayscale8)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.fillPath(path, QColor(255, 255, 255))
+        painter.end()
+        bits = image.constBits()
+        if hasattr(bits, "setsize"):  # PyQt returns a sip.voidptr
+            bits.setsize(image.sizeInBytes())
+        pixels = np.frombuffer(bits, dtype=np.uint8).reshape(
+            height, image.bytesPerLine()
+        )
+        return pixels[:, :width] > 0
+
+    def set_aperture_selection(self, mask: np.ndarray):
+        self.chip.aperture_selection = mask
+        self.refresh()
+        self.aperture_selection_changed.emit(mask)
@@ -84,9 +84,6 @@ class ControlPanelWidget(QWidget):
                 SetFiducial(name=fiducial), client_id=self.websocket_client.uuid
             ),
         )
-        led = getattr(self, f"{fiducial}_set_light")
-        led.setState(True)
-
 
     def clear_fiducials(self):
         if not self.websocket_client:
@@ -95,5 +92,8 @@ class ControlPanelWidget(QWidget):
             self.websocket_client, 
             create_execute_action_request(
                 ClearFiducials(), client_id=self.websocket_client.uuid))
-        for led in (self.F0_set_light, self.F1_set_light, self.F2_set_light):
-            led.setState(False)
\ No newline at end of file
+
+    def set_fiducial_state(self, fiducials: "dict[str, bool]"):
+        # The indicators follow the fiducials reported by the server
+        for name in ("F0", "F1", "F2"):
+            getattr(self, f"{name}_set_light").setState(fiducials.get(name, False))
@@ -1,16 +1,47 @@
 import typing
 
 from qtpy import QtCore
-from qtpy.QtWidgets import QGridLayout, QSpinBox, QToolButton, QWidget
+from qtpy.QtWidgets import (
+    QAbstractSpinBox,
+    QApplication,
+    QCheckBox,
+    QGridLayout,
+    QLineEdit,
+    QSpinBox,
+    QTextEdit,
+    QToolButton,
+    QWidget,
+)
 
 from gui.utils import create_execute_action_request, send_message_to_server
-from model.comm_protocol import NudgeGonio
+from model.comm_protocol import NudgeGonio, StartJog, StopJog
 
 if typing.TYPE_CHECKING:
     from gui.websocket_client import WebSocketClient
 
 
 class NudgeWidget(QWidget):
+    # (axis, direction) moved by each button in jog mode
+    jog_axes = {
+        "up": ("y", 1),
+        "down": ("y", -1),
+        "left": ("x", -1),
+        "right": ("x", 1),
+        "in": ("z", 1),
+        "out": ("z", -1),
+    }
+    jog_keys = {
+        QtCore.Qt.Key.Key_Up: "up",
+        QtCore.Qt.Key.Key_Down: "down",
+        QtCore.Qt.Key.Key_Left: "left",
+        QtCore.Qt.Key.Key_Right: "right",
+        QtCore.Qt.Key.Key_PageUp: "in",
+        QtCore.Qt.Key.Key_PageDown: "out",
+    }
+    # Must be well below the server jog_timeout, which stops the stage
+    # when the jog is not refreshed
+    jog_refresh_ms = 150
+
     def __init__(
         self,
         parent: QWidget | None = None,
@@ -29,29 +60,46 @@ class NudgeWidget(QWidget):
         self.focus_amount_spin_box.setMaximum(100)
         self.focus_amount_spin_box.setMinimum(0)
 
+        # In jog mode the spin boxes set the jog velocity per second
+        self.jog_check_box = QCheckBox("Jog")
+        self.jog_check_box.setToolTip(
+            "Hold a direction button or arrow key to move continuously"
+        )
+        self.jog_check_box.toggled.connect(self.set_jog_mode)
+        self.jog_direction: str | None = None
+        self.jog_timer = QtCore.QTimer(self)
+        self.jog_timer.setInterval(self.jog_refresh_ms)
+        self.jog_timer.timeout.connect(self.send_jog)
+
         up_button = QToolButton()
         up_button.setArrowType(QtCore.Qt.ArrowType.UpArrow)
-        up_button.clicked.connect(lambda: self.nudge("up"))
 
         down_button = QToolButton()
         down_button.setArrowType(QtCore.Qt.ArrowType.DownArrow)
-        down_button.clicked.connect(lambda: self.nudge("down"))
 
         left_button = QToolButton()
         left_button.setArrowType(QtCore.Qt.ArrowType.LeftArrow)
-        left_button.clicked.connect(lambda: self.nudge("left"))
 
         right_button = QToolButton()
         right_button.setArrowType(QtCore.Qt.ArrowType.RightArrow)
-        right_button.clicked.connect(lambda: self.nudge("right"))
 
         focus_in_button = QToolButton()
         focus_in_button.setText("+")
-        focus_in_button.clicked.connect(lambda: self.nudge("in"))
 
         focus_out_button = QToolButton()
         focus_out_button.setText("-")
-        focus_out_button.clicked.connect(lambda: self.nudge("out"))
+
+        for button, direction in [
+            (up_button, "up"),
+            (down_button, "down"),
+            (left_button, "left"),
+            (right_button, "right"),
+            (focus_in_button, "in"),
+            (focus_out_button, "out"),
+        ]:
+            button.clicked.connect(lambda _, d=direction: self.nudge(d))
+            button.pressed.connect(lambda d=direction: self.start_jog(d))
+            button.released.connect(self.stop_jog)
 
         nudge_buttons.addWidget(
             self.nudge_amount_spin_box, 1, 1, QtCore.Qt.AlignmentFlag.AlignCenter
@@ -60,20 +108,21 @@ class NudgeWidget(QWidget):
         nudge_buttons.addWidget(down_button, 2, 1, QtCore.Qt.AlignmentFlag.AlignCenter)
         nudge_buttons.addWidget(left_button, 1, 0, QtCore.Qt.AlignmentFlag.AlignCenter)
         nudge_buttons.addWidget(right_button, 1, 2, QtCore.Qt.AlignmentFlag.AlignCenter)
-        
+
         nudge_buttons.addWidget(focus_in_button, 0, 3, QtCore.Qt.AlignmentFlag.AlignCenter)
         nudge_buttons.addWidget(self.focus_amount_spin_box, 1, 3, QtCore.Qt.AlignmentFlag.AlignCenter)
         nudge_buttons.addWidget(focus_out_button, 2, 3, QtCore.Qt.AlignmentFlag.AlignCenter)
+        nudge_buttons.addWidget(self.jog_check_box, 3, 0, 1, 4)
         self.setLayout(nudge_buttons)
 
     def nudge(self, direction: str):
-        if not self.websocket_client:
+        if not self.websocket_client or self.jog_check_box.isChecked():
             return
-        
+
         nudge_amount = self.nudge_amount_spin_box.value()
         if direction in ["in", "out"]:
             nudge_amount = self.focus_amount_spin_box.value()
-        
+
         delta_values = {
             "up": (0, nudge_amount, 0),
             "down": (0, -nudge_amount, 0),
@@ -92,3 +141,66 @@ class NudgeWidget(QWidget):
                 client_id=self.websocket_client.uuid,
             ),
         )
+
+    def set_jog_mode(self, enabled: bool):
+        # Arrow keys only jog the stage while jog mode is on
+        app = QApplication.instance()
+        if enabled:
+            app.installEventFilter(self)
+        else:
+            app.removeEventFilter(self)
+            self.stop_jog()
+
+    def start_jog(self, direction: str):
+        if not self.websocket_client or not self.jog_check_box.isChecked():
+            return
+        self.jog_direction = direction
+        self.send_jog()
+        self.jog_timer.start()
+
+    def send_jog(self):
+        if self.jog_direction is None:
+            return
+        axis, sign = self.jog_axes[self.jog_direction]
+        velocity = self.nudge_amount_spin_box.value()
+        if axis == "z":
+            velocity = self.focus_amount_spin_box.value()
+        send_message_to_server(
+            self.websocket_client,
+            create_execute_action_request(
+                StartJog(axis=axis, direction=sign, velocity=velocity),
+                client_id=self.websocket_client.uuid,
+            ),
+        )
+
+    def stop_jog(self):
+        if self.jog_direction is None:
+            return
+        self.jog_timer.stop()
+        self.jog_direction = None
+        send_message_to_server(
+            self.websocket_client,
+            create_execute_action_request(
+                StopJog(), client_id=self.websocket_client.uuid
+            ),
+        )
+
+    def eventFilter(self, obj, event):
+        if event.type() not in (
+            QtCore.QEvent.Type.KeyPress,
+            QtCore.QEvent.Type.KeyRelease,
+        ):
+            return False
+        direction = self.jog_keys.get(event.key())
+        # Leave arrow keys alone while the operator is editing a field
+        if direction is None or isinstance(
+            QApplication.focusWidget(), (QAbstractSpinBox, QLineEdit, QTextEdit)
+        ):
+            return False
+        if event.isAutoRepeat():
+            return True
+        if event.type() == QtCore.QEvent.Type.KeyPress:
+            self.start_jog(direction)
+        elif direction == self.jog_direction:
+            self.stop_jog()
+        return True
@@ -0,0 +1,138 @@
+from collections import deque
+from typing import Deque, List, Tuple
+
+from qtpy import QtCore
+from qtpy.QtCore import QAbstractListModel, QModelIndex, QSortFilterProxyModel, Qt
+from qtpy.QtGui import QColor
+from qtpy.QtWidgets import QComboBox, QHBoxLayout, QLabel, QListView, QVBoxLayout, QWidget
+
+SEVERITIES = ["info", "warning", "error"]
+SEVERITY_COLORS = {"warning": QColor("#b36b00"), "error": QColor(Qt.GlobalColor.red)}
+
+Entry = Tuple[str, int]
+
+
+class StatusLogModel(QAbstractListModel):
+    """
+    Fixed capacity log of status lines. Appends only go into a pending
+    buffer, flush moves them into the model with one remove and one insert
+    so that a burst of messages costs one view update.
+    """
+
+    SeverityRole = Qt.ItemDataRole.UserRole
+
+    def __init__(self, capacity=5000):
+        super().__init__()
+        self.capacity = capacity
+        self.entries: Deque[Entry] = deque(maxlen=capacity)
+        self.pending: List[Entry] = []
+
+    def rowCount(self, index=QModelIndex()):
+        return len(self.entries)
+
+    def data(self, index, role):
+        text, severity = self.entries[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return text
+        elif role == Qt.ItemDataRole.ForegroundRole:
+            return SEVERITY_COLORS.get(SEVERITIES[severity])
+        elif role == self.SeverityRole:
+            return severity
+
+    def append(self, text: str, severity="info"):
+        self.pending.append((text, SEVERITIES.index(severity)))
+        if len(self.pending) > self.capacity:
+            # Lines that would be evicted by the same flush are never shown
+            del self.pending[: -self.capacity]
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        overflow = len(self.entries) + len(batch) - self.capacity
+        if overflow >= len(self.entries) and self.entries:
+            self.beginResetModel()
+            self.entries.clear()
+            self.entries.extend(batch)
+            self.endResetModel()
+            return
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self.entries.popleft()
+            self.endRemoveRows()
+        first = len(self.entries)
+        self.beginInsertRows(QModelIndex(), first, first + len(batch) - 1)
+        self.entries.extend(batch)
+        self.endInsertRows()
+
+
+class SeverityFilterModel(QSortFilterProxyModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.minimum_severity = 0
+
+    def set_minimum_severity(self, severity: int):
+        self.minimum_severity = severity
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        index = self.sourceModel().index(source_row, 0, source_parent)
+        return (
+            self.sourceModel().data(index, StatusLogModel.SeverityRole)
+            >= self.minimum_severity
+        )
+
+
+class StatusLogWidget(QWidget):
+    """
+    Status pane with bounded memory. Appends are buffered and flushed to
+    the view at most flush_rate times per second, older lines are dropped
+    once capacity is reached.
+    """
+
+    def __init__(self, parent=None, capacity=5000, flush_rate=10):
+        super().__init__(parent)
+        self.model = StatusLogModel(capacity)
+        self.filter_model = SeverityFilterModel(self)
+        self.filter_model.setSourceModel(self.model)
+
+        self.view = QListView()
+        self.view.setModel(self.filter_model)
+        # Lets the view lay out only the visible rows
+        self.view.setUniformItemSizes(True)
+        self.view.setWordWrap(False)
+
+        self.severity_combo_box = QComboBox()
+        self.severity_combo_box.addItems(SEVERITIES)
+        self.severity_combo_box.currentIndexChanged.connect(
+            self.filter_model.set_minimum_severity
+        )
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Show"))
+        filter_layout.addWidget(self.severity_combo_box)
+        filter_layout.addStretch()
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(filter_layout)
+        layout.addWidget(self.view)
+        self.setLayout(layout)
+
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setInterval(int(1000 / flush_rate))
+        self.flush_timer.timeout.connect(self.flush)
+        self.flush_timer.start()
+
+    def append(self, text: str, severity="info"):
+        self.model.append(text, severity)
+
+    def flush(self):
+        if not self.model.pending:
+            return
+        scroll_bar = self.view.verticalScrollBar()
+        # Only follow new lines if the operator has not scrolled up
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self.model.flush()
+        if at_bottom:
+            self.view.scrollToBottom()
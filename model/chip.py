@@ -1,5 +1,121 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Units of the chip are indexed in address order: blocks row major over the
+# chip, rows within a block, and apertures on the full chip raster so that
+# aperture indices map directly onto a (chip rows * block rows,
+# chip columns * block columns) array.
+
+
+def block_index(location: str, columns=8) -> int:
+    return (ord(location[0]) - 65) * columns + int(location[1:]) - 1
+
+
+def block_location(index: int, columns=8) -> str:
+    return f"{chr(65 + index // columns)}{index % columns + 1}"
+
+
+def row_index(location: str, columns=8, block_rows=20) -> int:
+    return block_index(location[:-1], columns) * block_rows + ord(location[-1]) - 97
+
+
+def row_location(index: int, columns=8, block_rows=20) -> str:
+    return f"{block_location(index // block_rows, columns)}{chr(97 + index % block_rows)}"
+
+
+def aperture_position(location: str, block_rows=20, block_cols=20) -> Tuple[int, int]:
+    """
+    Position (row, column) of an aperture such as "A1aa" on the chip raster
+    """
+    return (
+        (ord(location[0]) - 65) * block_rows + ord(location[2]) - 97,
+        (int(location[1]) - 1) * block_cols + ord(location[3]) - 97,
+    )
+
+
+def aperture_index(location: str, columns=8, block_rows=20, block_cols=20) -> int:
+    y, x = aperture_position(location, block_rows, block_cols)
+    return y * columns * block_cols + x
+
+
+def aperture_location(index: int, columns=8, block_rows=20, block_cols=20) -> str:
+    y, x = divmod(index, columns * block_cols)
+    return (
+        f"{chr(65 + y // block_rows)}{x // block_cols + 1}"
+        f"{chr(97 + y % block_rows)}{chr(97 + x % block_cols)}"
+    )
+
+
+def location_slices(location: str, block_rows=20, block_cols=20) -> Tuple[slice, slice]:
+    """
+    Slices (rows, columns) of the chip raster covered by a block ("A1"), a
+    row ("A1a") or an aperture ("A1aa")
+    """
+    y = (ord(location[0]) - 65) * block_rows
+    x = (int(location[1]) - 1) * block_cols
+    if len(location) == 2:
+        return slice(y, y + block_rows), slice(x, x + block_cols)
+    y += ord(location[2]) - 97
+    if len(location) == 3:
+        return slice(y, y + 1), slice(x, x + block_cols)
+    x += ord(location[3]) - 97
+    return slice(y, y + 1), slice(x, x + 1)
+
+
+# Cells are identified by (block x, block y, row index), the row index is
+# None for changes to the block itself
+Cell = Tuple[int, int, Optional[int]]
+ChangeSet = Dict[Cell, Set[str]]
+
+
+# Flags combined per aperture by Chip.aperture_states
+SELECTED = 1
+QUEUED = 2
+EXPOSED = 4
+APERTURE_SELECTED = 8
+
+_UNSET = object()
+
+
+class Observed:
+    """
+    Attribute that reports every change of value to the owning chip
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.private_name = f"_{name}"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.private_name)
+
+    def __set__(self, obj, value):
+        if getattr(obj, self.private_name, _UNSET) == value:
+            return
+        setattr(obj, self.private_name, value)
+        if obj.notify is not None:
+            obj.notify(obj.cell, self.name)
+
+
+def summarize_state(flags: List[bool], state: str) -> str:
+    if all(flags):
+        return state
+    elif any(flags):
+        return f"partially {state}"
+    return f"not {state}"
+
+
 class Block:
-    def __init__(self, x, y, num_rows, num_cols):
+    selected = Observed()
+    queued = Observed()
+    exposed = Observed()
+
+    def __init__(self, x, y, num_rows, num_cols, notify=None):
+        self.notify = None
+        self.cell: Cell = (x, y, None)
         self.address = f"{chr(65+x)}{y+1}"
         self.selected = False
         self.queued = "not queued"
@@ -7,15 +123,25 @@ class Block:
         self.position = (x, y)
         self.num_rows = num_rows
         self.num_cols = num_cols
-        self.rows = [Row(self.address, chr(97 + i)) for i in range(num_rows)]
+        self.rows = [
+            Row(self.address, chr(97 + i), (x, y, i), notify) for i in range(num_rows)
+        ]
+        self.notify = notify
 
 
 class Row:
-    def __init__(self, block_address, row_id):
+    selected = Observed()
+    queued = Observed()
+    exposed = Observed()
+
+    def __init__(self, block_address, row_id, cell=None, notify=None):
+        self.notify = None
+        self.cell = cell
         self.address = f"{block_address}{row_id}"
         self.selected = False
         self.queued = "not queued"
         self.exposed = "not exposed"
+        self.notify = notify
 
 
 class Chip:
@@ -25,11 +151,133 @@ class Chip:
         self.name = chip_name
         self.rows = rows
         self.columns = columns
+        self.block_rows = block_rows
+        self.block_cols = block_cols
+        self.aperture_shape = (rows * block_rows, columns * block_cols)
+        # Aperture resolution state that has no Block/Row equivalent
+        self.aperture_selection = np.zeros(self.aperture_shape, dtype=bool)
+        self.aperture_exposed = np.zeros(self.aperture_shape, dtype=bool)
+        self.aperture_queued = np.zeros(self.aperture_shape, dtype=bool)
+        self.subscribers: List[Callable[[ChangeSet], None]] = []
+        # Runs a callable on the next turn of the caller's event loop, set by
+        # the GUI. Without one, changes accumulate until flush_changes
+        self.scheduler: Optional[Callable[[Callable[[], None]], Any]] = None
+        self.pending_changes: ChangeSet = {}
+        self.flush_scheduled = False
         self.blocks: "list[list[Block]]" = [
-            [Block(r, c, block_rows, block_cols) for c in range(columns)]
+            [
+                Block(r, c, block_rows, block_cols, notify=self.record_change)
+                for c in range(columns)
+            ]
             for r in range(rows)
         ]
         self.blocks[0][0].selected = True
 
     def change_name(self, new_name):
         self.name = new_name
+
+    def subscribe(self, callback: Callable[[ChangeSet], None]):
+        """
+        Registers a callback receiving the coalesced set of changed cells
+        and attributes, at most once per event loop turn
+        """
+        self.subscribers.append(callback)
+
+    def set_scheduler(self, scheduler: Callable[[Callable[[], None]], Any]):
+        self.scheduler = scheduler
+
+    def record_change(self, cell: Cell, attribute: str):
+        if not self.subscribers:
+            return
+        self.pending_changes.setdefault(cell, set()).add(attribute)
+        if self.scheduler is not None and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.scheduler(self.flush_changes)
+
+    def flush_changes(self):
+        changes, self.pending_changes = self.pending_changes, {}
+        self.flush_scheduled = False
+        if not changes:
+            return
+        for callback in self.subscribers:
+            callback(changes)
+
+    def set_collection_state(
+        self,
+        queued: Iterable[str],
+        exposed: np.ndarray,
+        queued_apertures: Optional[np.ndarray] = None,
+    ):
+        """
+        Sets the queued state of every block and row from the block ("A1")
+        and row ("A1a") addresses given, and the exposed state from a boolean
+        array over the apertures. Blocks and rows are partially queued or
+        exposed when only part of them is. Apertures queued on their own are
+        given as a boolean array and only show at aperture resolution
+        """
+        queued = set(queued)
+        self.aperture_exposed = exposed
+        if queued_apertures is None:
+            queued_apertures = np.zeros(self.aperture_shape, dtype=bool)
+        self.aperture_queued = queued_apertures
+        # (rows * block rows, columns * block columns) ->
+        # (rows, block rows, columns, block columns)
+        apertures = exposed.reshape(
+            self.rows, self.block_rows, self.columns, self.block_cols
+        )
+        rows_exposed = apertures.all(axis=3)
+        rows_touched = apertures.any(axis=3)
+        for block_row in self.blocks:
+            for block in block_row:
+                i, j = block.position
+                for k, row in enumerate(block.rows):
+                    row.queued = (
+                        "queued"
+                        if block.address in queued or row.address in queued
+                        else "not queued"
+                    )
+                    if rows_exposed[i, k, j]:
+                        row.exposed = "exposed"
+                    elif rows_touched[i, k, j]:
+                        row.exposed = "partially exposed"
+                    else:
+                        row.exposed = "not exposed"
+                block.queued = summarize_state(
+                    [row.queued == "queued" for row in block.rows], "queued"
+                )
+                block.exposed = summarize_state(
+                    [rows_exposed[i, k, j] for k in range(len(block.rows))], "exposed"
+                )
+                if block.exposed == "not exposed" and rows_touched[i, :, j].any():
+                    block.exposed = "partially exposed"
+
+    def aperture_states(self) -> np.ndarray:
+        """
+        Returns the state flags of every aperture on the chip raster as a
+        uint8 array. Row state is broadcast over the apertures of each row,
+        the per aperture work is done by NumPy
+        """
+        row_flags = np.array(
+            [
+                [
+                    [
+                        SELECTED * (row.selected or block.selected)
+                        | QUEUED * (row.queued != "not queued")
+                        | EXPOSED * (row.exposed == "exposed")
+                        for row in block.rows
+                    ]
+                    for block in block_row
+                ]
+                for block_row in self.blocks
+            ],
+            dtype=np.uint8,
+        )
+        # (rows, columns, block rows) -> (rows * block rows, columns)
+        row_flags = row_flags.transpose(0, 2, 1).reshape(
+            self.aperture_shape[0], self.columns
+        )
+        states = np.repeat(row_flags, self.block_cols, axis=1)
+        states[self.aperture_queued] |= QUEUED
+        states[self.aperture_exposed] |= EXPOSED
+        states[self.aperture_selection] |= APERTURE_SELECTED
+        return states
@@ -1,10 +1,17 @@
+import base64
+import struct
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Literal, Optional, Union, Tuple
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Literal, Optional, Union, Tuple
 from uuid import UUID
 
 from pydantic import BaseModel, Field
 
+try:
+    import msgpack
+except ImportError:  # Binary framing is optional, JSON always works
+    msgpack = None
+
 
 # =============================================================================
 # Section 0: General data
@@ -44,12 +51,16 @@ class Metadata(BaseModel):
         The type of the message being sent.
     status_msg : str
         Message to be displayed to the UI
+    seq : Optional[int]
+        Set on broadcasts that change the server state, consecutive
+        numbers let clients detect missed updates
     """
 
     user_id: Optional[str] = None
     timestamp: datetime = Field(default_factory=datetime.now)
     message_type: str
     status_msg: str = ""
+    seq: Optional[int] = None
 
 
 class QueueRequest(Metadata):
@@ -111,6 +122,31 @@ class StatusResponse(Metadata):
     message_type: Literal["status"] = "status"
 
 
+class SnapshotResponse(Metadata):
+    """
+    Response data carrying the full server state, sent to a client when it
+    connects or requests a snapshot
+    """
+
+    message_type: Literal["snapshot"] = "snapshot"
+
+
+class PositionResponse(Metadata):
+    """
+    Response data for the live stage position stream, not logged
+    """
+
+    message_type: Literal["position"] = "position"
+
+
+class HitMapResponse(Metadata):
+    """
+    Response data for the live hit map of the online hit finder, not logged
+    """
+
+    message_type: Literal["hit_map"] = "hit_map"
+
+
 MetadataType = Union[
     QueueRequest,
     ExecuteRequest,
@@ -119,6 +155,9 @@ MetadataType = Union[
     ExecuteActionResponse,
     LoginResponse,
     StatusResponse,
+    SnapshotResponse,
+    PositionResponse,
+    HitMapResponse,
 ]
 
 # =============================================================================
@@ -135,6 +174,52 @@ class Payload(BaseModel):
     payload_type: str
 
 
+class FiducialStatus(Payload):
+    """
+    Which fiducials are set on the chip scanner, sent by the server whenever
+    that changes
+    fiducials: dict
+        - Fiducial name (F0, F1, F2) to whether it is set
+
+    Example:
+    --------
+    >>> FiducialStatus(fiducials={"F0": True, "F1": False, "F2": False})
+    """
+
+    payload_type: Literal["fiducial_status"] = "fiducial_status"
+    fiducials: Dict[str, bool]
+
+
+class StagePosition(Payload):
+    """
+    Position of the chip stage, streamed by the server when it changes
+    x, y, z: float
+        - Motor readbacks
+    x_enc, y_enc, z_enc: float
+        - Encoder readbacks
+    chip_x, chip_y: float
+        - Distances from F0 on the chip, None until the fiducials are set
+    location: str
+        - Address of the aperture under the beam ("A1aa"), None between
+          blocks or off the chip
+
+    Example:
+    --------
+    >>> StagePosition(x=1.0, y=2.0, z=0.5, x_enc=10.0, y_enc=20.0, z_enc=5.0)
+    """
+
+    payload_type: Literal["stage_position"] = "stage_position"
+    x: float
+    y: float
+    z: float
+    x_enc: float
+    y_enc: float
+    z_enc: float
+    chip_x: Optional[float] = None
+    chip_y: Optional[float] = None
+    location: Optional[str] = None
+
+
 class ClickToCenter(Payload):
     """
     Delta in pixels from the center of the camera feed
@@ -149,6 +234,9 @@ class ClickToCenter(Payload):
 class NudgeGonio(Payload):
     """
     Payload to indicate the change in x, y, z directions to move the gonio
+    move_id: int
+        - Set by the server when it hands the move to the worker, which
+          reports it back with the completion
 
     """
 
@@ -156,17 +244,53 @@ class NudgeGonio(Payload):
     x_delta: float
     y_delta: float
     z_delta: float
+    move_id: Optional[int] = None
 
 
 class MoveGonio(Payload):
     """
     Payload to indicate the exact position to move the gonio to
+    move_id: int
+        - Set by the server, see NudgeGonio
     """
 
     payload_type: Literal["move_gonio"] = "move_gonio"
     x_pos: float
     y_pos: float
     z_pos: float
+    move_id: Optional[int] = None
+
+
+class StartJog(Payload):
+    """
+    Starts, or keeps alive, a continuous move of one chip stage axis.
+    The GUI repeats it while a direction is held, the worker stops the
+    stage if neither StartJog nor StopJog arrives within its dead-man
+    timeout
+    axis: str
+        - Stage axis to move ("x", "y" or "z")
+    direction: int
+        - 1 for positive, -1 for negative
+    velocity: float
+        - Jog speed in motor units per second
+
+    Example:
+    --------
+    >>> StartJog(axis="x", direction=-1, velocity=200)
+    """
+
+    payload_type: Literal["start_jog"] = "start_jog"
+    axis: Literal["x", "y", "z"]
+    direction: Literal[-1, 1]
+    velocity: float
+
+
+class StopJog(Payload):
+    """
+    Stops any jog in progress on all chip stage axes
+    """
+
+    payload_type: Literal["stop_jog"] = "stop_jog"
 
 
 class SetFiducial(Payload):
@@ -239,6 +363,249 @@ class CollectRow(Payload):
         return f"collect row {self.location}"
 
 
+def pack_indices(indices: Iterable[int]) -> str:
+    """
+    Packs a set of indices into a base64 encoded little endian bitmask
+    """
+    buffer = bytearray()
+    for index in indices:
+        byte = index >> 3
+        if byte >= len(buffer):
+            buffer.extend(bytes(byte - len(buffer) + 1))
+        buffer[byte] |= 1 << (index & 7)
+    return base64.b64encode(bytes(buffer)).decode("ascii")
+
+
+def unpack_indices(mask: str) -> List[int]:
+    """
+    Inverse of pack_indices, returns the set indices in ascending order
+    """
+    indices = []
+    for byte_index, byte in enumerate(base64.b64decode(mask)):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (1 << bit):
+                indices.append(byte_index * 8 + bit)
+    return indices
+
+
+class CollectSelection(Payload):
+    """
+    Bulk collection request covering many blocks, rows or apertures at once.
+    The server expands it into individual queue items in one step
+    level: str
+        - Unit the mask indexes ("block", "row" or "aperture")
+    mask: str
+        - Base64 encoded bitmask, see model.chip for the index of each unit
+    wait_time: int
+        - Exposure time (ms), shared by every expanded item
+
+    Example:
+    --------
+    >>> CollectSelection.from_indices("block", [0, 1, 8], wait_time=20)
+    """
+
+    payload_type: Literal["collect_selection"] = "collect_selection"
+    level: Literal["block", "row", "aperture"]
+    mask: str
+    wait_time: int
+
+    @classmethod
+    def from_indices(
+        cls, level: str, indices: Iterable[int], wait_time: int
+    ) -> "CollectSelection":
+        return cls(level=level, mask=pack_indices(indices), wait_time=wait_time)
+
+    def indices(self) -> List[int]:
+        return unpack_indices(self.mask)
+
+    def __str__(self):
+        return f"collect {len(self.indices())} {self.level}(s)"
+
+
+class CollectApertures(Payload):
+    """
+    Collect an arbitrary set of apertures with one detector arm. The scan
+    runs neighbouring apertures of a row as gated line segments, see
+    server.scan_sidecar.aperture_segments
+    apertures: str
+        - Apertures to collect, packed with pack_indices over aperture indices
+    wait_time: int
+        - Exposure time (ms)
+
+    Example:
+    --------
+    >>> CollectApertures.from_indices([0, 1, 2, 161], wait_time=20)
+    """
+
+    payload_type: Literal["collect_apertures"] = "collect_apertures"
+    apertures: str
+    wait_time: int
+
+    @classmethod
+    def from_indices(cls, indices: Iterable[int], wait_time: int) -> "CollectApertures":
+        return cls(apertures=pack_indices(indices), wait_time=wait_time)
+
+    def indices(self) -> List[int]:
+        return unpack_indices(self.apertures)
+
+    def __str__(self):
+        return f"collect {len(self.indices())} aperture(s)"
+
+
+QueueItem = Union[CollectNeighborhood, CollectRow, CollectApertures]
+
+
+class QueuedItems(Payload):
+    """
+    Batched acknowledgement listing every item added to the queue by a
+    single request, applied by the GUI in one model insert
+    """
+
+    payload_type: Literal["queued_items"] = "queued_items"
+    items: List[QueueItem]
+
+
+class CollectionStatus(Payload):
+    """
+    Progress of a queue item, broadcast when collection of the item starts
+    and when it finishes
+    item: CollectNeighborhood | CollectRow | CollectApertures
+        - The queue item being collected
+    state: str
+        - "running", "completed", "failed" or "skipped" when the ledger
+          shows the item was already collected
+    exposed: str
+        - Apertures recorded as exposed by a completed item, packed with
+          pack_indices over aperture indices
+    """
+
+    payload_type: Literal["collection_status"] = "collection_status"
+    item: QueueItem
+    state: Literal["running", "completed", "failed", "skipped"]
+    exposed: Optional[str] = None
+
+
+class HitMap(Payload):
+    """
+    Spot counts found by the online hit finder. Broadcasts carry the
+    apertures analysed since the last one, snapshots the whole chip
+    apertures: str
+        - Apertures analysed, packed with pack_indices over aperture indices
+    spots: list
+        - Spot count of each aperture in apertures, in ascending index order
+    min_spots: int
+        - Spot count from which an aperture counts as a hit
+
+    Example:
+    --------
+    >>> HitMap(apertures=pack_indices([0, 1]), spots=[3, 25], min_spots=10)
+    """
+
+    payload_type: Literal["hit_map"] = "hit_map"
+    apertures: str
+    spots: List[int]
+    min_spots: int = 10
+
+
+class Prescreen(Payload):
+    """
+    Image blocks with an on axis camera and classify each aperture as filled
+    or empty, generally an immediate request. Empty apertures are skipped
+    during collection
+    locations: list
+        - Blocks to screen, e.g. "A1"
+    camera: str
+        - "lo" or "hi" magnification camera
+
+    Example:
+    --------
+    >>> Prescreen(locations=["A1", "A2"])
+    """
+
+    payload_type: Literal["prescreen"] = "prescreen"
+    locations: List[str]
+    camera: Literal["lo", "hi"] = "lo"
+
+    def __str__(self):
+        return f"pre-screen {len(self.locations)} block(s)"
+
+
+class PrescreenResult(Payload):
+    """
+    Outcome of screening one block
+    location: str
+        - Block screened
+    filled: str
+        - Apertures of the block that appear filled, packed with
+          pack_indices over aperture indices
+    """
+
+    payload_type: Literal["prescreen_result"] = "prescreen_result"
+    location: str
+    filled: str
+
+
+class StateSnapshot(Payload):
+    """
+    Full view state owned by the server. Clients replace their queue and
+    chip state with it, later broadcasts with seq greater than this one
+    are applied on top
+    seq: int
+        - Sequence number of the last state change included
+    queue: list
+        - Items waiting in the queue, in order
+    running: CollectNeighborhood | CollectRow | CollectApertures | None
+        - Item currently being collected
+    fiducials: dict
+        - Whether each fiducial (F0, F1, F2) is set
+    chip_name: str
+        - Name of the chip loaded on the scanner
+    exposed: str
+        - Apertures of the chip recorded as exposed, packed with
+          pack_indices over aperture indices
+    hits: HitMap | None
+        - Spot counts of the chip found by the online hit finder
+    screened: str
+        - Apertures covered by the optical pre-screen, packed with
+          pack_indices over aperture indices
+    filled: str
+        - Screened apertures that appear filled, packed the same way
+    paused: bool
+        - Whether collection is paused
+    """
+
+    payload_type: Literal["state_snapshot"] = "state_snapshot"
+    seq: int
+    queue: List[QueueItem] = []
+    running: Optional[QueueItem] = None
+    fiducials: Dict[str, bool] = {}
+    chip_name: str = "Chip01"
+    exposed: str = ""
+    hits: Optional[HitMap] = None
+    screened: str = ""
+    filled: str = ""
+    paused: bool = False
+
+
+class LoadChip(Payload):
+    """
+    Switch the chip loaded on the scanner. Exposure is recorded per chip
+    name, loading a chip again restores what was collected on it
+    name: str
+        - Chip name, letters, digits, "_" and "-" only as it names the
+          chip's ledger and master files
+
+    Example:
+    --------
+    >>> LoadChip(name="Chip02")
+    """
+
+    payload_type: Literal["load_chip"] = "load_chip"
+    name: str = Field(pattern=r"^[A-Za-z0-9_-]+$")
+
+
 class CollectQueue(Payload):
     """
     Collect queue, generally an immediate request
@@ -247,6 +614,35 @@ class CollectQueue(Payload):
     payload_type: Literal["collect_queue"] = "collect_queue"
 
 
+class PauseQueue(Payload):
+    """
+    Pause collection, generally an immediate request. A running scan stops
+    at the next line boundary and no further queue item is started
+    """
+
+    payload_type: Literal["pause_queue"] = "pause_queue"
+
+
+class ResumeQueue(Payload):
+    """
+    Resume a paused collection, generally an immediate request. A paused
+    scan continues from its next line with the detector re-armed for the
+    frames left
+    """
+
+    payload_type: Literal["resume_queue"] = "resume_queue"
+
+
+class EmergencyStop(Payload):
+    """
+    Stop the running scan at once, generally an immediate request. Closes
+    the shutter and stops the Zebra, PPMAC, chip motors and Eiger from the
+    worker's control lane, then aborts the plan. The queue is paused
+    """
+
+    payload_type: Literal["emergency_stop"] = "emergency_stop"
+
+
 class ClearQueue(Payload):
     """
     Clear the queue of all requests, generally an immediate request
@@ -264,6 +660,24 @@ class RemoveFromQueue(Payload):
     index: int
 
 
+class RequestSnapshot(Payload):
+    """
+    Sent by a client when it detects a gap in the state updates, asks the
+    server for the current state instead of a replay. The server also sends
+    the snapshot unprompted when a client connects
+    last_seq: int
+        - Sequence number of the last state update the client applied,
+          None if it has none
+
+    Example:
+    --------
+    >>> RequestSnapshot(last_seq=41)
+    """
+
+    payload_type: Literal["request_snapshot"] = "request_snapshot"
+    last_seq: Optional[int] = None
+
+
 class SetGovernorState(Payload):
     payload_type: Literal["set_governor_state"] = "set_governor_state"
     state: str
@@ -272,15 +686,32 @@ class SetGovernorState(Payload):
 PayloadType = Union[
     NudgeGonio,
     MoveGonio,
+    StartJog,
+    StopJog,
     SetFiducial,
     ClearFiducials,
     GoToFiducial,
     CollectNeighborhood,
     CollectRow,
+    CollectSelection,
+    CollectApertures,
+    QueuedItems,
+    CollectionStatus,
+    HitMap,
+    Prescreen,
+    PrescreenResult,
+    StateSnapshot,
+    LoadChip,
     ClearQueue,
     CollectQueue,
+    PauseQueue,
+    ResumeQueue,
+    EmergencyStop,
     RemoveFromQueue,
     ClickToCenter,
+    FiducialStatus,
+    StagePosition,
+    RequestSnapshot,
     SetGovernorState
 ]
 
@@ -294,3 +725,91 @@ class Message(BaseModel):
     payload: Optional[PayloadType] = None
 
 
+
+
+# =============================================================================
+# Section 4: Wire encoding
+# =============================================================================
+
+# Encodings are negotiated as websocket subprotocols when the client connects.
+# A client or server without msgpack installed simply does not offer it and
+# both ends fall back to JSON text frames.
+JSON_SUBPROTOCOL = "chipsight.json"
+MSGPACK_SUBPROTOCOL = "chipsight.msgpack"
+
+_EXT_UUID = 1
+_EXT_DATETIME = 2
+
+
+def supported_subprotocols() -> "list[str]":
+    """
+    Subprotocols this side can speak, in order of preference
+    """
+    if msgpack is None:
+        return [JSON_SUBPROTOCOL]
+    return [MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL]
+
+
+def select_subprotocol(offered: "list[str]") -> Optional[str]:
+    """
+    Picks the preferred subprotocol out of the ones offered by a client.
+    Returns None for clients that do not negotiate, which means JSON
+    """
+    for subprotocol in supported_subprotocols():
+        if subprotocol in offered:
+            return subprotocol
+    return None
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, UUID):
+        return msgpack.ExtType(_EXT_UUID, obj.bytes)
+    if isinstance(obj, datetime):
+        # Flag byte records whether the datetime was timezone aware, naive
+        # datetimes (the Metadata default) round trip as local time
+        aware = obj.tzinfo is not None
+        return msgpack.ExtType(
+            _EXT_DATETIME, struct.pack(">d?", obj.timestamp(), aware)
+        )
+    raise TypeError(f"Cannot encode {type(obj).__name__} with msgpack")
+
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == _EXT_UUID:
+        return UUID(bytes=data)
+    if code == _EXT_DATETIME:
+        timestamp, aware = struct.unpack(">d?", data)
+        if aware:
+            return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        return datetime.fromtimestamp(timestamp)
+    return msgpack.ExtType(code, data)
+
+
+def encode_message(message: Message, subprotocol: Optional[str] = None) -> Union[str, bytes]:
+    """
+    Encodes a message for the negotiated subprotocol. Returns bytes to be
+    sent as a binary frame for msgpack, otherwise JSON text
+
+    Example:
+    --------
+    >>> encode_message(message, MSGPACK_SUBPROTOCOL)
+    """
+    if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+        return msgpack.packb(
+            message.model_dump(exclude_none=True), default=_msgpack_default
+        )
+    return message.model_dump_json()
+
+
+def decode_message(data: Union[str, bytes]) -> Message:
+    """
+    Decodes a websocket frame into a message. Binary frames are msgpack,
+    text frames are JSON
+    """
+    if isinstance(data, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError("Received a binary frame but msgpack is not installed")
+        return Message.model_validate(
+            msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False)
+        )
+    return Message.model_validate_json(data)
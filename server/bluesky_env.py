@@ -1,16 +1,28 @@
 import asyncio
 import os
-from concurrent.futures import Future, ThreadPoolExecutor
-from multiprocessing import Pipe, Process
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
 
 from bluesky.run_engine import RunEngine, get_bluesky_event_loop
-from bluesky.utils import PersistentDict
+from bluesky.utils import Msg, PersistentDict, RunEngineInterrupted
 from databroker import Broker
+import numpy as np
 
-from server.chip_scanner_plans import BL_calibration, chip_scanner, govStateSet
+from server.chip_scanner_plans import (
+    BL_calibration,
+    chip_scanner,
+    configure_hardware,
+    govStateSet,
+)
+from server.devices import cam_7, cam_8
+from server.document_writer import BatchedDocumentWriter
+from server.scan_sidecar import sidecar_writer
 from model.comm_protocol import (
     ClearQueue,
+    CollectApertures,
     CollectNeighborhood,
     CollectQueue,
     CollectRow,
@@ -18,30 +30,204 @@ from model.comm_protocol import (
     ExecuteActionResponse,
     ExecuteRequest,
     GoToFiducial,
+    LoadChip,
     LoginResponse,
     Message,
     MetadataType,
     MoveGonio,
     NudgeGonio,
     PayloadType,
+    Prescreen,
     QueueActionResponse,
     QueueRequest,
     SetFiducial,
+    ClearFiducials,
     ClickToCenter,
-    SetGovernorState
+    SetGovernorState,
+    StartJog,
+    StopJog,
 )
-from typing import Dict, Type,Callable
+from typing import Callable, Dict, Optional, Set, Tuple, Type
 import traceback
 
+# Device actions that must not run beside a plan: the fiducials define the
+# scan and the plans drive the governor themselves
+DEVICE_ACTIONS = (SetFiducial, ClearFiducials, SetGovernorState)
+
+
+class PositionMonitor:
+    """
+    Streams the chip stage position to the server. Readbacks arrive through
+    CA monitors, changes are sent at most rate times per second along with
+    the chip coordinates and aperture under the beam
+    """
+
+    axes = ("x", "y", "z")
+
+    def __init__(self, send: Callable, rate=10.0):
+        self.send = send
+        self.interval = 1 / rate
+        self.readings: Dict[str, float] = {}
+        self.changed = threading.Event()
+        self.stopped = threading.Event()
+        self.last_sent = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        for axis in self.axes:
+            motor = getattr(chip_scanner, axis)
+            motor.user_readback.subscribe(self.on_reading(axis), run=True)
+            motor.encoder_readback.subscribe(self.on_reading(f"{axis}_enc"), run=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.changed.set()
+
+    def on_reading(self, name: str):
+        def callback(value, **kwargs):
+            # Runs on the CA thread, only records the value
+            self.readings[name] = value
+            self.changed.set()
+
+        return callback
+
+    def loop(self):
+        while not self.stopped.is_set():
+            self.changed.wait()
+            self.changed.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.send_position()
+            except Exception as e:
+                print(f"Could not send stage position: {e}")
+            self.stopped.wait(self.interval)
+
+    def send_position(self):
+        readings = dict(self.readings)
+        if len(readings) < 2 * len(self.axes):
+            return
+        position = {name: float(value) for name, value in readings.items()}
+        if position == self.last_sent:
+            return
+        self.last_sent = position
+        position["chip_x"] = position["chip_y"] = position["location"] = None
+        if all(getattr(chip_scanner, name) is not None for name in ("F0", "F1", "F2")):
+            chip_x, chip_y = chip_scanner.location_to_fiducial_distances(
+                [readings["x"], readings["y"], readings["z"]]
+            )
+            position["chip_x"], position["chip_y"] = float(chip_x), float(chip_y)
+            position["location"] = chip_scanner.fiducial_distances_to_name(chip_x, chip_y)
+        self.send({"status": "position", "position": position})
+
 
-class RunEngineWorker(Process):
-    def __init__(self, conn, config, proposal_config):
-        super().__init__()
-        print(f"Initializing RE worker {conn}")
+class OpticsMonitor:
+    """
+    Keeps the web process up to date with the camera calibration and the
+    size of the ROI shown at each GUI zoom level, which click to center
+    needs to turn pixels into microns. Values arrive through CA monitors
+    and are sent whenever one changes, which is rare
+    """
+
+    def __init__(self, send: Callable):
+        self.send = send
+        # Per GUI zoom level: calibration signal and ROI
+        self.zoom_levels = [
+            (BL_calibration.LoMagCal, cam_7.roi2),
+            (BL_calibration.LoMagCal, cam_7.roi3),
+            (BL_calibration.HiMagCal, cam_8.roi2),
+            (BL_calibration.HiMagCal, cam_8.roi1),
+        ]
+        self.signals = {}
+        for level, (calibration, roi) in enumerate(self.zoom_levels):
+            self.signals[f"calibration_{level}"] = calibration
+            self.signals[f"roi_x_{level}"] = roi.size.x
+            self.signals[f"roi_y_{level}"] = roi.size.y
+        self.readings: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        for name, signal in self.signals.items():
+            signal.subscribe(self.on_reading(name), run=True)
+
+    def on_reading(self, name: str):
+        def callback(value, **kwargs):
+            with self.lock:
+                self.readings[name] = value
+                if len(self.readings) == len(self.signals):
+                    self.send_optics()
+
+        return callback
+
+    def send_optics(self):
+        levels = range(len(self.zoom_levels))
+        self.send(
+            {
+                "status": "optics",
+                "microns_per_pixel": [
+                    float(self.readings[f"calibration_{level}"]) for level in levels
+                ],
+                "roi_sizes": [
+                    (float(self.readings[f"roi_x_{level}"]), float(self.readings[f"roi_y_{level}"]))
+                    for level in levels
+                ],
+            }
+        )
+
+
+def paused_at_first_checkpoint(plan):
+    """
+    Runs a plan that was paused before it started
+    """
+    yield Msg("pause", defer=True)
+    return (yield from plan)
+
+
+class RunEngineWorker:
+    """
+    Runs plans and device actions for the web process, which talks to it
+    over conn. Started in its own process by server.worker_process.
+
+    A standby worker initialises the RunEngine, databroker and devices
+    like the active one, but streams nothing until the supervisor activates
+    it with the state of the worker it replaces
+    """
+
+    def __init__(self, conn, config, proposal_config, standby=False):
+        print(f"Initializing RE worker {conn}{' (standby)' if standby else ''}")
         self.conn = conn
+        self.standby = standby
         self.config = config
         self.proposal_config = proposal_config
-        
+        # Jog state, the timer is the dead-man switch that stops the stage
+        # when the GUI stops refreshing the jog
+        self.jog_lock = threading.Lock()
+        self.jog_timer = None
+        self.active_jog = None
+        # The pipe is written from the plan and control lanes, the jog
+        # timer and the monitors
+        self.send_lock = threading.Lock()
+        self.position_monitor = None
+        self.optics_monitor = None
+        # Plan lane: payloads waiting for the RunEngine, and resume or
+        # abort commands for a paused plan
+        self.plans: "queue.Queue[Optional[PayloadType]]" = queue.Queue()
+        self.paused_commands: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self.current_plan: Optional[PayloadType] = None
+        # False until the current plan is handed to the RunEngine, commands
+        # for it are kept until then
+        self.plan_started = False
+        self.pause_requested = False
+        self.actions = ThreadPoolExecutor(1, "device-action")
+        # Device actions started while no plan was active, a plan waits for
+        # them. The lock orders starting an action against starting a plan
+        self.pending_actions: Set[Future] = set()
+        self.lane_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
 
     def initialize_run_engine(self):
         self.RE = RunEngine()
@@ -52,7 +238,12 @@ class RunEngineWorker(Process):
 
         db = Broker.named(beamline)
         print("Initialized databroker")
-        self.RE.subscribe(db.insert)
+        # Documents are stored from a background thread, scans never wait
+        # on the document store
+        self.document_writer = BatchedDocumentWriter(
+            db.insert, **self.config.get("document_writer", {})
+        )
+        self.RE.subscribe(self.document_writer)
         print("Initialized databroker")
 
         from bluesky.log import config_bluesky_logging
@@ -63,29 +254,343 @@ class RunEngineWorker(Process):
         p = Path(self.config["fiducial_file"])
         if p.exists():
             chip_scanner.load_fiducials(str(p))
+        if not self.standby:
+            configure_hardware()
+            self.start_monitors()
+
+    def start_monitors(self):
+        self.report_fiducials()
+        self.position_monitor = PositionMonitor(
+            self.send, rate=self.config.get("position_rate", 10.0)
+        )
+        self.position_monitor.start()
+        self.optics_monitor = OpticsMonitor(self.send)
+        self.optics_monitor.start()
+
+    def activate(self, message):
+        """
+        Takes over from a failed worker: its fiducials, and with them the
+        aperture transform, the loaded chip and the data path. Stops the
+        hardware first when the failed worker was running a plan, then
+        configures it, which a standby leaves to the active worker. The
+        configuration runs off the control lane, which keeps answering
+        heartbeats, and plans wait for it
+        """
+        if message.get("emergency_stop"):
+            self.emergency_stop()
+        with self.lane_lock:
+            future = self.actions.submit(self.configure_hardware)
+            self.pending_actions.add(future)
+            future.add_done_callback(self.pending_actions.discard)
+        if message.get("fiducials") is not None:
+            chip_scanner.set_fiducials(
+                *[None if value is None else np.asarray(value) for value in message["fiducials"]]
+            )
+        if message.get("chip_name"):
+            chip_scanner.chip_name = message["chip_name"]
+        if message.get("filepath") is not None:
+            chip_scanner.filepath = message["filepath"]
+        self.standby = False
+        self.start_monitors()
+        print("Standby worker activated")
+        self.send({"status": "activated"})
+
+    def configure_hardware(self):
+        try:
+            configure_hardware()
+        except Exception as e:
+            print(f"Failed configuring the hardware {e}")
+            self.send(
+                {
+                    "status": "failed",
+                    "payload_type": "configure_hardware",
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                }
+            )
+
+    def report_fiducials(self):
+        self.send(
+            {
+                "status": "fiducials",
+                "fiducials": {
+                    name: getattr(chip_scanner, name, None) is not None
+                    for name in ("F0", "F1", "F2")
+                },
+                # Handed to a standby worker if this one fails
+                "values": [
+                    None if value is None else np.asarray(value).tolist()
+                    for value in (
+                        getattr(chip_scanner, name, None)
+                        for name in ("F0", "F1", "F2", "F0_enc", "F1_enc", "F2_enc")
+                    )
+                ],
+            }
+        )
 
     def run(self):
+        """
+        The calling thread becomes the plan lane, which owns the RunEngine.
+        Messages are read by the control thread, so pause, abort, status
+        queries and cache updates are served while a plan runs
+        """
         self.initialize_run_engine()
+        self.control_thread = threading.Thread(
+            target=self.control_loop, name="worker-control", daemon=True
+        )
+        self.control_thread.start()
+        self.run_plans()
+        if self.position_monitor:
+            self.position_monitor.stop()
+        self.actions.shutdown(wait=True)
+        sidecar_writer.close()
+        self.document_writer.close()
 
+    def control_loop(self):
+        # Tells the supervisor the worker is initialised
+        self.send_status()
         while True:
-            message = self.conn.recv()
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                message = "STOP"
             if message == "STOP":
-                break
-            # elif isinstance(message, dict) and message["action"] == "execute_plan":
+                if self.RE.state != "idle":
+                    self.interrupt("abort", "worker shutting down")
+                self.plans.put(None)
+                return
+            try:
+                self.handle_control(message)
+            except Exception as e:
+                print(f"Failed control message {message}: {e}")
+                self.send({"status": f"failed control message: {e}"})
+
+    def handle_control(self, message):
+        if isinstance(message, dict):
+            action = message.get("action")
+            if action == "set_filepath":
+                chip_scanner.filepath = message["path"]
+                print(f"Data path set to {message['path']}")
+            elif action == "activate":
+                self.activate(message)
+            elif action == "emergency_stop":
+                self.emergency_stop(message.get("sent"))
+            elif action == "status":
+                self.send_status(message.get("sent"))
+            elif action == "pause":
+                self.pause(message.get("defer", True))
+            elif action in ("resume", "abort", "stop"):
+                self.interrupt(action, message.get("reason", "requested"))
+            else:
+                print(f"Unknown control action {action}")
+        elif isinstance(message, (StartJog, StopJog, LoadChip)):
+            # A cache and a jog velocity, handled at once. Jogs are refused
+            # while a plan is active
+            self.plan_selector(payload=message)
+        elif isinstance(message, DEVICE_ACTIONS):
+            with self.lane_lock:
+                if self.current_plan is None and self.plans.empty():
+                    # Slow device actions, the governor can take half a
+                    # minute to reach a state, run without holding up the
+                    # control lane
+                    future = self.actions.submit(self.run_action, message)
+                    self.pending_actions.add(future)
+                    future.add_done_callback(self.pending_actions.discard)
+                    return
+            # Queued behind the plans, never run beside one
+            self.plans.put(message)
+        else:
+            self.plans.put(message)
+
+    def pause(self, defer: bool):
+        with self.lane_lock:
+            if self.current_plan is not None and not self.plan_started:
+                # Still waiting on a device action, it pauses at its first
+                # checkpoint
+                self.pause_requested = True
+            elif self.RE.state == "running":
+                self.pause_requested = True
+                self.RE.request_pause(defer=defer)
+
+    def interrupt(self, action: str, reason: str):
+        """
+        Resumes, aborts or stops the plan. The RunEngine is resumed and
+        ended from the plan lane, which waits while it is paused, so a
+        running plan is paused first. A plan that has not started yet is
+        ended before it starts
+        """
+        with self.lane_lock:
+            if self.current_plan is not None and not self.plan_started:
+                if action == "resume":
+                    self.pause_requested = False
+                else:
+                    self.paused_commands.put((action, reason))
+                return
+        if self.RE.state == "idle":
+            return
+        if self.RE.state == "running":
+            if action == "resume":
+                # A deferred pause may still be pending, the plan is resumed
+                # as soon as it reaches it
+                if self.pause_requested:
+                    self.paused_commands.put((action, reason))
+                return
+            self.RE.request_pause(defer=False)
+        self.paused_commands.put((action, reason))
+
+    def emergency_stop(self, sent: Optional[float] = None):
+        """
+        Stops the hardware straight from the control lane, then aborts the
+        plan, which only notices at its next message to the RunEngine
+        """
+        received = time.time()
+        started = time.monotonic()
+        steps = chip_scanner.emergency_stop(
+            self.config.get("emergency_stop", {}).get("ppmac_abort_pv")
+        )
+        hardware_ms = (time.monotonic() - started) * 1000
+        self.interrupt("abort", "emergency stop")
+        print(f"Emergency stop in {hardware_ms:.1f} ms: {steps}")
+        self.send(
+            {
+                "status": "emergency_stop",
+                "steps": steps,
+                "hardware_ms": hardware_ms,
+                "transit_ms": None if sent is None else (received - sent) * 1000,
+                "sent": sent,
+            }
+        )
+
+    def send_status(self, sent: Optional[float] = None):
+        self.send(
+            {
+                "status": "worker_status",
+                # A ProxyString, which does not unpickle on the other end
+                "run_engine": str(self.RE.state),
+                "plan": None if self.current_plan is None else str(self.current_plan),
+                "queued_plans": self.plans.qsize(),
+                "filepath": str(chip_scanner.filepath),
+                "sent": sent,
+            }
+        )
+
+    def run_action(self, payload):
+        try:
+            self.plan_selector(payload=payload)
+            self.send({"status": "completed", "payload_type": payload.payload_type})
+        except Exception as e:
+            print(f"Failed action {e}")
+            self.send(
+                {
+                    "status": "failed",
+                    "payload_type": payload.payload_type,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                }
+            )
+
+    def run_plans(self):
+        while True:
+            message = self.plans.get()
+            if message is None:
+                return
+            if isinstance(message, DEVICE_ACTIONS):
+                self.run_action(message)
+                continue
+            with self.lane_lock:
+                self.current_plan = message
+                self.plan_started = False
+                # Commands meant for an earlier plan are void
+                self.pause_requested = False
+                while not self.paused_commands.empty():
+                    self.paused_commands.get_nowait()
+            # Device actions started before the plan finish first
+            wait(list(self.pending_actions))
+            plan = self.plan_selector(payload=message)
+            if not plan:
+                self.current_plan = None
+                continue
+            # Scans of this plan only, it may end before it starts
+            chip_scanner.scans = []
+            try:
+                print("running plan")
+                self.send({"status": f"running plan for {message}"})
+                with self.lane_lock:
+                    self.plan_started = True
+                    ended = None
+                    while not self.paused_commands.empty():
+                        action, reason = self.paused_commands.get_nowait()
+                        ended = f"{'stopped' if action == 'stop' else 'aborted'}: {reason}"
+                    if self.pause_requested:
+                        plan = paused_at_first_checkpoint(plan)
+                if ended is not None:
+                    plan.close()
+                    raise RuntimeError(f"plan {ended}")
+                try:
+                    self.RE(plan)
+                except RunEngineInterrupted:
+                    # Paused, resumed or ended by the control lane below
+                    pass
+                ended = self.wait_while_paused()
+                if ended is not None:
+                    raise RuntimeError(f"plan {ended}")
+                result = {
+                    "status": "completed",
+                    "payload_type": message.payload_type,
+                }
+                if isinstance(message, (NudgeGonio, MoveGonio)):
+                    result["move_id"] = message.move_id
+                if isinstance(
+                    message, (CollectNeighborhood, CollectRow, CollectApertures)
+                ):
+                    # Empty when the scan refused to run
+                    result["scans"] = chip_scanner.scans
+                self.send(result)
+                print("Completed plan")
+            except Exception as e:
+                print(f"Failed plan {e}")
+                result = {
+                    "status": "failed",
+                    "payload_type": message.payload_type,
+                    "error": str(e),
+                    "traceback": traceback.format_exc(),
+                }
+                if isinstance(message, (NudgeGonio, MoveGonio)):
+                    result["move_id"] = message.move_id
+                if isinstance(
+                    message, (CollectNeighborhood, CollectRow, CollectApertures)
+                ):
+                    # Lines exposed before the plan ended
+                    result["scans"] = chip_scanner.scans
+                self.send(result)
+            finally:
+                self.current_plan = None
+
+    def wait_while_paused(self) -> Optional[str]:
+        """
+        Waits for the control lane to resume or end a paused plan. Returns
+        how the plan was ended, None when it ran to completion. A resumed
+        plan that pauses again is waited for again
+        """
+        while self.RE.state == "paused":
+            self.pause_requested = False
+            self.send({"status": "paused", "payload_type": self.current_plan.payload_type})
+            action, reason = self.paused_commands.get()
+            if action == "resume":
+                self.send({"status": "resumed", "payload_type": self.current_plan.payload_type})
+                # Collections re-arm the detector for the frames left
+                chip_scanner.rearm_pending = True
+                try:
+                    self.RE.resume()
+                except RunEngineInterrupted:
+                    pass
+            elif action == "stop":
+                self.RE.stop()
+                return f"stopped: {reason}"
             else:
-                plan = self.plan_selector(payload=message)
-                if plan:
-                    try:
-                        print("running plan")
-                        self.conn.send(
-                            {"status": f"running plan for {message}"}
-                        )
-                        self.RE(plan)
-                        self.conn.send({"status": "completed"})
-                        print("Completed plan")
-                    except Exception as e:
-                        print(f"Failed plan {e}")
-                        self.conn.send({"status": "failed", "error": str(e), "traceback": traceback.format_exc()})
+                self.RE.abort(reason=reason)
+                return f"aborted: {reason}"
+        return None
 
     def plan_selector(self, payload):
         if isinstance(payload, GoToFiducial):
@@ -100,13 +605,95 @@ class RunEngineWorker(Process):
             chip_scanner.manual_set_fiducial(payload.name)
             if chip_scanner.F0 is not None and chip_scanner.F1 is not None and chip_scanner.F2 is not None:
                 chip_scanner.save_fiducials(self.config["fiducial_file"])
+            self.report_fiducials()
+        elif isinstance(payload, LoadChip):
+            chip_scanner.chip_name = payload.name
+        elif isinstance(payload, ClearFiducials):
+            chip_scanner.set_fiducials(None, None, None, None, None, None)
+            self.report_fiducials()
         elif isinstance(payload, MoveGonio):
             return chip_scanner.drive_to_position(
                 payload.x_pos,
                 payload.y_pos,
             )
+        elif isinstance(payload, CollectNeighborhood):
+            return chip_scanner.ppmac_neighbourhood_scan(
+                payload.location, payload.wait_time
+            )
+        elif isinstance(payload, CollectRow):
+            return chip_scanner.ppmac_single_line_scan(
+                payload.location, payload.wait_time
+            )
+        elif isinstance(payload, CollectApertures):
+            return chip_scanner.ppmac_aperture_scan(
+                payload.indices(), payload.wait_time
+            )
+        elif isinstance(payload, Prescreen):
+            return self.prescreen(payload)
         elif isinstance(payload, SetGovernorState):
             govStateSet(payload.state, configStr="Chip_Scanner")
+        elif isinstance(payload, StartJog):
+            self.start_jog(payload)
+        elif isinstance(payload, StopJog):
+            self.stop_jog()
+
+    def prescreen(self, payload: Prescreen):
+        """
+        Screens the blocks one after the other, each result is reported as
+        soon as the block is done
+        """
+        config = self.config.get("prescreen", {})
+        camera = chip_scanner.lo_camera if payload.camera == "lo" else chip_scanner.hi_camera
+        for location in payload.locations:
+            filled = yield from chip_scanner.prescreen_block(
+                location,
+                camera,
+                ratio=config.get("ratio", 1.5),
+                empty_score=config.get("empty_score"),
+                settle=config.get("settle", 0.3),
+            )
+            self.send(
+                {"status": "prescreen", "location": location, "filled": filled.tolist()}
+            )
+
+    def start_jog(self, payload: StartJog):
+        if self.RE.state != "idle":
+            # Never move the stage under a running or paused plan
+            self.send(
+                {
+                    "status": "failed",
+                    "payload_type": payload.payload_type,
+                    "error": f"cannot jog while the RunEngine is {self.RE.state}",
+                }
+            )
+            return
+        with self.jog_lock:
+            if self.jog_timer:
+                self.jog_timer.cancel()
+            jog = (payload.axis, payload.direction, payload.velocity)
+            if jog != self.active_jog:
+                if self.active_jog:
+                    chip_scanner.stop_jog()
+                chip_scanner.start_jog(*jog)
+                self.active_jog = jog
+            self.jog_timer = threading.Timer(
+                self.config.get("jog_timeout", 0.5),
+                self.stop_jog,
+                kwargs={"reason": "dead-man timeout"},
+            )
+            self.jog_timer.daemon = True
+            self.jog_timer.start()
+
+    def stop_jog(self, reason="requested"):
+        with self.jog_lock:
+            if self.jog_timer:
+                self.jog_timer.cancel()
+                self.jog_timer = None
+            if self.active_jog:
+                chip_scanner.stop_jog()
+                print(f"Stopped jog {self.active_jog}: {reason}")
+                self.send({"status": f"jog stopped ({reason})"})
+            self.active_jog = None
 
 
 def run_worker(worker):
@@ -0,0 +1,191 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, List, Optional
+
+import httpx
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+SYNTHETIC_URL = "synthetic"
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+# Buffered stream data is dropped past this size if no frame end is found
+MAX_BUFFER = 16 * 1024 * 1024
+
+
+class CameraRelay:
+    """
+    Pulls one camera stream and keeps only its latest JPEG frame, which is
+    fanned out to any number of clients. The camera is only read while at
+    least one client is watching, and is released idle_timeout seconds
+    after the last one leaves.
+    """
+
+    def __init__(self, url: str, idle_timeout=10.0, max_backoff=10.0):
+        self.url = url
+        self.idle_timeout = idle_timeout
+        self.max_backoff = max_backoff
+        self.frame: Optional[bytes] = None
+        self.frame_id = 0
+        self.new_frame = asyncio.Condition()
+        self.clients = 0
+        self.pull_task: Optional[asyncio.Task] = None
+        self.idle_handle: Optional[asyncio.TimerHandle] = None
+
+    def subscribe(self):
+        self.clients += 1
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.pull_task is None or self.pull_task.done():
+            self.pull_task = asyncio.create_task(self.pull())
+
+    def unsubscribe(self):
+        self.clients -= 1
+        if self.clients == 0:
+            self.idle_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self.stop
+            )
+
+    def stop(self):
+        self.idle_handle = None
+        if self.pull_task is not None:
+            self.pull_task.cancel()
+            self.pull_task = None
+        self.frame = None
+
+    async def publish(self, frame: bytes):
+        async with self.new_frame:
+            self.frame = frame
+            self.frame_id += 1
+            self.new_frame.notify_all()
+
+    async def pull(self):
+        attempt = 0
+        while True:
+            try:
+                if self.url == SYNTHETIC_URL:
+                    await self.pull_synthetic()
+                else:
+                    await self.pull_mjpeg()
+                attempt = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Camera relay for {self.url} failed: {e}")
+            backoff = min(self.max_backoff, 0.5 * 2**attempt)
+            attempt += 1
+            await asyncio.sleep(backoff / 2 + random.uniform(0, backoff / 2))
+
+    async def pull_mjpeg(self):
+        # Frames are cut on the JPEG start and end markers, which works for
+        # any multipart boundary the camera server uses
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None)) as client:
+            async with client.stream("GET", self.url) as response:
+                response.raise_for_status()
+                buffer = b""
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
+                    end = buffer.rfind(JPEG_END)
+                    if end < 0:
+                        if len(buffer) > MAX_BUFFER:
+                            buffer = b""
+                        continue
+                    start = buffer.rfind(JPEG_START, 0, end)
+                    if start >= 0:
+                        # Frames completed in the same chunk are dropped in
+                        # favour of the newest one
+                        await self.publish(buffer[start : end + 2])
+                    buffer = buffer[end + 2 :]
+
+    async def pull_synthetic(self, fps=30, width=640, height=480):
+        """
+        Moving test pattern, stands in for a camera during testing
+        """
+        if cv2 is None:
+            raise RuntimeError("The synthetic camera source requires opencv-python")
+        y, x = np.mgrid[0:height, 0:width]
+        while True:
+            t = time.time()
+            image = np.stack(
+                [
+                    (x + 100 * t) % 256,
+                    (y + 60 * t) % 256,
+                    np.full_like(x, int(t * 10) % 256),
+                ],
+                axis=-1,
+            ).astype(np.uint8)
+            cv2.putText(
+                image,
+                time.strftime("%H:%M:%S"),
+                (20, 40),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                1,
+                (255, 255, 255),
+                2,
+            )
+            ok, encoded = cv2.imencode(".jpg", image)
+            if ok:
+                await self.publish(encoded.tobytes())
+            await asyncio.sleep(max(0, 1 / fps - (time.time() - t)))
+
+    async def latest(self, timeout=5.0) -> Optional[bytes]:
+        """
+        Returns the latest frame, waiting for the first one if needed
+        """
+        if self.frame is None:
+            async with self.new_frame:
+                try:
+                    await asyncio.wait_for(
+                        self.new_frame.wait_for(lambda: self.frame is not None), timeout
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        return self.frame
+
+    async def frames(self, max_fps=30.0) -> AsyncIterator[bytes]:
+        """
+        Yields frames to one client. A frame is only sent when it is newer
+        than the last one sent to the client, and never faster than the
+        client consumes them: the time taken to send each frame stretches
+        the interval, so slow clients get a lower rate instead of a backlog
+        """
+        min_interval = 1 / max_fps
+        interval = min_interval
+        last_id = -1
+        while True:
+            async with self.new_frame:
+                await self.new_frame.wait_for(
+                    lambda: self.frame is not None and self.frame_id != last_id
+                )
+                frame, last_id = self.frame, self.frame_id
+            started = time.monotonic()
+            yield frame
+            send_time = time.monotonic() - started
+            # Smoothed so that one slow send does not drop the rate for long
+            interval = max(min_interval, 0.8 * interval + 0.2 * send_time)
+            await asyncio.sleep(max(0, interval - send_time))
+
+
+class CameraRelays:
+    """
+    One relay per configured camera URL, addressed by index
+    """
+
+    def __init__(self, urls: List[str], idle_timeout=10.0):
+        self.relays = [CameraRelay(url, idle_timeout) for url in urls]
+
+    def __len__(self):
+        return len(self.relays)
+
+    def __getitem__(self, index: int) -> CameraRelay:
+        return self.relays[index]
+
+    def stop(self):
+        for relay in self.relays:
+            relay.stop()
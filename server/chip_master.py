@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import h5py
+import numpy as np
+
+from server.scan_sidecar import read_aperture_index
+
+APERTURE_SHAPE = (160, 160)
+# Eiger file writer naming, every scan fits in its first data file since
+# configure_detector sets the images per file to the number of triggers
+DATA_FILE_SUFFIX = "_data_000001.h5"
+DATA_PATH = "entry/data/data"
+DEFAULT_DTYPE = np.uint32
+
+
+def frame_runs(xs: np.ndarray, frames: np.ndarray) -> Iterator[Tuple[int, int, int]]:
+    """
+    Splits the apertures of one raster row, sorted by column, into runs
+    whose columns and frames both increase by one, yields (first column,
+    first frame, length). Rows scanned right to left give runs of one
+    """
+    breaks = np.flatnonzero((np.diff(xs) != 1) | (np.diff(frames) != 1)) + 1
+    for start, stop in zip(np.r_[0, breaks], np.r_[breaks, len(xs)]):
+        yield int(xs[start]), int(frames[start]), int(stop - start)
+
+
+class ChipMaster:
+    """
+    One HDF5 file per chip with a virtual dataset "data" of shape (chip
+    raster rows, chip raster columns, frame height, frame width) over the
+    Eiger data of every scan on the chip. A block, row or aperture is a
+    plain slice, for example data[20:40, 0:20] is block B1.
+
+    The file is rebuilt from the list of scan sidecars each time a scan
+    lands. Only the mapping is written, no detector data is copied, and
+    the aperture to frame mapping comes from one read per sidecar. An
+    aperture collected twice maps to its latest scan.
+    """
+
+    def __init__(self, path: Path, chip_name: str):
+        self.path = Path(path)
+        self.chip_name = chip_name
+
+    def sidecars(self) -> List[str]:
+        if not self.path.exists():
+            return []
+        with h5py.File(self.path, "r") as f:
+            return [name.decode() for name in f["scans/sidecar"][()]]
+
+    def add_scan(self, sidecar: Path):
+        sidecars = [name for name in self.sidecars() if name != str(sidecar)]
+        sidecars.append(str(sidecar))
+        self.rebuild(sidecars)
+
+    def rebuild(self, sidecars: List[str]):
+        scan_index = np.full(APERTURE_SHAPE, -1, dtype=np.int32)
+        frame_index = np.full(APERTURE_SHAPE, -1, dtype=np.int32)
+        data_files = []
+        frame_counts = []
+        for i, sidecar in enumerate(sidecars):
+            apertures = read_aperture_index(Path(sidecar))
+            scan_index.flat[apertures] = i
+            frame_index.flat[apertures] = np.arange(len(apertures))
+            with h5py.File(sidecar, "r") as f:
+                data_files.append(f"{f.attrs['data_file']}{DATA_FILE_SUFFIX}")
+            frame_counts.append(len(apertures))
+        frame_shape, dtype = self.frame_format(data_files)
+
+        temporary_path = self.path.with_suffix(".tmp")
+        with h5py.File(temporary_path, "w") as f:
+            f.attrs["chip_name"] = self.chip_name
+            f.create_dataset("scans/sidecar", data=np.array(sidecars, dtype="S"))
+            f.create_dataset("scans/data_file", data=np.array(data_files, dtype="S"))
+            f.create_dataset("scan_index", data=scan_index)
+            f.create_dataset("frame_index", data=frame_index)
+            if frame_shape is not None:
+                layout = h5py.VirtualLayout(
+                    shape=APERTURE_SHAPE + frame_shape, dtype=dtype
+                )
+                for i, (data_file, count) in enumerate(zip(data_files, frame_counts)):
+                    source = h5py.VirtualSource(
+                        data_file, DATA_PATH, shape=(count,) + frame_shape, dtype=dtype
+                    )
+                    ys, xs = np.nonzero(scan_index == i)
+                    for y in np.unique(ys):
+                        row_xs = xs[ys == y]
+                        for x, frame, length in frame_runs(row_xs, frame_index[y, row_xs]):
+                            layout[y, x : x + length] = source[frame : frame + length]
+                # Apertures without data read as zeros
+                f.create_virtual_dataset("data", layout, fillvalue=0)
+        temporary_path.replace(self.path)
+
+    def frame_format(self, data_files: List[str]):
+        """
+        Frame shape and type from the first data file already written, the
+        virtual dataset is left out until one exists
+        """
+        for data_file in data_files:
+            try:
+                with h5py.File(data_file, "r") as f:
+                    data = f[DATA_PATH]
+                    return tuple(data.shape[1:]), data.dtype
+            except (OSError, KeyError):
+                continue
+        return None, DEFAULT_DTYPE
@@ -18,6 +18,17 @@ from ophyd import Device, EpicsMotor
 from ophyd.signal import EpicsSignal, EpicsSignalRO
 from ophyd.status import SubscriptionStatus
 
+from model.chip import aperture_location, location_slices
+from server.chip_master import ChipMaster
+from server.prescreen import aperture_pixels, classify_filled, patch_scores
+from server.scan_sidecar import (
+    RASTER_COLUMNS,
+    aperture_segments,
+    build_sidecar,
+    segment_apertures,
+    serpentine_apertures,
+    sidecar_writer,
+)
 from server.devices import cam_7, cam_8, shutter_bcu, trans_bcu, trans_ri
 
 
@@ -26,7 +37,6 @@ zebra = Zebra("XF:17IDC-ES:FMX{Zeb:3}:", name="zebra")
 eiger_single = EigerSingleTriggerV26("XF:17IDC-ES:FMX{Det:Eig16M}", name="eiger_single")
 # TODO: uncomment for V33
 # eiger_single.cam.ensure_nonblocking()
-set_eiger_defaults(eiger_single)
 mx_flyer = MXFlyer(vector=vector, zebra=zebra, detector=eiger_single)
 
 
@@ -178,7 +188,14 @@ def configure_zebra_for_chip_scanner():
     time.sleep(0.5)
     epics.caput("XF:17IDC-ES:FMX{Zeb:3}:M1:SETPOS.PROC", 1)
 
-configure_zebra_for_chip_scanner()
+
+def configure_hardware():
+    """Sets up the Eiger and the Zebra for the chip scanner. Called by the
+    worker that runs the scans only, never on import: a standby worker
+    starting up would otherwise reset the Zebra encoder position under
+    a scan in progress."""
+    set_eiger_defaults(eiger_single)
+    configure_zebra_for_chip_scanner()
 
 class ppmac_input(Device):
     prog = Cpt(EpicsSignal, "Program")
@@ -209,6 +226,9 @@ ppmac_channel = ppmac_input("XF:17ID-CT:FMX{MC17:Sender}", name="ppmac_channel")
 
 class MotorWithEncoder(EpicsMotor):
     encoder_readback = Cpt(EpicsSignalRO, ".RRBV", kind="hinted", auto_monitor=True)
+    jog_forward = Cpt(EpicsSignal, ".JOGF", kind="omitted")
+    jog_reverse = Cpt(EpicsSignal, ".JOGR", kind="omitted")
+    jog_velocity = Cpt(EpicsSignal, ".JVEL", kind="config")
 
 
 def get_energy():
@@ -267,6 +287,18 @@ class ChipScanner(Device):
         self.hi_camera_ratios = (BL_calibration.HiMagCal.get(), BL_calibration.HiMagCal.get())
         
         self.filepath = None
+        # Name of the loaded chip, names the per chip master file
+        self.chip_name = "Chip01"
+        # Summary of every detector arm of the last collection, read by the
+        # worker to record the exposure. A collection resumed after a pause
+        # has one per arm
+        self.scans = []
+        # Start of every gated line of the current scan, for the sidecar
+        self.line_starts = []
+        # Lines of the multi-line collection in progress, see start_collection
+        self.collection = None
+        # Set by the worker when it resumes a paused plan
+        self.rearm_pending = False
         self.set_fiducials(None, None, None, None, None, None)
                 
     def manual_set_fiducial(self, location):
@@ -301,6 +333,24 @@ class ChipScanner(Device):
             self.z.get().user_readback + delta_z
         )
 
+    def start_jog(self, axis, direction, velocity):
+        """Starts a continuous move of one axis using the motor record
+        jog fields. Runs outside the RunEngine, the caller is responsible
+        for calling stop_jog."""
+        motor = getattr(self, axis)
+        motor.jog_velocity.put(abs(velocity))
+        if direction > 0:
+            motor.jog_reverse.put(0)
+            motor.jog_forward.put(1)
+        else:
+            motor.jog_forward.put(0)
+            motor.jog_reverse.put(1)
+
+    def stop_jog(self):
+        for motor in (self.x, self.y, self.z):
+            motor.jog_forward.put(0)
+            motor.jog_reverse.put(0)
+
     def drive_to_fiducial(self, location_name):
         approx_locations = {
             "F0": (-self.F1_x / 2, -self.F2_y / 2),
@@ -510,8 +560,59 @@ class ChipScanner(Device):
         dy_mot =  -MagCal * (center_y - roi_size/2)
         yield from bps.mvr(self.x, dx_mot, self.y, dy_mot)
         yield from bps.sleep(0.4)
-        
-        
+
+    def prescreen_block(self, neighbourhood, camera=None, ratio=1.5, empty_score=None, settle=0.3, patch_fraction=0.6):
+        """Images a block with the on axis camera at the precomputed aperture
+        positions and returns the raster indices of the apertures that
+        appear filled, see server.prescreen. Blocks larger than the field of
+        view are imaged in tiles.
+
+        Only valid for the Oxford Chip."""
+
+        camera = camera or self.lo_camera
+        if camera == cam_7:
+            zoom_roi = camera.roi3
+            MagCal = BL_calibration.LoMagCal.get()
+        else:
+            zoom_roi = camera.roi1
+            MagCal = BL_calibration.HiMagCal.get()
+        x_size = camera.image.dimensions.get()[1]
+        y_size = camera.image.dimensions.get()[2]
+        # The beam, and so the commanded aperture position, is at the zoom ROI center
+        center_pixel = (zoom_roi.min_xyz.min_x.get() + np.ceil(zoom_roi.size.x.get()/2),
+                        zoom_roi.min_xyz.min_y.get() + np.ceil(zoom_roi.size.y.get()/2))
+
+        a0 = self.fiducial_distances_to_location(*self.name_to_fiducial_distances(f'{neighbourhood}aa'))
+        ax = self.fiducial_distances_to_location(*self.name_to_fiducial_distances('A1ab'))
+        ay = self.fiducial_distances_to_location(*self.name_to_fiducial_distances('A1ba'))
+        a00 = self.fiducial_distances_to_location(*self.name_to_fiducial_distances('A1aa'))
+        x_step, y_step = ax - a00, ay - a00
+        rows, cols = np.mgrid[0:self.APnum_y, 0:self.APnum_x]
+        positions = a0 + cols.reshape(-1, 1)*x_step + rows.reshape(-1, 1)*y_step
+        half_size = int(patch_fraction * np.linalg.norm(x_step[:2]) / MagCal / 2)
+
+        # Tiles along each axis so that every patch lands inside the image
+        extent = np.ptp(positions[:, :2], axis=0) / MagCal + 2*half_size
+        tiles = np.maximum(1, np.ceil(extent / (0.9*np.array([x_size, y_size])))).astype(int)
+        tile = (rows.ravel()*tiles[1]//self.APnum_y)*tiles[0] + cols.ravel()*tiles[0]//self.APnum_x
+        scores = np.full(len(positions), np.nan)
+        for t in np.unique(tile):
+            in_tile = tile == t
+            center = positions[in_tile].mean(axis=0)
+            yield from bps.mv(self.x, center[0], self.y, center[1], self.z, center[2])
+            yield from bps.sleep(settle)
+            image = np.asarray(camera.image.array_data.get(), dtype=np.float32)
+            # Color cameras deliver interleaved channels
+            image = image.reshape(y_size, x_size, -1).mean(axis=2)
+            pixels = aperture_pixels(positions[in_tile], center, center_pixel, MagCal)
+            scores[in_tile] = patch_scores(image, pixels, half_size)
+        filled = classify_filled(scores, ratio, empty_score)
+
+        block_rows, block_cols = location_slices(neighbourhood)
+        indices = (rows + block_rows.start)*RASTER_COLUMNS + cols + block_cols.start
+        print(f"Pre-screen {neighbourhood}: {filled.sum()} of {filled.size} apertures filled")
+        return indices.ravel()[filled]
+
     def name_to_fiducial_distances(self, location_name):
         """Given a location name of the form @#&& where @ is a capital
         letter from A-H, # is a number from 1-8 and &s are lower case 
@@ -566,6 +667,38 @@ class ChipScanner(Device):
         motor_coords = np.matmul(M, relative_loc) + self.F0_enc
         return(motor_coords)
     
+    def location_to_fiducial_distances(self, motor_coords):
+        """Inverse of fiducial_distances_to_location, given x, y and z motor
+        coordinates returns the distances to the fiducial from the starting
+        point F0=(0,0). Positions off the chip plane are projected onto it.
+        
+        Only valid for the Oxford Chip."""
+        
+        M = np.array([self.F1-self.F0, self.F2-self.F0]).transpose()
+        relative_loc = np.linalg.lstsq(M, np.asarray(motor_coords) - self.F0, rcond=None)[0]
+        return relative_loc[0]*self.F1_x, relative_loc[1]*self.F2_y
+    
+    def fiducial_distances_to_name(self, x_loc, y_loc):
+        """Inverse of name_to_fiducial_distances, returns the name of the
+        house within half an aperture gap of the given distances, or None
+        when they fall between blocks or off the chip.
+        
+        Only valid for the Oxford Chip."""
+        
+        block_x = self.BLgap_x + (self.APnum_x-1)*self.APgap_x
+        block_y = self.BLgap_y + (self.APnum_y-1)*self.APgap_y
+        dx = x_loc - self.F0_x
+        dy = y_loc - self.F0_y
+        # Block boundaries are taken halfway across the gap between blocks
+        Nx = int(np.floor((dx + self.BLgap_x/2)/block_x))
+        Ny = int(np.floor((dy + self.BLgap_y/2)/block_y))
+        Hx = int(np.round((dx - Nx*block_x)/self.APgap_x))
+        Hy = int(np.round((dy - Ny*block_y)/self.APgap_y))
+        if not (0 <= Nx < self.BLnum_x and 0 <= Ny < self.BLnum_y and
+                0 <= Hx < self.APnum_x and 0 <= Hy < self.APnum_y):
+            return None
+        return f"{chr(65+Ny)}{Nx+1}{chr(97+Hy)}{chr(97+Hx)}"
+    
     def drive_to_location(self, location_name):
         chip_x, chip_y = self.name_to_fiducial_distances(location_name)
         motor_loc = self.fiducial_distances_to_location(chip_x, chip_y)
@@ -612,7 +745,7 @@ class ChipScanner(Device):
         status = SubscriptionStatus(zebra.pc.arm.output, check_armed)
         zebra.pc.arm_signal.put(1)
         try:
-            status.wait(10)
+            yield from self.wait_status(status, 10)
         except TimeoutError as e:
             print("Failed to arm zebra within 10s, aborting.")
             return()
@@ -621,11 +754,156 @@ class ChipScanner(Device):
             return(old_value == 1 and value == 0)
         shutter_bcu.open.put(1)
         yield from bps.sleep(0.08)
+        self.line_starts.append({
+            "time": time.time(),
+            "position": location_start,
+            "encoder": location_start_enc,
+            "position_step": step_vector,
+            "encoder_step": step_vector_enc,
+        })
         ppmac_channel.run_program(23)
         status = SubscriptionStatus(zebra.pc.arm.output, check_done)
         return status
 
+    def wait_status(self, status, timeout):
+        """Waits for an ophyd status by sleeping through the RunEngine
+        instead of blocking it, so that a pause or abort is seen within
+        the poll time rather than when the line ends."""
+        deadline = time.monotonic() + timeout
+        while not status.done:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{status} not done within {timeout} s")
+            yield from bps.sleep(0.05)
+        if not status.success:
+            raise RuntimeError(f"{status} failed")
+
+    def emergency_stop(self, ppmac_abort_pv = None):
+        """Stops everything a scan drives, straight from the calling thread
+        and without the RunEngine: closes the shutter, disarms the Zebra
+        position compare, aborts the PPMAC program when an abort PV is
+        given, stops the chip motors and the Eiger acquisition. Every step
+        is tried even when one fails. Returns the milliseconds each step
+        took to be sent, an error message instead when it failed or was
+        skipped."""
+        steps = [
+            ("shutter", lambda: shutter_bcu.close.put(1)),
+            ("zebra", lambda: zebra.pc.disarm.put(1)),
+        ]
+        if ppmac_abort_pv:
+            steps.append(("ppmac", lambda: epics.caput(ppmac_abort_pv, 1, wait=False)))
+        steps += [
+            ("motors", lambda: [motor.motor_stop.put(1) for motor in (self.x, self.y, self.z)]),
+            ("jog", self.stop_jog),
+            ("eiger", lambda: eiger_single.cam.acquire.put(0)),
+        ]
+        timings = {}
+        if not ppmac_abort_pv:
+            timings["ppmac"] = "skipped, no abort PV configured"
+        for name, step in steps:
+            started = time.monotonic()
+            try:
+                step()
+                timings[name] = (time.monotonic() - started) * 1000
+            except Exception as e:
+                timings[name] = f"failed: {e}"
+        return timings
+
+    def record_scan(self, location, scan_type, wait_time, transmission, frames_per_line=20, apertures=None, partial=False):
+        data_file = f"{eiger_single.cam.file_path.get()}{eiger_single.cam.fw_name_pattern.get()}"
+        sidecar_path = Path(eiger_single.cam.file_path.get()) / f"{eiger_single.cam.fw_name_pattern.get()}_chipsight.h5"
+        beamline = {
+            "transmission": transmission,
+            "energy_ev": get_energy(),
+            "detector_distance": getDetectorDist(configStr = 'Chip_Scanner'),
+            "data_file": data_file,
+            "partial": partial,
+        }
+        for name in ("F0", "F1", "F2", "F0_enc", "F1_enc", "F2_enc"):
+            beamline[f"fiducial_{name}"] = np.asarray(getattr(self, name), dtype=float)
+        # The chip master file is updated once the sidecar is on disk
+        chip_master = ChipMaster(sidecar_path.parent / f"{self.chip_name}_chip.h5", self.chip_name)
+        sidecar_writer.submit(
+            sidecar_path,
+            build_sidecar(location, scan_type, wait_time, self.line_starts, frames_per_line, beamline, apertures),
+            then=chip_master.add_scan,
+        )
+        self.scans.append({
+            "location": location,
+            "type": scan_type,
+            "timestamp": time.time(),
+            "dwell": wait_time,
+            "transmission": transmission,
+            "data_file": data_file,
+            "sidecar": str(sidecar_path),
+            "apertures": None if apertures is None else [int(index) for index in apertures],
+            "partial": partial,
+        })
+
+    def start_collection(self, location, scan_type, wait_time, order, frames_per_line):
+        """Arms the detector for a scan of several gated lines, order gives
+        the aperture of every frame and frames_per_line the frames of each
+        line. Lines are the unit of pause and resume, see line_checkpoint."""
+        self.scans = []
+        self.line_starts = []
+        self.rearm_pending = False
+        self.collection = {
+            "location": location,
+            "scan_type": scan_type,
+            "wait_time": wait_time,
+            "order": np.asarray(order),
+            "frames_per_line": list(frames_per_line),
+            "lines_done": 0,
+            "part_line": 0,
+        }
+        self.configure_detector(location, len(order))
+
+    def line_checkpoint(self):
+        """Checkpoint before each line. A deferred pause stops the plan here,
+        between lines, so nothing has to be rewound. When the plan resumes,
+        the lines collected so far are recorded as a scan of their own and
+        the detector is re-armed for the frames left, so a pause never
+        costs recollecting the lines already exposed."""
+        yield from bps.checkpoint()
+        if self.rearm_pending:
+            self.rearm_pending = False
+            eiger_single.cam.acquire.put(0)
+            self.record_part()
+            c = self.collection
+            done = sum(c["frames_per_line"][:c["lines_done"]])
+            remaining = c["order"][done:]
+            # Named after the first aperture left, the data file does not
+            # start at the beginning of the location
+            self.configure_detector(aperture_location(int(remaining[0])), len(remaining))
+            govStateSet('CD', configStr = 'Chip_Scanner')
+            print(f"Resuming {c['location']} at line {c['lines_done']}, {len(remaining)} frames left")
+
+    def line_done(self):
+        self.collection["lines_done"] += 1
+
+    def record_part(self, transmission = None, aborted = False):
+        """Records the lines collected since the detector was last armed.
+        When the scan was aborted, a line whose shutter had opened counts as
+        exposed and the scan is marked partial, its data stops short."""
+        c = self.collection
+        if c is None:
+            return
+        partial = aborted and len(self.line_starts) > c["lines_done"] - c["part_line"]
+        if partial:
+            self.line_done()
+        lines = c["frames_per_line"][c["part_line"]:c["lines_done"]]
+        if not lines:
+            return
+        first = sum(c["frames_per_line"][:c["part_line"]])
+        if transmission is None:
+            transmission = trans_bcu.transmission.get()*trans_ri.transmission.get()
+        self.record_scan(c["location"], c["scan_type"], c["wait_time"], transmission, lines, c["order"][first:first + sum(lines)], partial)
+        c["part_line"] = c["lines_done"]
+        self.line_starts = []
+
     def ppmac_single_line_scan(self, line, wait_time, zebra_offset = 0.01, location_offset_x = 0.0, location_offset_y = 0.0, refocus = False, recenter = True):
+        self.scans = []
+        self.collection = None
+        self.line_starts = []
         pattern = re.compile("^([A-H][1-8][a-t])$")
         if not pattern.match(line):
             print(f"Line scan requires input of form ex. A1a, got {line}.")
@@ -651,7 +929,7 @@ class ChipScanner(Device):
         govStateSet('CD', configStr = 'Chip_Scanner')
         status = yield from self.ppmac_linear_scan(loc, enc_loc, x_step, x_step_enc, wait_time, 20, start_offset = zebra_offset + location_offset_x, location_offset_x = location_offset_x, location_offset_y = location_offset_y)
         between_time = wait_time * 20 + 400
-        status.wait(between_time/1000. + 20)
+        yield from self.wait_status(status, between_time/1000. + 20)
         shutter_bcu.close.put(1)
         eiger_single.cam.acquire.put(0)
         govStateSet('CA', configStr = 'Chip_Scanner')
@@ -663,8 +941,12 @@ class ChipScanner(Device):
         print(f"Energy = {get_energy()}")
         print(f"Detector distance = {getDetectorDist(configStr = 'Chip_Scanner')}")
         print(f"Data location = {eiger_single.cam.file_path.get()}{eiger_single.cam.fw_name_pattern.get()}")
+        self.record_scan(line, "line", wait_time, transmission)
         
     def ppmac_neighbourhood_scan(self, neighbourhood, wait_time, zebra_offset = 0.01, location_offset_x = 0.0, location_offset_y = 0.0, refocus = False, recenter = True):
+        self.scans = []
+        self.collection = None
+        self.line_starts = []
         pattern = re.compile("^([A-H][1-8])$")
         if not pattern.match(neighbourhood):
             print(f"Neighbourhood scan requires input of form ex. A1, got {neighbourhood}.")
@@ -672,7 +954,7 @@ class ChipScanner(Device):
         if zebra.pc.gate.sel.get():
             print("Zebra appears to be configured for gonio1, run configure_zebra_for_chip_scanner() and retry.")
             return(False)
-        self.configure_detector(neighbourhood, 400)
+        self.start_collection(neighbourhood, "neighbourhood", wait_time, serpentine_apertures(neighbourhood), [20]*20)
         a0 = self.name_to_fiducial_distances('A1aa')
         ax = self.name_to_fiducial_distances('A1ab')
         ay = self.name_to_fiducial_distances('A1ba')
@@ -689,20 +971,25 @@ class ChipScanner(Device):
         enc_loc = np.array([self.x.get().encoder_readback, self.y.get().encoder_readback, self.z.get().encoder_readback])
         between_time = wait_time * 20 + 400
         govStateSet('CD', configStr = 'Chip_Scanner')
-        for i in range(10):
-            # Snake scan, initial going right
-            start_loc = loc + 2*i*y_step
-            start_enc_loc = enc_loc + 2*i*y_step_enc
-            status = yield from self.ppmac_linear_scan(start_loc, start_enc_loc, x_step, x_step_enc, wait_time, 20, start_offset = zebra_offset + location_offset_x, location_offset_x = location_offset_x, location_offset_y = location_offset_y) # 20 to push the chip off the sample at the end
-            status.wait(between_time/1000. + 20)
-            shutter_bcu.close.put(1)
-            
-            # Going back left
-            start_loc = start_loc + y_step + 19*x_step
-            start_enc_loc = start_enc_loc + y_step_enc + 19*x_step_enc
-            status = yield from self.ppmac_linear_scan(start_loc, start_enc_loc, -x_step, -x_step_enc, wait_time, 20, start_offset = zebra_offset + location_offset_x, location_offset_x = location_offset_x, location_offset_y = location_offset_y)
-            status.wait(between_time/1000. + 20)
-            shutter_bcu.close.put(1)
+        try:
+            for i in range(20):
+                yield from self.line_checkpoint()
+                # Snake scan, even lines going right, odd lines back left
+                start_loc = loc + i*y_step
+                start_enc_loc = enc_loc + i*y_step_enc
+                step, step_enc = x_step, x_step_enc
+                if i % 2:
+                    start_loc = start_loc + 19*x_step
+                    start_enc_loc = start_enc_loc + 19*x_step_enc
+                    step, step_enc = -x_step, -x_step_enc
+                status = yield from self.ppmac_linear_scan(start_loc, start_enc_loc, step, step_enc, wait_time, 20, start_offset = zebra_offset + location_offset_x, location_offset_x = location_offset_x, location_offset_y = location_offset_y) # 20 to push the chip off the sample at the end
+                yield from self.wait_status(status, between_time/1000. + 20)
+                shutter_bcu.close.put(1)
+                self.line_done()
+        except BaseException:
+            # Aborted, the lines already exposed are still recorded
+            self.record_part(aborted=True)
+            raise
 
         eiger_single.cam.acquire.put(0)
         govStateSet('CA', configStr = 'Chip_Scanner')
@@ -713,7 +1000,75 @@ class ChipScanner(Device):
         print(f"Location = {neighbourhood}")
         print(f"Energy = {get_energy()}")
         print(f"Detector distance = {getDetectorDist(configStr = 'Chip_Scanner')}")
-        print(f"Data location = {eiger_single.cam.file_path.get()}{eiger_single.cam.fw_name_pattern.get()}")    
+        print(f"Data location = {eiger_single.cam.file_path.get()}{eiger_single.cam.fw_name_pattern.get()}")
+        self.record_part(transmission)
+
+    def ppmac_aperture_scan(self, apertures, wait_time, zebra_offset = 0.01, location_offset_x = 0.0, location_offset_y = 0.0, refocus = False, recenter = True):
+        """Collects a set of apertures, given as raster indices, with a
+        single detector arm. Neighbouring apertures in a row of a block are
+        gated line segments, visited in the order of aperture_segments, so
+        the scan time grows with the number of apertures and segments
+        rather than the blocks they sit in.
+
+        Only valid for the Oxford Chip."""
+        self.scans = []
+        self.collection = None
+        self.line_starts = []
+        segments = aperture_segments(apertures)
+        if not segments:
+            print("Aperture scan requires at least one aperture.")
+            return(False)
+        if zebra.pc.gate.sel.get():
+            print("Zebra appears to be configured for gonio1, run configure_zebra_for_chip_scanner() and retry.")
+            return(False)
+        order = segment_apertures(segments)
+        # Scans are named after their first aperture
+        location = aperture_location(int(order[0]))
+        self.start_collection(location, "apertures", wait_time, order, [length for _, _, length, _ in segments])
+        a0 = self.name_to_fiducial_distances('A1aa')
+        ax = self.name_to_fiducial_distances('A1ab')
+        x_step = self.fiducial_distances_to_location(*ax) - self.fiducial_distances_to_location(*a0)
+        x_step_enc = self.fiducial_distances_to_enc_location(*ax) - self.fiducial_distances_to_enc_location(*a0)
+        yield from self.drive_to_location(location)
+        if recenter:
+            yield from self.center_on_point()
+        if refocus:
+            yield from autofocus(self.hi_camera, 'stats4_sigma_x', self.z, -10,10,15)
+        # Centering on the first aperture corrects the whole path
+        loc = np.array([self.x.get().user_readback, self.y.get().user_readback, self.z.get().user_readback])
+        enc_loc = np.array([self.x.get().encoder_readback, self.y.get().encoder_readback, self.z.get().encoder_readback])
+        offset = loc - self.fiducial_distances_to_location(*self.name_to_fiducial_distances(location))
+        enc_offset = enc_loc - self.fiducial_distances_to_enc_location(*self.name_to_fiducial_distances(location))
+        govStateSet('CD', configStr = 'Chip_Scanner')
+        try:
+            for y, x, length, reverse in segments:
+                yield from self.line_checkpoint()
+                first = aperture_location(y*RASTER_COLUMNS + (x + length - 1 if reverse else x))
+                distances = self.name_to_fiducial_distances(first)
+                start_loc = self.fiducial_distances_to_location(*distances) + offset
+                start_enc_loc = self.fiducial_distances_to_enc_location(*distances) + enc_offset
+                step = -x_step if reverse else x_step
+                step_enc = -x_step_enc if reverse else x_step_enc
+                status = yield from self.ppmac_linear_scan(start_loc, start_enc_loc, step, step_enc, wait_time, length, start_offset = zebra_offset + location_offset_x, location_offset_x = location_offset_x, location_offset_y = location_offset_y)
+                yield from self.wait_status(status, (wait_time * length + 400)/1000. + 20)
+                shutter_bcu.close.put(1)
+                self.line_done()
+        except BaseException:
+            # Aborted, the segments already exposed are still recorded
+            self.record_part(aborted=True)
+            raise
+
+        eiger_single.cam.acquire.put(0)
+        govStateSet('CA', configStr = 'Chip_Scanner')
+        transmission = trans_bcu.transmission.get()*trans_ri.transmission.get()
+        print(f"Transmission = {transmission}")
+        print(f"Time = {datetime.datetime.now()}")
+        print(f"Type = Aperture Scan")
+        print(f"Apertures = {len(order)} in {len(segments)} segments from {location}")
+        print(f"Energy = {get_energy()}")
+        print(f"Detector distance = {getDetectorDist(configStr = 'Chip_Scanner')}")
+        print(f"Data location = {eiger_single.cam.file_path.get()}{eiger_single.cam.fw_name_pattern.get()}")
+        self.record_part(transmission)
 
     def linear_scan_with_triggering(self, location_start, location_end, wait_time):
         Ny = ord(location_start[0])-65
@@ -7,6 +7,7 @@ import yaml
 from fastapi import HTTPException, Request
 from fastapi.templating import Jinja2Templates
 
+from server.camera_relay import CameraRelays
 from server.manager import ConnectionManager
 from server.message_manager import ChipScannerMessageManager
 
@@ -24,16 +25,17 @@ if prop_config_file.exists():
     
 
 if not config.get("test", False):
-    from server import bluesky_env
+    from server.worker_process import start_worker
 else:
-    bluesky_env = Mock()
-    bluesky_env.RE.state = "idle"
-
-# bluesky_env.chip_scanner.filepath = proposal_config["path"]
+    start_worker = Mock()
 
 conn_manager = ConnectionManager()
 csm_manager = ChipScannerMessageManager(
-    connection_manager=conn_manager, bluesky_env=bluesky_env, config=config, proposal_config=proposal_config
+    connection_manager=conn_manager, start_worker=start_worker, config=config, proposal_config=proposal_config
+)
+camera_relays = CameraRelays(
+    config.get("camera_relay", {}).get("urls", []),
+    idle_timeout=config.get("camera_relay", {}).get("idle_timeout", 10.0),
 )
 secrets = json.load(open("secrets.json", "r"))
 
@@ -43,7 +45,7 @@ templates = Jinja2Templates(directory="server/templates")
 def set_proposal_config(new_path: Path, proposal_id, date, pi):
     print(f"{ proposal_config= }")
     proposal_config['path'] = str(new_path)
-    bluesky_env.chip_scanner.filepath = str(new_path)
+    csm_manager.set_filepath(new_path)
 
     proposal_config['proposal_id'] = proposal_id
     proposal_config["date"] = date
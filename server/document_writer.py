@@ -0,0 +1,210 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from event_model import pack_event_page
+
+Document = Tuple[str, Dict[str, Any], float]
+
+
+class BatchedDocumentWriter:
+    """
+    RunEngine subscriber that hands documents to a background thread, which
+    inserts them into the document store in batches. Runs of events from
+    one descriptor are inserted as one event page. A run is written out as
+    soon as its stop document arrives, and close() writes everything left.
+    A document that cannot be inserted does not hold up the rest of its
+    batch, it is tried once more with the next batch and then given up on.
+
+    The queue is bounded: when the store falls max_queue documents behind
+    the RunEngine waits for room rather than holding an unbounded backlog.
+    Insert latency is reported at the end of each run.
+    """
+
+    def __init__(
+        self,
+        insert: Callable[[str, Dict[str, Any]], Any],
+        max_queue=10000,
+        batch_size=500,
+        flush_interval=0.5,
+        retries=3,
+        pack_events=True,
+    ):
+        self.insert = insert
+        self.queue: "queue.Queue[Optional[Document]]" = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.pack_events = pack_events
+        self.thread: Optional[threading.Thread] = None
+        # Documents the last batch could not insert
+        self.failed: List[Document] = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.documents = 0
+        self.inserts = 0
+        self.insert_time = 0.0
+        self.max_insert_time = 0.0
+        self.max_latency = 0.0
+        self.blocked_time = 0.0
+        self.blocked = 0
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.run, name="document-writer", daemon=True
+            )
+            self.thread.start()
+
+    def __call__(self, name: str, doc: Dict[str, Any]):
+        self.start()
+        item = (name, doc, time.monotonic())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not self.blocked:
+                print(f"Document queue full ({self.queue.maxsize}), waiting for the store")
+            started = time.monotonic()
+            self.queue.put(item)
+            self.blocked += 1
+            self.blocked_time += time.monotonic() - started
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch: List[Document] = []
+            closing = item is None
+            if not closing:
+                batch.append(item)
+                closing = self.fill_batch(batch)
+            received = len(batch)
+            retried, self.failed = self.failed, []
+            try:
+                # Documents that failed with the last batch go first, in order
+                failed = self.write(retried + batch)
+                retried_ids = {id(doc) for _, doc, _ in retried}
+                for item in failed:
+                    name, doc, _ = item
+                    if id(doc) in retried_ids:
+                        print(f"Gave up on inserting {name} document {doc.get('uid', '')}")
+                    else:
+                        self.failed.append(item)
+            except Exception as e:
+                print(f"Document writer failed: {e}")
+            finally:
+                for _ in range(received + closing):
+                    self.queue.task_done()
+            if closing:
+                if self.failed:
+                    print(f"Document writer closed with {len(self.failed)} documents not inserted")
+                return
+
+    def fill_batch(self, batch: List[Document]) -> bool:
+        """
+        Collects documents until the batch is full, the flush interval has
+        passed or a run stops. Returns True when the writer is closing
+        """
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1][0] != "stop":
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    def write(self, batch: List[Document]) -> List[Document]:
+        """
+        Inserts a batch, returns the documents that could not be inserted
+        """
+        failed: List[Document] = []
+        i = 0
+        while i < len(batch):
+            name, doc, queued = batch[i]
+            if name == "event" and self.pack_events:
+                # Consecutive events of the same descriptor form one page
+                j = i + 1
+                while (
+                    j < len(batch)
+                    and batch[j][0] == "event"
+                    and batch[j][1]["descriptor"] == doc["descriptor"]
+                ):
+                    j += 1
+                if j - i > 1:
+                    events = [event for _, event, _ in batch[i:j]]
+                    if self.insert_one("event_page", pack_event_page(*events), j - i):
+                        self.record_latency(batch[i:j])
+                        i = j
+                        continue
+                    if self.pack_events:
+                        failed.extend(batch[i:j])
+                        i = j
+                        continue
+                    # The store does not take pages, insert the events one by one
+            if self.insert_one(name, doc, 1):
+                self.record_latency(batch[i : i + 1])
+            else:
+                failed.append(batch[i])
+            if name == "stop":
+                self.report(doc)
+            i += 1
+        return failed
+
+    def insert_one(self, name: str, doc: Dict[str, Any], count: int) -> bool:
+        for attempt in range(self.retries):
+            started = time.monotonic()
+            try:
+                self.insert(name, doc)
+            except Exception as e:
+                if name == "event_page" and attempt == 0 and self.is_unsupported(e):
+                    print(f"Document store does not take event pages: {e}")
+                    self.pack_events = False
+                    return False
+                print(f"Failed to insert {name} document (attempt {attempt + 1}): {e}")
+                time.sleep(min(2**attempt, 5))
+                continue
+            elapsed = time.monotonic() - started
+            self.inserts += 1
+            self.documents += count
+            self.insert_time += elapsed
+            self.max_insert_time = max(self.max_insert_time, elapsed)
+            return True
+        return False
+
+    @staticmethod
+    def is_unsupported(error: Exception) -> bool:
+        return isinstance(error, (KeyError, NotImplementedError, AttributeError))
+
+    def record_latency(self, items: List[Document]):
+        now = time.monotonic()
+        self.max_latency = max(self.max_latency, now - min(queued for _, _, queued in items))
+
+    def report(self, stop: Dict[str, Any]):
+        mean = self.insert_time / self.inserts * 1000 if self.inserts else 0.0
+        print(
+            f"Run {stop.get('run_start', '')[:8]} stored: {self.documents} documents "
+            f"in {self.inserts} inserts, insert mean {mean:.1f} ms "
+            f"max {self.max_insert_time * 1000:.1f} ms, "
+            f"queue latency max {self.max_latency * 1000:.1f} ms, "
+            f"RunEngine waited {self.blocked_time:.3f} s on {self.blocked} documents"
+        )
+        self.reset_stats()
+
+    def flush(self):
+        """
+        Blocks until every queued document is written
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,187 @@
+import base64
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from model.chip import aperture_location, aperture_position, location_slices
+
+APERTURE_SHAPE = (160, 160)
+
+
+class ExposureLedger:
+    """
+    Per aperture record of what has been collected on one chip.
+
+    The state lives in packed arrays on the chip raster (exposed, timestamp,
+    dwell, transmission, partial and an index into the list of data files),
+    saved as <chip name>.npz. Every scan is first appended to
+    <chip name>.jsonl and flushed to disk, so a crash loses nothing, the log
+    is folded into the arrays by compact once it grows past compact_every
+    records.
+    """
+
+    def __init__(self, directory: Path, chip_name: str, compact_every=64):
+        self.directory = Path(directory)
+        self.chip_name = chip_name
+        self.compact_every = compact_every
+        self.array_path = self.directory / f"{chip_name}.npz"
+        self.log_path = self.directory / f"{chip_name}.jsonl"
+        self.exposed = np.zeros(APERTURE_SHAPE, dtype=bool)
+        self.timestamp = np.zeros(APERTURE_SHAPE, dtype=np.float64)
+        self.dwell = np.zeros(APERTURE_SHAPE, dtype=np.float32)
+        self.transmission = np.zeros(APERTURE_SHAPE, dtype=np.float32)
+        self.file_index = np.full(APERTURE_SHAPE, -1, dtype=np.int32)
+        # Exposed by a scan that was stopped, its data file stops short
+        self.partial = np.zeros(APERTURE_SHAPE, dtype=bool)
+        self.files: List[str] = []
+        self.log_records = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if self.array_path.exists():
+            with np.load(self.array_path) as arrays:
+                self.exposed = arrays["exposed"]
+                self.timestamp = arrays["timestamp"]
+                self.dwell = arrays["dwell"]
+                self.transmission = arrays["transmission"]
+                self.file_index = arrays["file_index"]
+                if "partial" in arrays.files:
+                    self.partial = arrays["partial"]
+                self.files = [str(name) for name in arrays["files"]]
+        if self.log_path.exists():
+            with self.log_path.open() as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A write cut short by a crash, the scan was not
+                        # acknowledged so it is collected again
+                        print(f"Skipping incomplete ledger record in {self.log_path}")
+                        continue
+                    self.apply(record)
+                    self.log_records += 1
+
+    def apply(self, record: Dict[str, Any]):
+        apertures = self.record_apertures(record)
+        if record["data_file"] not in self.files:
+            self.files.append(record["data_file"])
+        self.exposed.flat[apertures] = True
+        self.timestamp.flat[apertures] = record["timestamp"]
+        self.dwell.flat[apertures] = record["dwell"]
+        self.transmission.flat[apertures] = record["transmission"]
+        self.file_index.flat[apertures] = self.files.index(record["data_file"])
+        self.partial.flat[apertures] = record.get("partial", False)
+
+    @staticmethod
+    def record_apertures(record: Dict[str, Any]) -> np.ndarray:
+        """
+        Raster indices of the apertures of a record, listed for aperture
+        scans and taken from the block, row or aperture location otherwise
+        """
+        if record.get("apertures") is not None:
+            return np.asarray(record["apertures"], dtype=np.int64)
+        mask = np.zeros(APERTURE_SHAPE, dtype=bool)
+        mask[location_slices(record["location"])] = True
+        return np.flatnonzero(mask)
+
+    def record(
+        self,
+        location: str,
+        dwell: float,
+        transmission: float,
+        data_file: str,
+        timestamp: Optional[float] = None,
+        apertures: Optional[List[int]] = None,
+        partial: bool = False,
+    ) -> np.ndarray:
+        """
+        Records a completed scan of a block, row or aperture, or of the
+        listed apertures, and returns the raster indices of the apertures
+        it exposed. A partial scan was stopped during its last line, whose
+        apertures were exposed but have incomplete data
+        """
+        record = {
+            "location": location,
+            "timestamp": timestamp if timestamp is not None else time.time(),
+            "dwell": dwell,
+            "transmission": transmission,
+            "data_file": data_file,
+        }
+        if apertures is not None:
+            record["apertures"] = [int(index) for index in apertures]
+        if partial:
+            record["partial"] = True
+        with self.log_path.open("a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.apply(record)
+        self.log_records += 1
+        if self.log_records >= self.compact_every:
+            self.compact()
+        return np.unique(self.record_apertures(record))
+
+    def compact(self):
+        """
+        Saves the arrays and truncates the log, the arrays are written to a
+        temporary file first so that a crash leaves the old ones intact
+        """
+        temporary_path = self.array_path.with_suffix(".tmp.npz")
+        np.savez_compressed(
+            temporary_path,
+            exposed=self.exposed,
+            timestamp=self.timestamp,
+            dwell=self.dwell,
+            transmission=self.transmission,
+            file_index=self.file_index,
+            partial=self.partial,
+            files=np.array(self.files, dtype=str),
+        )
+        os.replace(temporary_path, self.array_path)
+        self.log_path.unlink(missing_ok=True)
+        self.log_records = 0
+
+    def close(self):
+        if self.log_records:
+            self.compact()
+
+    def exposed_mask(self) -> str:
+        """
+        Exposed apertures in the bitmask encoding of
+        model.comm_protocol.pack_indices
+        """
+        bits = np.packbits(self.exposed.ravel(), bitorder="little")
+        return base64.b64encode(bits.tobytes()).decode("ascii")
+
+    def is_exposed(self, location: str) -> bool:
+        """
+        Whether every aperture of a block, row or aperture is exposed
+        """
+        return bool(self.exposed[location_slices(location)].all())
+
+    def query(self, first: str, last: str) -> List[Dict[str, Any]]:
+        """
+        Records of the exposed apertures in the rectangle of the chip raster
+        spanned by two aperture addresses, for example "A1aa" to "B2tt"
+        """
+        (y0, x0), (y1, x1) = aperture_position(first), aperture_position(last)
+        rows = slice(min(y0, y1), max(y0, y1) + 1)
+        cols = slice(min(x0, x1), max(x0, x1) + 1)
+        window = np.zeros(APERTURE_SHAPE, dtype=bool)
+        window[rows, cols] = True
+        return [
+            {
+                "location": aperture_location(int(index)),
+                "timestamp": float(self.timestamp.flat[index]),
+                "dwell": float(self.dwell.flat[index]),
+                "transmission": float(self.transmission.flat[index]),
+                "data_file": self.files[self.file_index.flat[index]],
+                "partial": bool(self.partial.flat[index]),
+            }
+            for index in np.flatnonzero(window & self.exposed)
+        ]
@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin  # noqa: F401, registers the bitshuffle filter of Eiger data
+except ImportError:
+    hdf5plugin = None
+
+from server.chip_master import DATA_FILE_SUFFIX, DATA_PATH
+from server.scan_sidecar import (
+    build_sidecar,
+    read_aperture_index,
+    serpentine_apertures,
+    write_sidecar,
+)
+
+SIDECAR_SUFFIX = "_chipsight.h5"
+# configure_detector names every scan CHIP<location><time>
+SCAN_NAME_PATTERN = re.compile(r"^CHIP([A-H][1-8][a-t]?)\d")
+
+
+def find_spots(
+    frame: np.ndarray, sigma=6.0, binning=1, min_counts=10.0
+) -> Tuple[int, float]:
+    """
+    Spot count and total intensity of one frame. Pixels at the maximum value
+    of an integer type are module gaps or bad pixels on the Eiger and are
+    masked. After summing binning x binning pixel blocks, a spot is a local
+    maximum whose 3 x 3 neighbourhood sum is more than sigma standard
+    deviations, and at least min_counts, above the mean neighbourhood sum
+    """
+    if np.issubdtype(frame.dtype, np.integer):
+        valid = frame != np.iinfo(frame.dtype).max
+    else:
+        valid = np.isfinite(frame)
+    image = np.where(valid, frame, 0).astype(np.float32)
+    if binning > 1:
+        height = image.shape[0] // binning * binning
+        width = image.shape[1] // binning * binning
+        shape = (height // binning, binning, width // binning, binning)
+        image = image[:height, :width].reshape(shape).sum(axis=(1, 3))
+        valid = valid[:height, :width].reshape(shape).all(axis=(1, 3))
+    height, width = image.shape
+    # Neighbourhood sums of the interior pixels, a single noisy pixel on a
+    # Poisson background does not reach the threshold on its own
+    box = sum(
+        image[dy : height - 2 + dy, dx : width - 2 + dx]
+        for dy in range(3)
+        for dx in range(3)
+    )
+    inner = valid[1:-1, 1:-1]
+    count = max(int(inner.sum()), 1)
+    mean = float(box[inner].sum()) / count
+    std = np.sqrt(max(float((box[inner] ** 2).sum()) / count - mean * mean, 0.0))
+    # The Poisson tail is long at low background, the floor keeps a few
+    # stray photons from counting as a spot
+    peaks = inner & (box > mean + max(sigma * std, min_counts))
+    core = image[1:-1, 1:-1]
+    for dy in range(3):
+        for dx in range(3):
+            if (dy, dx) == (1, 1):
+                continue
+            neighbour = image[dy : height - 2 + dy, dx : width - 2 + dx]
+            # Ties go to the first pixel in raster order
+            peaks &= core > neighbour if (dy, dx) > (1, 1) else core >= neighbour
+    return int(peaks.sum()), float(image.sum())
+
+
+def analyse_frames(
+    data_file: str, start: int, stop: int, sigma=6.0, binning=1, min_counts=10.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spot counts and intensities of frames start to stop of a data file, run
+    in the pool. Each worker reads its own frames, only the results travel
+    back to the server
+    """
+    spots = np.zeros(stop - start, dtype=np.int32)
+    intensity = np.zeros(stop - start, dtype=np.float64)
+    with h5py.File(data_file, "r", locking=False) as f:
+        data = f[DATA_PATH]
+        for i in range(start, stop):
+            spots[i - start], intensity[i - start] = find_spots(
+                data[i], sigma, binning, min_counts
+            )
+    return spots, intensity
+
+
+def frame_count(data_file: Path) -> int:
+    """
+    Frames readable so far, 0 while the file writer still holds the file
+    """
+    try:
+        with h5py.File(data_file, "r", locking=False) as f:
+            return f[DATA_PATH].shape[0]
+    except (OSError, KeyError):
+        return 0
+
+
+class FollowedScan:
+    """
+    Analysis progress of one scan data file
+    """
+
+    def __init__(self, data_file: Path):
+        self.data_file = data_file
+        self.name = data_file.name[: -len(DATA_FILE_SUFFIX)]
+        self.sidecar = data_file.with_name(f"{self.name}{SIDECAR_SUFFIX}")
+        # Frame to aperture index mapping, from the scan name until the
+        # sidecar is written
+        self.apertures: Optional[np.ndarray] = None
+        match = SCAN_NAME_PATTERN.match(self.name)
+        if match:
+            self.apertures = serpentine_apertures(match.group(1))
+        self.next_frame = 0
+        # Chunks to read again, with the number of failed attempts
+        self.retry: List[Tuple[int, int, int]] = []
+        self.in_flight = 0
+        # Results of aperture scans wait here for the sidecar to map them
+        self.unmapped: List[Tuple[int, int, np.ndarray, np.ndarray]] = []
+        self.analysed = 0
+        # Frames given up on after too many failed reads
+        self.failed = 0
+        self.started = time.monotonic()
+        # An aborted scan stops short of its frames, it is dropped once
+        # the file stops growing
+        self.available = 0
+        self.last_growth = self.started
+
+    def update_apertures(self):
+        if self.sidecar.exists():
+            try:
+                self.apertures = read_aperture_index(self.sidecar)
+            except (OSError, KeyError):
+                pass
+
+    @property
+    def frames(self) -> Optional[int]:
+        return None if self.apertures is None else len(self.apertures)
+
+    @property
+    def done(self) -> bool:
+        return self.frames is not None and self.analysed + self.failed >= self.frames
+
+
+class HitFinder:
+    """
+    Follows the Eiger data files written to the proposal path and finds
+    spots in every frame as it becomes readable. Frames are analysed in
+    chunks on a process pool, results are mapped to apertures and handed to
+    on_results(apertures, spots, intensity) on the event loop.
+
+    Data files present when the finder starts, or when the path changes,
+    are left alone. A chunk that cannot be read is given up on after
+    max_retries attempts, and a scan whose file has not grown for
+    stale_timeout seconds is no longer followed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        on_results: Callable[[np.ndarray, np.ndarray, np.ndarray], None],
+        processes=4,
+        chunk_frames=20,
+        poll_interval=0.5,
+        sigma=6.0,
+        binning=1,
+        min_counts=10.0,
+        max_retries=5,
+        stale_timeout=120.0,
+    ):
+        self.path = Path(path)
+        self.on_results = on_results
+        self.processes = processes
+        self.chunk_frames = chunk_frames
+        self.poll_interval = poll_interval
+        self.sigma = sigma
+        self.binning = binning
+        self.min_counts = min_counts
+        self.max_retries = max_retries
+        self.stale_timeout = stale_timeout
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.task: Optional[asyncio.Task] = None
+        self.scans: Dict[Path, FollowedScan] = {}
+        self.finished: Set[Path] = set()
+        self.pending: Set[asyncio.Task] = set()
+
+    def start(self):
+        if hdf5plugin is None:
+            print(
+                "Hit finder: hdf5plugin is not installed, compressed Eiger data "
+                "cannot be read and its chunks will be given up on"
+            )
+        # Spawned, the server process runs threads that must not be forked
+        self.pool = ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.set_path(self.path)
+        self.task = asyncio.create_task(self.follow())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for task in self.pending:
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def set_path(self, path: Path):
+        self.path = Path(path)
+        self.scans = {}
+        self.finished = set(self.data_files())
+
+    def data_files(self) -> List[Path]:
+        try:
+            with os.scandir(self.path) as entries:
+                return [
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.name.endswith(DATA_FILE_SUFFIX)
+                ]
+        except OSError:
+            return []
+
+    async def follow(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Hit finder poll failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self):
+        for data_file in await asyncio.to_thread(self.data_files):
+            if data_file not in self.finished and data_file not in self.scans:
+                self.scans[data_file] = FollowedScan(data_file)
+        for scan in list(self.scans.values()):
+            if scan.apertures is None or scan.next_frame >= len(scan.apertures):
+                await asyncio.to_thread(scan.update_apertures)
+            if scan.unmapped or scan.done:
+                self.deliver(scan)
+            if scan.data_file not in self.scans:
+                continue
+            available = await asyncio.to_thread(frame_count, scan.data_file)
+            if scan.frames is not None:
+                available = min(available, scan.frames)
+            now = time.monotonic()
+            if available > scan.available:
+                scan.available = available
+                scan.last_growth = now
+            elif (
+                not scan.retry
+                and not scan.in_flight
+                and scan.next_frame >= available
+                and now - scan.last_growth > self.stale_timeout
+            ):
+                self.finish(scan, "stopped growing")
+                continue
+            chunks, scan.retry = scan.retry, []
+            while scan.next_frame < available:
+                stop = min(scan.next_frame + self.chunk_frames, available)
+                chunks.append((scan.next_frame, stop, 0))
+                scan.next_frame = stop
+            for start, stop, attempts in chunks:
+                scan.in_flight += 1
+                task = asyncio.create_task(self.analyse(scan, start, stop, attempts))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+
+    async def analyse(self, scan: FollowedScan, start: int, stop: int, attempts=0):
+        try:
+            spots, intensity = await asyncio.get_running_loop().run_in_executor(
+                self.pool,
+                analyse_frames,
+                str(scan.data_file),
+                start,
+                stop,
+                self.sigma,
+                self.binning,
+                self.min_counts,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            scan.in_flight -= 1
+            attempts += 1
+            if attempts < self.max_retries:
+                # Frames the file writer had not flushed yet are tried again
+                print(f"Hit finder could not read {scan.name} frames {start}-{stop}: {e}")
+                scan.retry.append((start, stop, attempts))
+                return
+            print(
+                f"Hit finder gave up on {scan.name} frames {start}-{stop} "
+                f"after {attempts} attempts: {e}"
+            )
+            scan.failed += stop - start
+            self.deliver(scan)
+            return
+        scan.in_flight -= 1
+        scan.analysed += stop - start
+        scan.unmapped.append((start, stop, spots, intensity))
+        self.deliver(scan)
+
+    def deliver(self, scan: FollowedScan):
+        if scan.apertures is None:
+            scan.update_apertures()
+            if scan.apertures is None:
+                return
+        for start, stop, spots, intensity in scan.unmapped:
+            self.on_results(scan.apertures[start:stop], spots, intensity)
+        scan.unmapped = []
+        if scan.done:
+            self.finish(scan)
+
+    def finish(self, scan: FollowedScan, reason: Optional[str] = None):
+        if self.scans.pop(scan.data_file, None) is None:
+            return
+        self.finished.add(scan.data_file)
+        elapsed = time.monotonic() - scan.started
+        failed = f", {scan.failed} unreadable" if scan.failed else ""
+        stopped = f", {reason}" if reason else ""
+        print(
+            f"Hit finder analysed {scan.analysed} frames of {scan.name} in "
+            f"{elapsed:.1f} s ({scan.analysed / max(elapsed, 1e-6):.0f} frames/s"
+            f"{failed}{stopped})"
+        )
+
+
+def write_synthetic_scan(
+    directory: Path,
+    location: str,
+    dwell=10.0,
+    hit_rate=0.3,
+    frame_shape=(512, 512),
+    seed: Optional[int] = None,
+):
+    """
+    Stands in for the detector during testing: writes one scan of a block or
+    row line by line at the real frame rate, named like configure_detector
+    names them, followed by its sidecar. Hits have 20 to 60 Bragg spots on
+    a Poisson background
+    """
+    rng = np.random.default_rng(seed)
+    apertures = serpentine_apertures(location)
+    name = f"CHIP{location}{time.strftime('%Y%m%d%H%M%S')}"
+    data_file = directory / f"{name}{DATA_FILE_SUFFIX}"
+    height, width = frame_shape
+    line_starts = []
+    with h5py.File(data_file, "w", libver="latest") as f:
+        data = f.create_dataset(
+            DATA_PATH,
+            shape=(0,) + frame_shape,
+            maxshape=(None,) + frame_shape,
+            chunks=(1,) + frame_shape,
+            dtype=np.uint32,
+        )
+        for start in range(0, len(apertures), 20):
+            line_started = time.time()
+            frames = rng.poisson(2.0, (20,) + frame_shape).astype(np.uint32)
+            for frame in frames:
+                if rng.random() < hit_rate:
+                    count = rng.integers(20, 60)
+                    frame[rng.integers(1, height - 1, count), rng.integers(1, width - 1, count)] += (
+                        rng.integers(50, 500, count).astype(np.uint32)
+                    )
+            data.resize(start + 20, axis=0)
+            data[start:] = frames
+            f.flush()
+            line_starts.append(
+                {
+                    "time": line_started,
+                    "position": np.zeros(3),
+                    "encoder": np.zeros(3),
+                    "position_step": np.zeros(3),
+                    "encoder_step": np.zeros(3),
+                }
+            )
+            time.sleep(max(0.0, 20 * dwell / 1000 - (time.time() - line_started)))
+    write_sidecar(
+        directory / f"{name}{SIDECAR_SUFFIX}",
+        build_sidecar(location, "synthetic", dwell, line_starts, 20, {"data_file": name}),
+    )
+    return data_file
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write synthetic chip scans for testing the online hit finder"
+    )
+    parser.add_argument("directory", type=Path, help="Proposal path the server follows")
+    parser.add_argument("locations", nargs="+", help="Blocks or rows to scan, e.g. A1 A2a")
+    parser.add_argument("--dwell", type=float, default=10.0, help="Milliseconds per frame")
+    parser.add_argument("--hit-rate", type=float, default=0.3)
+    parser.add_argument("--size", type=int, default=512, help="Frame height and width")
+    args = parser.parse_args()
+    for location in args.locations:
+        data_file = write_synthetic_scan(
+            args.directory, location, args.dwell, args.hit_rate, (args.size, args.size)
+        )
+        print(f"Wrote {data_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
-from typing import Any
+from typing import Any, Optional, Union
 from uuid import UUID
 
 from fastapi import WebSocket
 
-from model.comm_protocol import Message
+from model.comm_protocol import Message, encode_message
 
 
 class ConnectionManager:
@@ -14,21 +14,40 @@ class ConnectionManager:
     def __init__(self):
         self.active_connections: dict[UUID, WebSocket] = {}
         self.user_info: dict[UUID, dict[str, Any]] = {}
+        # Negotiated wire encoding per client, None means JSON
+        self.subprotocols: dict[UUID, Optional[str]] = {}
 
-    async def connect(self, websocket: WebSocket, client_id: UUID):
-        await websocket.accept()
+    async def connect(
+        self, websocket: WebSocket, client_id: UUID, subprotocol: Optional[str] = None
+    ):
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[client_id] = websocket
         self.user_info[client_id] = {}
+        self.subprotocols[client_id] = subprotocol
 
     def disconnect(self, client_id: UUID):
         self.active_connections.pop(client_id, None)
         self.user_info.pop(client_id, None)
+        self.subprotocols.pop(client_id, None)
+
+    async def _send(self, websocket: WebSocket, data: Union[str, bytes]):
+        if isinstance(data, bytes):
+            await websocket.send_bytes(data)
+        else:
+            await websocket.send_text(data)
 
     async def unicast(self, message: Message, client_id: UUID):
         websocket = self.active_connections.get(client_id, None)
         if websocket:
-            await websocket.send_text(message.json())
+            await self._send(
+                websocket, encode_message(message, self.subprotocols.get(client_id))
+            )
 
     async def broadcast(self, message: Message):
-        for client_id, connection in self.active_connections.items():
-            await connection.send_text(message.json())
+        # Encode once per subprotocol rather than once per client
+        encoded: dict[Optional[str], Union[str, bytes]] = {}
+        for client_id, connection in list(self.active_connections.items()):
+            subprotocol = self.subprotocols.get(client_id)
+            if subprotocol not in encoded:
+                encoded[subprotocol] = encode_message(message, subprotocol)
+            await self._send(connection, encoded[subprotocol])
@@ -1,62 +1,366 @@
-from queue import Queue
-from typing import Any, Callable, Dict, Optional, Type, TypeVar
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 from uuid import UUID
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import time
+import numpy as np
 from model.comm_protocol import (
+    ClearFiducials,
     ClearQueue,
+    CollectApertures,
+    CollectionStatus,
     CollectNeighborhood,
     CollectQueue,
     CollectRow,
+    CollectSelection,
+    EmergencyStop,
     ErrorResponse,
     ExecuteActionResponse,
     ExecuteRequest,
+    FiducialStatus,
     GoToFiducial,
+    HitMapResponse,
+    LoadChip,
     LoginResponse,
     Message,
     MetadataType,
     MoveGonio,
     NudgeGonio,
+    PauseQueue,
     PayloadType,
+    PositionResponse,
+    Prescreen,
+    QueueItem,
+    PrescreenResult,
     QueueActionResponse,
+    QueuedItems,
     QueueRequest,
+    RemoveFromQueue,
+    RequestSnapshot,
+    ResumeQueue,
     SetFiducial,
+    SnapshotResponse,
+    StagePosition,
+    StatusResponse,
     ClickToCenter,
-    SetGovernorState
+    SetGovernorState,
+    StartJog,
+    StopJog,
+    pack_indices,
 )
-from multiprocessing import Pipe
+from model.chip import block_location, location_slices, row_location
 from .manager import ConnectionManager
-from .devices import cam_7, cam_8
+from .exposure_ledger import APERTURE_SHAPE, ExposureLedger
+from .hit_finder import HitFinder
+from .motion import MotionCoalescer
+from .scan_sidecar import aperture_segments
+from .state import ServerState, item_apertures
+from .worker_supervisor import WorkerSupervisor
 
 T = TypeVar("T", bound=PayloadType)
 
+# Number of units of each selection level on the chip, 8 x 8 blocks of
+# 20 x 20 apertures
+SELECTION_SIZES = {
+    "block": APERTURE_SHAPE[0] // 20 * (APERTURE_SHAPE[1] // 20),
+    "row": APERTURE_SHAPE[0] * (APERTURE_SHAPE[1] // 20),
+    "aperture": APERTURE_SHAPE[0] * APERTURE_SHAPE[1],
+}
+
+
+class CollectionError(RuntimeError):
+    """
+    A collection plan that failed, with the scans it recorded before it
+    ended
+    """
+
+    def __init__(self, message: str, scans: List[Dict[str, Any]]):
+        super().__init__(message)
+        self.scans = scans
+
+
+class WorkerFailed(CollectionError):
+    """
+    The worker running a collection failed and was replaced
+    """
+
 
 class ChipScannerMessageManager:
-    def __init__(self, connection_manager: ConnectionManager, bluesky_env, config, proposal_config):
+    def __init__(self, connection_manager: ConnectionManager, start_worker: Callable, config, proposal_config):
         self.name = "Chip scanner manager"
         self.conn_manager = connection_manager
-        self.bluesky_env = bluesky_env
-        self.request_queue: Queue[PayloadType] = Queue()
         self.config = config
+        self.ledger_directory = Path(config.get("exposure_ledger_dir", "exposure_ledger"))
+        self.state = ServerState(self.open_ledger(self.current_chip_name()))
+        # State updates and snapshots, sent one at a time in the order they
+        # were taken
+        self.outbox: "asyncio.Queue[Tuple[Message, Optional[UUID]]]" = asyncio.Queue()
+        self.outbox_task: Optional[asyncio.Future] = None
         self.valid_queue_requests: Dict[Type[PayloadType], Callable] = {
             CollectNeighborhood: self.collect_neighborhood,
             CollectRow: self.collect_row,
+            CollectApertures: self.collect_apertures,
         }
         self.valid_immediate_requests: Dict[Type[PayloadType], Callable] = {
             GoToFiducial: self.go_to_fiducial,
             SetFiducial: self.set_fiducial,
+            ClearFiducials: self.clear_fiducials,
             ClearQueue: self.clear_queue,
+            RemoveFromQueue: self.remove_from_queue,
             NudgeGonio: self.nudge_gonio,
+            MoveGonio: self.move_gonio,
             CollectQueue: self.collect_queue,
+            PauseQueue: self.pause_queue,
+            ResumeQueue: self.resume_queue,
+            EmergencyStop: self.emergency_stop,
             ClickToCenter: self.click_to_center,
-            SetGovernorState: self.set_governor_state
+            SetGovernorState: self.set_governor_state,
+            LoadChip: self.load_chip,
+            Prescreen: self.prescreen,
+            StartJog: self.start_jog,
+            StopJog: self.stop_jog,
         }
         
 
-        self.parent_conn, self.child_conn = Pipe()
-        self.worker_process = bluesky_env.RunEngineWorker(conn=self.child_conn, config=config, proposal_config=proposal_config)
-        self.worker_process.start()
+        if not config.get("test", False) and not config.get("emergency_stop", {}).get(
+            "ppmac_abort_pv"
+        ):
+            # Stopping the motor records does not end the PPMAC coordinate
+            # system program, the stage would keep moving after an e-stop
+            raise ValueError(
+                "emergency_stop.ppmac_abort_pv is not set in the server config, "
+                "an emergency stop could not abort the PPMAC motion program"
+            )
+        # Every device read and plan runs in the worker, this process never
+        # imports bluesky or ophyd. A standby worker takes over if it fails
+        supervisor_config = config.get("worker_supervisor", {})
+        self.workers = WorkerSupervisor(
+            start_worker,
+            config,
+            proposal_config,
+            on_message=self.handle_worker_message,
+            on_failover=self.worker_failed,
+            standby=supervisor_config.get("standby", True),
+            heartbeat_interval=None
+            if config.get("test", False)
+            else supervisor_config.get("heartbeat_interval", 0.2),
+            heartbeat_timeout=supervisor_config.get("heartbeat_timeout", 0.8),
+            startup_timeout=supervisor_config.get("startup_timeout", 300.0),
+            activation_timeout=supervisor_config.get("activation_timeout", 10.0),
+        )
+        # Camera calibration and zoom ROI sizes, reported by the worker
+        self.optics: Optional[Dict[str, Any]] = None
+        # Last RunEngine state, plan and plan queue length of the worker
+        self.worker_status: Optional[Dict[str, Any]] = None
+        # The worker names the chip master file after the loaded chip
+        self.workers.send(LoadChip(name=self.state.ledger.chip_name))
+        self.active_jog: Optional[StartJog] = None
+        # Refused while a collection runs, the operator is told once per
+        # held jog
+        self.refused_jog: Optional[StartJog] = None
+        self.collection_result: Optional[asyncio.Future] = None
+        self.queue_task: Optional[asyncio.Future] = None
+        # Set while collection is not paused
+        self.queue_resumed = asyncio.Event()
+        self.queue_resumed.set()
+        self.motion = MotionCoalescer(
+            self.workers.send,
+            max_in_flight=config.get("motion_max_in_flight", 1),
+        )
+
+        # Items partly screened empty are collected aperture by aperture when
+        # that takes at most this many line segments
+        self.prescreen_max_segments = config.get("prescreen", {}).get("max_segments", 20)
+        hit_config = config.get("hit_finder", {})
+        self.state.min_spots = hit_config.get("min_spots", 10)
+        self.hit_broadcast_interval = hit_config.get("broadcast_interval", 0.5)
+        self.pending_hits: List[np.ndarray] = []
+        self.hit_finder: Optional[HitFinder] = None
+        if hit_config.get("enabled", False):
+            self.hit_finder = HitFinder(
+                Path(str(proposal_config["path"])),
+                self.record_hits,
+                processes=hit_config.get("processes", 8),
+                chunk_frames=hit_config.get("chunk_frames", 20),
+                poll_interval=hit_config.get("poll_interval", 0.5),
+                sigma=hit_config.get("sigma", 6.0),
+                binning=hit_config.get("binning", 1),
+                min_counts=hit_config.get("min_counts", 10.0),
+                max_retries=hit_config.get("max_retries", 5),
+                stale_timeout=hit_config.get("stale_timeout", 120.0),
+            )
+
+    def start_listening(self):
+        """
+        Handles worker messages as soon as they arrive on the pipe instead
+        of polling it
+        """
+        self.outbox_task = asyncio.ensure_future(self.send_outbox())
+        self.workers.start_listening()
+        self.request_worker_status()
+        if self.hit_finder is not None:
+            self.hit_finder.start()
+
+    def stop_listening(self):
+        self.workers.stop_listening()
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+
+    def publish(self, metadata: MetadataType, payload: Optional[PayloadType] = None):
+        """
+        Broadcasts a change of the server state stamped with the next
+        sequence number. The number is taken and the message queued in one
+        step, so clients receive the changes in sequence order
+        """
+        metadata.seq = self.state.bump()
+        self.send_in_order(Message(metadata=metadata, payload=payload))
+
+    def send_in_order(self, message: Message, client_id: Optional[UUID] = None):
+        """
+        Queues a state update or snapshot for the outbox, broadcast unless
+        a client is given
+        """
+        self.outbox.put_nowait((message, client_id))
+
+    async def send_outbox(self):
+        while True:
+            message, client_id = await self.outbox.get()
+            try:
+                if client_id is None:
+                    await self.conn_manager.broadcast(message)
+                else:
+                    await self.conn_manager.unicast(message, client_id=client_id)
+            except Exception as e:
+                print(f"Could not send state update: {e}")
+
+    def worker_failed(self, reason: str):
+        """
+        Called once a standby worker has taken over. Moves the manager
+        state that waited on the failed worker forward, the collection in
+        progress fails and is put back at the front of the queue
+        """
+        self.motion.reset()
+        if self.collection_result and not self.collection_result.done():
+            self.collection_result.set_result(
+                {"status": "failed", "error": f"worker failed: {reason}", "worker_failed": True}
+            )
+        asyncio.ensure_future(
+            self.conn_manager.broadcast(
+                Message(
+                    metadata=ErrorResponse(
+                        status_msg=f"RunEngine worker failed ({reason}), standby worker took over"
+                    )
+                )
+            )
+        )
+
+    def handle_worker_message(self, message):
+        if not isinstance(message, dict):
+            print(f"Received: {message}")
+            return
+        if message.get("status") not in ("position", "worker_status"):
+            # Positions and heartbeats arrive several times a second
+            print(f"Received: {message}")
+        if (
+            message.get("status") in ("completed", "failed")
+            and message.get("payload_type") in MotionCoalescer.motion_payload_types
+        ):
+            self.motion.completed(message.get("move_id"))
+        elif (
+            message.get("status") in ("completed", "failed")
+            and message.get("payload_type")
+            in ("collect_neighborhood", "collect_row", "collect_apertures")
+        ):
+            if self.collection_result and not self.collection_result.done():
+                self.collection_result.set_result(message)
+        elif message.get("status") == "position":
+            asyncio.ensure_future(
+                self.conn_manager.broadcast(
+                    Message(
+                        metadata=PositionResponse(),
+                        payload=StagePosition(**message["position"]),
+                    )
+                )
+            )
+        elif (
+            message.get("status") == "failed"
+            and message.get("payload_type") == "configure_hardware"
+        ):
+            asyncio.ensure_future(
+                self.conn_manager.broadcast(
+                    Message(
+                        metadata=ErrorResponse(
+                            status_msg=f"Worker could not configure the Zebra and Eiger: {message['error']}"
+                        )
+                    )
+                )
+            )
+        elif message.get("status") == "prescreen":
+            self.record_prescreen(message["location"], message["filled"])
+        elif message.get("status") in ("paused", "resumed"):
+            asyncio.ensure_future(
+                self.conn_manager.broadcast(
+                    Message(
+                        metadata=StatusResponse(
+                            status_msg=f"Worker {message['status']} {message['payload_type']}"
+                        )
+                    )
+                )
+            )
+        elif message.get("status") == "emergency_stop":
+            self.report_emergency_stop(message)
+        elif message.get("status") == "activated":
+            # Worker promoted from standby, its fiducials are those handed over
+            self.request_worker_status()
+        elif message.get("status") == "optics":
+            self.optics = message
+        elif message.get("status") == "worker_status":
+            self.worker_status = message
+            if message.get("sent") is not None:
+                print(f"Worker status round trip {(time.time() - message['sent']) * 1000:.1f} ms")
+        elif message.get("status") == "fiducials":
+            # The worker owns the fiducials, it reports them on startup and
+            # after every change
+            if message["fiducials"] != self.state.fiducials:
+                self.state.fiducials = message["fiducials"]
+                self.broadcast_fiducials()
+
+    def record_prescreen(self, location: str, filled: List[int]):
+        rows, cols = location_slices(location)
+        self.state.screened[rows, cols] = True
+        self.state.filled[rows, cols] = False
+        self.state.filled.flat[filled] = True
+        self.publish(
+            StatusResponse(
+                status_msg=f"Pre-screened {location}: {len(filled)} apertures filled"
+            ),
+            PrescreenResult(location=location, filled=pack_indices(filled)),
+        )
+
+    def record_hits(self, apertures: np.ndarray, spots: np.ndarray, intensity: np.ndarray):
+        """
+        Takes hit finder results, which arrive a chunk of frames at a time.
+        They are broadcast together every broadcast interval
+        """
+        self.state.hits.flat[apertures] = spots
+        if not self.pending_hits:
+            asyncio.get_running_loop().call_later(
+                self.hit_broadcast_interval, self.flush_hits
+            )
+        self.pending_hits.append(apertures)
+
+    def flush_hits(self):
+        if not self.pending_hits:
+            return
+        indices = np.concatenate(self.pending_hits)
+        self.pending_hits = []
+        self.publish(HitMapResponse(), self.state.hit_map(indices))
+
+    def broadcast_fiducials(self):
+        self.publish(
+            StatusResponse(status_msg="Fiducials updated"),
+            FiducialStatus(fiducials=self.state.fiducials),
+        )
 
     async def process_message(self, data: Message, user_id: str):
         if isinstance(data.metadata, QueueRequest):
@@ -67,16 +371,16 @@ class ChipScannerMessageManager:
     async def handle_queue_request(
         self, metadata: QueueRequest, payload: Optional[PayloadType]
     ):
-        if payload and type(payload) in self.valid_queue_requests:
-            self.request_queue.put(payload)
-            await self.conn_manager.broadcast(
-                Message(
-                    metadata=QueueActionResponse(
-                        status_msg=f"{metadata.user_id} added request {str(payload)} to queue",
-                        user_id=metadata.user_id,
-                    ),
-                    payload=payload,
-                )
+        if isinstance(payload, CollectSelection):
+            await self.handle_collect_selection(metadata, payload)
+        elif payload and type(payload) in self.valid_queue_requests:
+            self.state.queue.append(payload)
+            self.publish(
+                QueueActionResponse(
+                    status_msg=f"{metadata.user_id} added request {str(payload)} to queue",
+                    user_id=metadata.user_id,
+                ),
+                payload,
             )
         else:
             await self.conn_manager.unicast(
@@ -90,16 +394,127 @@ class ChipScannerMessageManager:
                 client_id=metadata.client_id,
             )
 
-    """
-    Other unimplemented commands:
-     - Pause queue: Should complete current task and pause
-     - Stop queue: Stop current task immediately 
-     """
+    def expand_selection(self, payload: CollectSelection) -> "list[QueueItem]":
+        indices = payload.indices()
+        if not indices:
+            raise ValueError("Nothing selected to queue")
+        # Indices are ascending, the last one is the largest
+        if indices[-1] >= SELECTION_SIZES[payload.level]:
+            raise ValueError(
+                f"Cannot queue {payload.level} {indices[-1]}, the chip has "
+                f"{SELECTION_SIZES[payload.level]} {payload.level}s"
+            )
+        if payload.level == "block":
+            return [
+                CollectNeighborhood(
+                    location=block_location(index), wait_time=payload.wait_time
+                )
+                for index in indices
+            ]
+        elif payload.level == "row":
+            return [
+                CollectRow(location=row_location(index), wait_time=payload.wait_time)
+                for index in indices
+            ]
+        elif payload.level == "aperture":
+            # One scan for the whole selection, its cost grows with the number
+            # of apertures rather than the blocks they sit in
+            return [CollectApertures(apertures=payload.mask, wait_time=payload.wait_time)]
+        raise ValueError(f"Cannot queue a selection of {payload.level}s")
+
+    async def handle_collect_selection(
+        self, metadata: QueueRequest, payload: CollectSelection
+    ):
+        try:
+            items = self.expand_selection(payload)
+        except ValueError as e:
+            await self.conn_manager.unicast(
+                Message(metadata=ErrorResponse(status_msg=str(e))),
+                client_id=metadata.client_id,
+            )
+            return
+        self.state.queue.extend(items)
+        self.publish(
+            QueueActionResponse(
+                status_msg=f"{metadata.user_id} added {len(items)} requests to queue",
+                user_id=metadata.user_id,
+            ),
+            QueuedItems(items=items),
+        )
+
+    def current_chip_name(self) -> str:
+        # Remembered across restarts so that exposure keeps being recorded
+        # against the chip on the scanner
+        path = self.ledger_directory / "current_chip"
+        if path.exists():
+            return path.read_text().strip()
+        return self.config.get("chip_name", "Chip01")
+
+    def send_control(self, action: str, **kwargs):
+        """
+        Sends an action to the worker's control lane, which serves it at
+        once even while a plan runs
+        """
+        self.workers.send({"action": action, **kwargs})
+
+    def request_worker_status(self):
+        self.send_control("status", sent=time.time())
+
+    def set_filepath(self, path: Path):
+        """
+        Points the worker's data files and the hit finder at a new
+        proposal path
+        """
+        self.send_control("set_filepath", path=str(path))
+        if self.hit_finder is not None:
+            self.hit_finder.set_path(path)
+
+    def open_ledger(self, chip_name: str) -> ExposureLedger:
+        ledger = ExposureLedger(self.ledger_directory, chip_name)
+        (self.ledger_directory / "current_chip").write_text(chip_name)
+        return ledger
+
+    async def load_chip(self, response_metadata: MetadataType, payload: LoadChip):
+        if self.state.running is not None:
+            await self.conn_manager.broadcast(
+                Message(
+                    metadata=ErrorResponse(
+                        status_msg=f"Cannot load chip {payload.name} during a collection"
+                    )
+                )
+            )
+            return
+        self.state.ledger.close()
+        self.state.ledger = self.open_ledger(payload.name)
+        self.workers.send(payload)
+        # Queued locations refer to the previous chip
+        self.state.queue.clear()
+        self.state.reset_chip()
+        self.pending_hits = []
+        # The snapshot carries the sequence number of its own message
+        seq = self.state.bump()
+        self.send_in_order(
+            Message(
+                metadata=SnapshotResponse(status_msg=f"Loaded chip {payload.name}", seq=seq),
+                payload=self.state.snapshot(),
+            )
+        )
+
+    async def send_snapshot(self, client_id: UUID):
+        """
+        Sends the full server state to one client, on connect and whenever
+        the client reports a gap in the sequence numbers
+        """
+        self.send_in_order(
+            Message(metadata=SnapshotResponse(), payload=self.state.snapshot()), client_id
+        )
 
     async def handle_execute_request(
         self, metadata: ExecuteRequest, payload: Optional[PayloadType]
     ):
-        if payload and type(payload) in self.valid_immediate_requests:
+        if isinstance(payload, RequestSnapshot):
+            await self.send_snapshot(metadata.client_id)
+        elif payload and type(payload) in self.valid_immediate_requests:
             # run_engine_state = self.bluesky_env.RE.state
             run_engine_state = "idle"
             if run_engine_state == "idle":
@@ -128,7 +543,7 @@ class ChipScannerMessageManager:
     async def set_governor_state(
             self, response_metadata: MetadataType, payload: SetGovernorState
     ):
-        self.parent_conn.send(payload)
+        self.workers.send(payload)
         response_metadata.status_msg = f"Going to Governor state {payload.state}"
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
@@ -138,14 +553,14 @@ class ChipScannerMessageManager:
         self, response_metadata: MetadataType, payload: GoToFiducial
     ):
         
-        self.parent_conn.send(payload)
+        self.workers.send(payload)
         response_metadata.status_msg = f"Going to fiducial {payload.name}"
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
 
     async def nudge_gonio(self, response_metadata: MetadataType, payload: NudgeGonio):
-        self.parent_conn.send(payload)
+        self.motion.submit(payload)
         
         response_metadata.status_msg = (
             f"Nudging gonio by x={payload.x_delta}, y={payload.y_delta}"
@@ -154,17 +569,63 @@ class ChipScannerMessageManager:
             Message(metadata=response_metadata, payload=payload)
         )
 
+    async def start_jog(self, response_metadata: MetadataType, payload: StartJog):
+        # Jogs are refreshed several times a second while held, only the
+        # first of a run is broadcast
+        if self.state.running is not None:
+            # The stage belongs to the scan, a held jog is refused once
+            if payload != self.refused_jog:
+                self.refused_jog = payload
+                await self.conn_manager.broadcast(
+                    Message(
+                        metadata=ErrorResponse(
+                            status_msg=f"Cannot jog during the collection of {self.state.running}"
+                        )
+                    )
+                )
+            return
+        self.refused_jog = None
+        self.workers.send(payload)
+        if payload == self.active_jog:
+            return
+        self.active_jog = payload
+        response_metadata.status_msg = (
+            f"Jogging {payload.axis} in direction {payload.direction} "
+            f"at {payload.velocity}/s"
+        )
+        await self.conn_manager.broadcast(
+            Message(metadata=response_metadata, payload=payload)
+        )
+
+    async def stop_jog(self, response_metadata: MetadataType, payload: StopJog):
+        self.workers.send(payload)
+        self.active_jog = None
+        self.refused_jog = None
+        response_metadata.status_msg = "Stopped jog"
+        await self.conn_manager.broadcast(
+            Message(metadata=response_metadata, payload=payload)
+        )
+
     async def click_to_center(self, response_metadata: MetadataType, payload: ClickToCenter):
-        # LowMagCal.get provides the microns/pixel ratio
-        zoom_levels = [self.bluesky_env.BL_calibration.LoMagCal.get(), self.bluesky_env.BL_calibration.LoMagCal.get(), 
-                       self.bluesky_env.BL_calibration.HiMagCal.get(), self.bluesky_env.BL_calibration.HiMagCal.get()]
-        rois = [cam_7.roi2, cam_7.roi3, cam_8.roi2, cam_8.roi1]
-        final_x_pixel_delta = payload.pixel_delta.x_delta * (rois[payload.zoom_level].size.x.get() / payload.video_dimensions.width)
-        final_y_pixel_delta = payload.pixel_delta.y_delta * (rois[payload.zoom_level].size.y.get() / payload.video_dimensions.height)
-        x_microns = final_x_pixel_delta * zoom_levels[payload.zoom_level]
-        y_microns = final_y_pixel_delta * zoom_levels[payload.zoom_level]
+        if self.optics is None:
+            await self.conn_manager.broadcast(
+                Message(
+                    metadata=ErrorResponse(
+                        status_msg="Camera calibration not yet reported by the worker"
+                    )
+                )
+            )
+            return
+        # Microns per pixel and ROI size of the zoom level, cached from the
+        # worker's CA monitors
+        microns_per_pixel = self.optics["microns_per_pixel"][payload.zoom_level]
+        roi_x, roi_y = self.optics["roi_sizes"][payload.zoom_level]
+        final_x_pixel_delta = payload.pixel_delta.x_delta * (roi_x / payload.video_dimensions.width)
+        final_y_pixel_delta = payload.pixel_delta.y_delta * (roi_y / payload.video_dimensions.height)
+        x_microns = final_x_pixel_delta * microns_per_pixel
+        y_microns = final_y_pixel_delta * microns_per_pixel
         nudge_payload = NudgeGonio(x_delta=x_microns, y_delta=y_microns, z_delta=0)
-        self.parent_conn.send(nudge_payload)
+        self.motion.submit(nudge_payload)
         
         response_metadata.status_msg = (
             f"Nudging gonio by x={x_microns}, y={y_microns}"
@@ -175,14 +636,23 @@ class ChipScannerMessageManager:
 
 
     async def set_fiducial(self, response_metadata: MetadataType, payload: SetFiducial):
-        self.parent_conn.send(payload)
+        self.workers.send(payload)
         response_metadata.status_msg = f"Setting fiducial {payload.name}"
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
 
+    async def clear_fiducials(
+        self, response_metadata: MetadataType, payload: ClearFiducials
+    ):
+        self.workers.send(payload)
+        response_metadata.status_msg = "Clearing fiducials"
+        await self.conn_manager.broadcast(
+            Message(metadata=response_metadata, payload=payload)
+        )
+
     async def move_gonio(self, response_metadata: MetadataType, payload: MoveGonio):
-        
+        self.motion.submit(payload)
         response_metadata.status_msg = (
             f"Moving gonio to x={payload.x_pos}, y={payload.y_pos}"
         )
@@ -190,40 +660,63 @@ class ChipScannerMessageManager:
             Message(metadata=response_metadata, payload=payload)
         )
 
-    def run_neighborhood_scan(self, location, wait_time):
-        return self.bluesky_env.RE(
-                self.bluesky_env.chip_scanner.ppmac_neighbourhood_scan(
-                    location, wait_time
-                )
-            )
-    
-    def run_row_scan(self, location, wait_time):
-        return self.bluesky_env.RE(
-                self.bluesky_env.chip_scanner.ppmac_single_line_scan(
-                    location, wait_time
-                )
-            )
-    
-    async def collect_neighborhood(
-        self, response_metadata: MetadataType, payload: CollectNeighborhood
-    ):
-        response_metadata.status_msg = (
-            f"Collecting block {payload.location} with wait time {payload.wait_time}"
-        )
+    async def prescreen(self, response_metadata: MetadataType, payload: Prescreen):
+        self.workers.send(payload)
+        response_metadata.status_msg = f"Pre-screening {', '.join(payload.locations)}"
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as pool:
-            uid, status = await loop.run_in_executor(pool, self.run_neighborhood_scan, *[payload.location, payload.wait_time])
-            
 
+    def prescreened_runs(self, item: QueueItem) -> "list[QueueItem]":
+        """
+        Scans that collect an item, leaving out what the pre-screen found
+        empty and what is already exposed, for example by an aborted scan
+        of the item. An item that is partly left out is collected as an
+        aperture scan of the rest when that is no more line segments than a
+        block scan, an item with nothing left is not collected
+        """
+        apertures = item_apertures(item)
+        empty = (self.state.screened_empty() | self.state.ledger.exposed).flat[apertures]
+        if not empty.any():
+            return [item]
+        if empty.all():
+            return []
+        remaining = apertures[~empty]
+        if (
+            isinstance(item, CollectApertures)
+            or len(aperture_segments(remaining)) <= self.prescreen_max_segments
+        ):
+            return [CollectApertures.from_indices(remaining.tolist(), item.wait_time)]
+        return [item]
+
+    async def run_collection(self, payload: QueueItem):
+        """
+        Runs a collection plan in the worker and waits for it to finish,
+        returns the scan summaries recorded by the plan, one per detector
+        arm
+        """
+        self.collection_result = asyncio.get_running_loop().create_future()
+        self.workers.send(payload)
+        result = await self.collection_result
+        scans = result.get("scans") or []
+        if result.get("worker_failed"):
+            raise WorkerFailed(result["error"], scans)
+        if result["status"] != "completed":
+            raise CollectionError(result.get("error", "plan failed"), scans)
+        if not scans:
+            raise RuntimeError("scan did not run, see the worker log")
+        return scans
+
+    async def collect_neighborhood(
+        self, response_metadata: MetadataType, payload: CollectNeighborhood
+    ):
         response_metadata.status_msg = (
-            f"Finished collecting block {payload.location} with status: {status}"
+            f"Collecting block {payload.location} with wait time {payload.wait_time}"
         )
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
+        return await self.run_collection(payload)
 
     async def collect_row(self, response_metadata: MetadataType, payload: CollectRow):
         response_metadata.status_msg = (
@@ -232,50 +725,200 @@ class ChipScannerMessageManager:
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as pool:
-            uid, status = await loop.run_in_executor(pool, self.run_row_scan, *[payload.location, payload.wait_time])
+        return await self.run_collection(payload)
 
+    async def collect_apertures(
+        self, response_metadata: MetadataType, payload: CollectApertures
+    ):
         response_metadata.status_msg = (
-            f"Finished collecting row {payload.location} with status: {status}"
+            f"Collecting {len(payload.indices())} apertures with wait time {payload.wait_time}"
         )
         await self.conn_manager.broadcast(
             Message(metadata=response_metadata, payload=payload)
         )
+        return await self.run_collection(payload)
+
+    def broadcast_collection_status(
+        self,
+        item: QueueItem,
+        state: str,
+        status_msg: str,
+        exposed: Optional[str] = None,
+    ):
+        self.publish(
+            QueueActionResponse(status_msg=status_msg),
+            CollectionStatus(item=item, state=state, exposed=exposed),
+        )
 
-    
     async def collect_queue(self, data: Dict[str, Any], user_id: str):
+        """
+        Starts collecting the queue in the background, so that pause and
+        every other request is served while it runs
+        """
+        if self.queue_task is not None and not self.queue_task.done():
+            return
+        self.queue_task = asyncio.ensure_future(self.run_queue())
+
+    async def run_queue(self):
         """
         Runs all tasks in the queue. Ideally will be excuted by the BlueSky run engine
         """
-        while not self.request_queue.empty():
-            item = self.request_queue.get()
+        while self.state.queue:
+            # A paused queue starts no new item
+            await self.queue_resumed.wait()
+            if not self.state.queue:
+                break
+            item = self.state.queue.pop(0)
+            if self.state.ledger.exposed.flat[item_apertures(item)].all():
+                # Already collected, possibly before a restart
+                self.broadcast_collection_status(
+                    item, "skipped", f"Skipped request {item}, already exposed"
+                )
+                continue
+            runs = self.prescreened_runs(item)
+            if not runs:
+                self.broadcast_collection_status(
+                    item, "skipped", f"Skipped request {item}, empty on pre-screen"
+                )
+                continue
+            self.state.running = item
             print(f"Working on : {item}")
-            await self.conn_manager.broadcast(
+            self.broadcast_collection_status(
+                item, "running", f"Collecting request {item}"
+            )
+            exposed = []
+            data_files = []
+            try:
+                for run in runs:
+                    try:
+                        scans = await self.valid_queue_requests[type(run)](
+                            ExecuteActionResponse(), run
+                        )
+                    except CollectionError as e:
+                        exposed.extend(self.record_scans(e.scans))
+                        raise
+                    exposed.extend(self.record_scans(scans))
+                    data_files.extend(scan["data_file"] for scan in scans)
+            except Exception as e:
+                self.state.running = None
+                self.broadcast_collection_status(
+                    item,
+                    "failed",
+                    f"Failed collecting request {item}: {e}",
+                    exposed=pack_indices(np.concatenate(exposed).tolist()) if exposed else None,
+                )
+                if isinstance(e, WorkerFailed):
+                    # Picked up again once the operator resumes, from its
+                    # first unexposed aperture
+                    self.state.queue.insert(0, item)
+                    self.state.paused = True
+                    self.queue_resumed.clear()
+                    self.send_in_order(
+                        Message(
+                            metadata=SnapshotResponse(
+                                status_msg=f"Put {item} back at the front of the queue, resume to continue"
+                            ),
+                            payload=self.state.snapshot(),
+                        )
+                    )
+                    continue
+                break
+            self.state.running = None
+            self.broadcast_collection_status(
+                item,
+                "completed",
+                f"Completed request {item}, data in {', '.join(data_files)}",
+                exposed=pack_indices(np.concatenate(exposed).tolist()),
+            )
+            print(f"Completed : {item}")
+
+    def record_scans(self, scans: List[Dict[str, Any]]) -> List[np.ndarray]:
+        """
+        Records scans in the exposure ledger, returns the apertures each
+        exposed
+        """
+        return [
+            self.state.ledger.record(
+                scan["location"],
+                dwell=scan["dwell"],
+                transmission=scan["transmission"],
+                data_file=scan["data_file"],
+                timestamp=scan["timestamp"],
+                apertures=scan.get("apertures"),
+                partial=scan.get("partial", False),
+            )
+            for scan in scans
+        ]
+
+    async def pause_queue(self, response_metadata: MetadataType, payload: PauseQueue):
+        self.state.paused = True
+        self.queue_resumed.clear()
+        if self.state.running is not None:
+            # Deferred, the scan stops at the checkpoint before its next line
+            self.send_control("pause", defer=True)
+            status_msg = f"Pausing {self.state.running} at the next line"
+        else:
+            status_msg = "Paused collection"
+        self.publish(QueueActionResponse(status_msg=status_msg), payload)
+
+    async def emergency_stop(self, response_metadata: MetadataType, payload: EmergencyStop):
+        # Sent before anything else, the worker stops the hardware from its
+        # control lane whatever the plan lane is doing
+        self.send_control("emergency_stop", sent=time.time())
+        # No further queue item starts until collection is resumed
+        self.state.paused = True
+        self.queue_resumed.clear()
+        self.publish(QueueActionResponse(status_msg="Emergency stop requested"), payload)
+
+    def report_emergency_stop(self, message: Dict[str, Any]):
+        """
+        Broadcasts how long the stop took: from the request to the worker,
+        for the worker to stop the hardware, and the round trip back
+        """
+        steps = ", ".join(
+            f"{name} {value:.1f} ms" if isinstance(value, float) else f"{name} {value}"
+            for name, value in message["steps"].items()
+        )
+        latency = f"hardware stopped in {message['hardware_ms']:.1f} ms"
+        if message.get("sent") is not None:
+            latency = (
+                f"request to worker {message['transit_ms']:.1f} ms, {latency}, "
+                f"round trip {(time.time() - message['sent']) * 1000:.1f} ms"
+            )
+        asyncio.ensure_future(
+            self.conn_manager.broadcast(
                 Message(
-                    metadata=QueueActionResponse(
-                        status_msg=f"Collecting request {item}"
+                    metadata=StatusResponse(
+                        status_msg=f"Emergency stop: {latency} ({steps})"
                     )
                 )
             )
-            response = QueueActionResponse()
-            await self.valid_queue_requests[type(item)](response, item)
-
-            print(f"Completed : {item}")
+        )
 
-            self.request_queue.task_done()
+    async def resume_queue(self, response_metadata: MetadataType, payload: ResumeQueue):
+        self.state.paused = False
+        self.queue_resumed.set()
+        if self.state.running is not None:
+            self.send_control("resume")
+        self.publish(QueueActionResponse(status_msg="Resumed collection"), payload)
 
     async def clear_queue(self, data: Dict[str, Any], user_id: str):
         """
         Removes all pending tasks from the queue
         """
-        with self.request_queue.mutex:
-            self.request_queue.queue.clear()
-        await self.conn_manager.broadcast(
-            Message(
-                metadata=QueueActionResponse(status_msg=f"{user_id} cleared the queue"),
-                payload=ClearQueue(),
-            )
+        self.state.queue.clear()
+        self.publish(
+            QueueActionResponse(status_msg=f"{user_id} cleared the queue"), ClearQueue()
+        )
+
+    async def remove_from_queue(
+        self, response_metadata: MetadataType, payload: RemoveFromQueue
+    ):
+        if not 0 <= payload.index < len(self.state.queue):
+            return
+        item = self.state.queue.pop(payload.index)
+        self.publish(
+            QueueActionResponse(status_msg=f"Removed request {item} from queue"), payload
         )
 
     async def send_login_result(self, success: bool, username: str, client_id: UUID):
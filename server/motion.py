@@ -0,0 +1,95 @@
+import time
+from typing import Callable, List, Optional, Set, Union
+
+from model.comm_protocol import MoveGonio, NudgeGonio, PayloadType
+
+
+class MotionCoalescer:
+    """
+    Merges manual stage moves that arrive faster than the stage executes them.
+
+    Relative moves (NudgeGonio, click to center) are summed into one net
+    delta and absolute moves (MoveGonio) replace whatever is pending, so
+    the worker only ever sees the latest intent. At most max_in_flight
+    moves are handed to the worker at a time, the next merged move is
+    dispatched when the worker reports one as completed. Each move carries
+    an id the worker reports back, so a completion that arrives after the
+    moves in flight were given up on is ignored.
+    """
+
+    motion_payload_types = ("nudge_gonio", "move_gonio")
+
+    def __init__(
+        self,
+        send: Callable[[PayloadType], None],
+        max_in_flight: int = 1,
+        stale_after: float = 30.0,
+    ):
+        self.send = send
+        self.max_in_flight = max_in_flight
+        # A move the worker never acknowledges (e.g. it crashed) should not
+        # block manual alignment forever
+        self.stale_after = stale_after
+        # Ids of the moves handed to the worker and not yet completed
+        self.in_flight: Set[int] = set()
+        self.next_id = 0
+        self.last_dispatch = 0.0
+        self.pending_target: Optional[List[float]] = None
+        self.pending_delta = [0.0, 0.0, 0.0]
+        self.has_pending = False
+
+    def submit(self, payload: Union[NudgeGonio, MoveGonio]):
+        if isinstance(payload, MoveGonio):
+            self.pending_target = [payload.x_pos, payload.y_pos, payload.z_pos]
+            self.pending_delta = [0.0, 0.0, 0.0]
+        else:
+            self.pending_delta[0] += payload.x_delta
+            self.pending_delta[1] += payload.y_delta
+            self.pending_delta[2] += payload.z_delta
+        self.has_pending = True
+        self.dispatch()
+
+    def dispatch(self):
+        if not self.has_pending:
+            return
+        if (
+            self.in_flight
+            and time.monotonic() - self.last_dispatch > self.stale_after
+        ):
+            print(f"No completion for {len(self.in_flight)} stage move(s), resetting")
+            self.reset()
+        if len(self.in_flight) >= self.max_in_flight:
+            return
+
+        dx, dy, dz = self.pending_delta
+        if self.pending_target is not None:
+            x, y, z = self.pending_target
+            payload = MoveGonio(
+                x_pos=x + dx, y_pos=y + dy, z_pos=z + dz, move_id=self.next_id
+            )
+        else:
+            payload = NudgeGonio(
+                x_delta=dx, y_delta=dy, z_delta=dz, move_id=self.next_id
+            )
+        self.pending_target = None
+        self.pending_delta = [0.0, 0.0, 0.0]
+        self.has_pending = False
+
+        self.in_flight.add(self.next_id)
+        self.next_id += 1
+        self.last_dispatch = time.monotonic()
+        self.send(payload)
+
+    def completed(self, move_id: Optional[int]):
+        if move_id not in self.in_flight:
+            # A move given up on, the one in flight now is still under way
+            print(f"Ignoring completion of stage move {move_id}")
+            return
+        self.in_flight.discard(move_id)
+        self.dispatch()
+
+    def reset(self):
+        """
+        Gives up on the moves in flight, e.g. after the worker was replaced
+        """
+        self.in_flight.clear()
@@ -0,0 +1,97 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def aperture_pixels(
+    apertures: np.ndarray,
+    center: np.ndarray,
+    center_pixel: Tuple[float, float],
+    microns_per_pixel: float,
+) -> np.ndarray:
+    """
+    Pixel (column, row) of each aperture, given x, y motor positions of the
+    apertures and the motor position under center_pixel. Uses the same
+    convention as find_camera_center: motor y grows towards the top of the
+    image
+    """
+    delta = (np.asarray(apertures)[:, :2] - np.asarray(center)[:2]) / microns_per_pixel
+    return np.rint(
+        np.column_stack([center_pixel[0] + delta[:, 0], center_pixel[1] - delta[:, 1]])
+    ).astype(int)
+
+
+def patch_scores(image: np.ndarray, pixels: np.ndarray, half_size: int) -> np.ndarray:
+    """
+    Contrast of the square patch around each aperture, the mean gradient
+    magnitude over the mean intensity. An empty aperture is evenly lit, a
+    crystal adds edges. All patches are gathered in one indexing step.
+    Apertures whose patch is not fully inside the image score NaN
+    """
+    image = np.asarray(image, dtype=np.float32)
+    height, width = image.shape
+    offsets = np.arange(-half_size, half_size + 1)
+    scores = np.full(len(pixels), np.nan)
+    inside = (
+        (pixels[:, 0] - half_size >= 0)
+        & (pixels[:, 0] + half_size < width)
+        & (pixels[:, 1] - half_size >= 0)
+        & (pixels[:, 1] + half_size < height)
+    )
+    if not inside.any():
+        return scores
+    rows = pixels[inside, 1][:, None, None] + offsets[None, :, None]
+    cols = pixels[inside, 0][:, None, None] + offsets[None, None, :]
+    patches = image[rows, cols]
+    gradient = np.abs(np.diff(patches, axis=1)).mean(axis=(1, 2)) + np.abs(
+        np.diff(patches, axis=2)
+    ).mean(axis=(1, 2))
+    scores[inside] = gradient / np.maximum(patches.mean(axis=(1, 2)), 1e-6)
+    return scores
+
+
+def bimodal_threshold(scores: np.ndarray, min_separation=0.8) -> Optional[float]:
+    """
+    Otsu threshold of the log scores when they fall into two clearly
+    separated groups, None otherwise. The separation is the share of the
+    variance explained by the split: 2/pi for a single normal population,
+    3/4 for a uniform one and close to 1 for two tight, distant groups
+    """
+    values = np.sort(np.log(np.maximum(scores, 1e-6)))
+    n = len(values)
+    if n < 4 or values[-1] == values[0]:
+        return None
+    low = np.arange(1, n)
+    cumulative = np.cumsum(values)
+    mean_low = cumulative[:-1] / low
+    mean_high = (cumulative[-1] - cumulative[:-1]) / (n - low)
+    between = low * (n - low) * (mean_high - mean_low) ** 2 / n**2
+    best = int(np.argmax(between))
+    if between[best] / values.var() < min_separation:
+        return None
+    return float(np.exp((values[best] + values[best + 1]) / 2))
+
+
+def classify_filled(
+    scores: np.ndarray, ratio=1.5, empty_score: Optional[float] = None
+) -> np.ndarray:
+    """
+    Apertures scoring more than ratio times the empty aperture score. The
+    empty score is calibrated on an empty chip when given. Otherwise the
+    block's scores must split into two clear groups, the empty score is
+    then the median of the lower one and only apertures of that group can
+    be empty. Without a clear split every aperture counts as filled, as do
+    apertures that could not be scored, so that sample is never skipped
+    """
+    filled = np.ones(len(scores), dtype=bool)
+    scored = np.isfinite(scores)
+    if empty_score is not None:
+        filled[scored] = scores[scored] > ratio * empty_score
+        return filled
+    threshold = bimodal_threshold(scores[scored])
+    if threshold is None:
+        return filled
+    lower = scored & (scores < threshold)
+    empty_score = float(np.median(scores[lower]))
+    filled[lower] = scores[lower] > ratio * empty_score
+    return filled
@@ -0,0 +1,61 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+
+from server.camera_relay import CameraRelay
+from server.dependencies import camera_relays, config
+
+router = APIRouter(
+    prefix="/camera",
+    tags=["camera"],
+    responses={404: {"description": "Not found"}},
+)
+
+BOUNDARY = "frame"
+
+
+def get_relay(index: int) -> CameraRelay:
+    if not 0 <= index < len(camera_relays):
+        raise HTTPException(status_code=404, detail=f"No camera {index}")
+    return camera_relays[index]
+
+
+@router.get("/{index}/stream")
+async def camera_stream(
+    index: int, fps: float = Query(30.0, gt=0)
+) -> StreamingResponse:
+    """
+    MJPEG stream of a camera, shared with every other client watching it
+    """
+    relay = get_relay(index)
+    max_fps = min(fps, config.get("camera_relay", {}).get("max_fps", 30.0))
+
+    async def parts():
+        relay.subscribe()
+        try:
+            async for frame in relay.frames(max_fps):
+                yield (
+                    f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(frame)}\r\n\r\n"
+                ).encode() + frame + b"\r\n"
+        finally:
+            relay.unsubscribe()
+
+    return StreamingResponse(
+        parts(), media_type=f"multipart/x-mixed-replace; boundary={BOUNDARY}"
+    )
+
+
+@router.get("/{index}/frame")
+async def camera_frame(index: int) -> Response:
+    """
+    Latest single frame of a camera as a JPEG
+    """
+    relay = get_relay(index)
+    relay.subscribe()
+    try:
+        frame = await relay.latest()
+    finally:
+        relay.unsubscribe()
+    if frame is None:
+        raise HTTPException(status_code=503, detail=f"No frame from camera {index}")
+    return Response(content=frame, media_type="image/jpeg")
@@ -2,9 +2,15 @@ from uuid import UUID
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from fastapi.responses import RedirectResponse
-from pydantic import parse_obj_as
+from pydantic import ValidationError
 
-from model.comm_protocol import Message, StatusResponse
+from model.comm_protocol import (
+    ErrorResponse,
+    Message,
+    StatusResponse,
+    decode_message,
+    select_subprotocol,
+)
 from server.dependencies import conn_manager, csm_manager, secrets
 
 router = APIRouter(
@@ -25,12 +31,27 @@ async def gui_login(uid: str) -> RedirectResponse:
 
 @router.websocket("/ws/{client_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: UUID, user_id: str):
-    await conn_manager.connect(websocket, client_id)
-    print("Trying to connect")
+    subprotocol = select_subprotocol(websocket.scope.get("subprotocols", []))
+    await conn_manager.connect(websocket, client_id, subprotocol)
+    print(f"Trying to connect with encoding {subprotocol or 'json'}")
+    # A joining client gets the current state in one message
+    await csm_manager.send_snapshot(client_id)
     try:
         while True:
-            data = await websocket.receive_json()
-            data = parse_obj_as(Message, data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            try:
+                data = decode_message(
+                    frame["bytes"] if frame.get("bytes") is not None else frame["text"]
+                )
+            except ValidationError as e:
+                # For example a chip name that is not a plain file name
+                await conn_manager.unicast(
+                    Message(metadata=ErrorResponse(status_msg=f"Invalid request: {e}")),
+                    client_id=client_id,
+                )
+                continue
             print(data)
 
             await csm_manager.process_message(data, user_id)
@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import h5py
+import numpy as np
+
+from model.chip import aperture_location, location_slices
+
+RASTER_COLUMNS = 160
+BLOCK_COLUMNS = 20
+
+Sidecar = Tuple[Dict[str, np.ndarray], Dict[str, Any]]
+
+
+def serpentine_apertures(location: str) -> np.ndarray:
+    """
+    Aperture indices of a block ("A1") or row ("A1a") in the order the
+    detector frames are taken: rows of the block alternate left to right
+    and right to left, starting left to right
+    """
+    rows, cols = location_slices(location)
+    y = np.arange(rows.start, rows.stop)[:, None]
+    x = np.tile(np.arange(cols.start, cols.stop), (len(y), 1))
+    x[1::2] = x[1::2, ::-1]
+    return (y * RASTER_COLUMNS + x).ravel()
+
+
+def aperture_segments(indices: Iterable[int]) -> List[Tuple[int, int, int, bool]]:
+    """
+    Plans a path through a set of apertures as gated line segments, each a
+    run of neighbouring apertures in one raster row of one block. Rows are
+    visited top to bottom, alternating left to right and right to left, so
+    that the stage never travels back across the chip. Returns (row, first
+    column, length, reversed) per segment in scan order, the first column
+    is the leftmost whichever way the segment is scanned
+    """
+    indices = np.unique(np.asarray(list(indices), dtype=np.int64))
+    if not len(indices):
+        return []
+    ys, xs = np.divmod(indices, RASTER_COLUMNS)
+    # A new segment starts at a gap, a new row or a block boundary, where
+    # the gap between blocks breaks the constant aperture pitch
+    breaks = np.flatnonzero(
+        (np.diff(xs) != 1) | (np.diff(ys) != 0) | (xs[1:] % BLOCK_COLUMNS == 0)
+    ) + 1
+    starts = np.r_[0, breaks]
+    lengths = np.diff(np.r_[starts, len(indices)])
+    segments = []
+    for i, y in enumerate(np.unique(ys)):
+        in_row = [
+            (int(y), int(xs[start]), int(length), i % 2 == 1)
+            for start, length in zip(starts, lengths)
+            if ys[start] == y
+        ]
+        segments.extend(reversed(in_row) if i % 2 else in_row)
+    return segments
+
+
+def segment_apertures(segments: Sequence[Tuple[int, int, int, bool]]) -> np.ndarray:
+    """
+    Aperture indices of planned segments in the order the frames are taken
+    """
+    if not segments:
+        return np.zeros(0, dtype=np.int64)
+    rows = []
+    for y, x, length, reverse in segments:
+        columns = np.arange(x, x + length)
+        rows.append(y * RASTER_COLUMNS + (columns[::-1] if reverse else columns))
+    return np.concatenate(rows)
+
+
+def build_sidecar(
+    location: str,
+    scan_type: str,
+    dwell: float,
+    line_starts: List[Dict[str, Any]],
+    frames_per_line: Union[int, Sequence[int]],
+    beamline: Dict[str, Any],
+    apertures: Optional[np.ndarray] = None,
+) -> Sidecar:
+    """
+    Collects the per frame arrays and scan attributes of a sidecar.
+
+    line_starts holds one entry per gated line with the start time, the
+    commanded start position and encoder position, and the step vectors.
+    Frame positions are the commanded ones along each line, frame
+    timestamps are the line start time plus the dwell per frame. Lines are
+    frames_per_line long, or as long as each entry of it, and cover the
+    apertures in the serpentine order of the location unless apertures
+    gives the frame order.
+    """
+    if apertures is None:
+        apertures = serpentine_apertures(location)
+    counts = np.broadcast_to(np.asarray(frames_per_line), (len(line_starts),))
+    line_of_frame = np.repeat(np.arange(len(line_starts)), counts)
+    frame_in_line = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    datasets: Dict[str, np.ndarray] = {
+        "frames/aperture_index": apertures.astype(np.int32),
+        "frames/aperture": np.array(
+            [aperture_location(int(index)) for index in apertures], dtype="S4"
+        ),
+    }
+    for name in ("position", "encoder"):
+        starts = np.array([line[name] for line in line_starts], dtype=np.float64)
+        step = np.array([line[f"{name}_step"] for line in line_starts], dtype=np.float64)
+        datasets[f"frames/{name}"] = (
+            starts[line_of_frame] + frame_in_line[:, None] * step[line_of_frame]
+        )
+        datasets[f"lines/{name}"] = starts
+    line_times = np.array([line["time"] for line in line_starts], dtype=np.float64)
+    datasets["frames/timestamp"] = line_times[line_of_frame] + frame_in_line * dwell / 1000
+    datasets["lines/start_time"] = line_times
+    attrs = {"location": location, "scan_type": scan_type, "dwell_ms": dwell}
+    attrs.update(beamline)
+    return datasets, attrs
+
+
+def write_sidecar(path: Path, sidecar: Sidecar):
+    datasets, attrs = sidecar
+    temporary_path = path.with_suffix(".tmp")
+    with h5py.File(temporary_path, "w") as f:
+        for name, data in datasets.items():
+            f.create_dataset(name, data=data)
+        for name, value in attrs.items():
+            f.attrs[name] = value if value is not None else ""
+    # Readers never see a partly written sidecar
+    temporary_path.replace(path)
+
+
+class SidecarWriter:
+    """
+    Writes sidecars on a background thread, so that the file system adds
+    nothing to the dead time between scans
+    """
+
+    def __init__(self):
+        self.queue: "queue.Queue[Optional[Tuple[Path, Sidecar, Optional[Callable]]]]" = (
+            queue.Queue()
+        )
+        self.thread: Optional[threading.Thread] = None
+
+    def submit(
+        self, path: Path, sidecar: Sidecar, then: Optional[Callable[[Path], None]] = None
+    ):
+        """
+        Queues a sidecar, then is called with its path once it is written
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((path, sidecar, then))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, sidecar, then = item
+                started = time.monotonic()
+                write_sidecar(path, sidecar)
+                print(f"Wrote sidecar {path} in {time.monotonic() - started:.3f} s")
+                if then is not None:
+                    then(path)
+            except Exception as e:
+                print(f"Failed to write sidecar: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Blocks until every submitted sidecar is written
+        """
+        self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+sidecar_writer = SidecarWriter()
+
+
+def read_aperture_index(path: Path) -> np.ndarray:
+    """
+    Frame to aperture index mapping of a sidecar, in one read
+    """
+    with h5py.File(path, "r") as f:
+        return f["frames/aperture_index"][()]
@@ -0,0 +1,96 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from model.chip import location_slices
+from model.comm_protocol import (
+    CollectApertures,
+    HitMap,
+    QueueItem,
+    StateSnapshot,
+    pack_indices,
+)
+
+from .exposure_ledger import APERTURE_SHAPE, ExposureLedger
+
+
+def item_apertures(item: QueueItem) -> np.ndarray:
+    """
+    Raster indices of the apertures a queue item collects
+    """
+    if isinstance(item, CollectApertures):
+        return np.asarray(item.indices(), dtype=np.int64)
+    mask = np.zeros(APERTURE_SHAPE, dtype=bool)
+    mask[location_slices(item.location)] = True
+    return np.flatnonzero(mask)
+
+
+class ServerState:
+    """
+    Authoritative view state shared by all clients. Every change is
+    published as a broadcast stamped with the sequence number returned by
+    bump, so that clients can tell when they missed one and ask for a
+    snapshot instead.
+    """
+
+    def __init__(self, ledger: ExposureLedger):
+        self.seq = 0
+        # Exposure of the loaded chip, persisted across restarts
+        self.ledger = ledger
+        self.queue: List[QueueItem] = []
+        self.running: Optional[QueueItem] = None
+        # Paused collection starts no queue item and holds the running scan
+        # at a line boundary
+        self.paused = False
+        self.fiducials: Dict[str, bool] = {"F0": False, "F1": False, "F2": False}
+        # Spot count per aperture of the loaded chip from the online hit
+        # finder, -1 where nothing was analysed
+        self.hits = np.full(APERTURE_SHAPE, -1, dtype=np.int32)
+        self.min_spots = 10
+        # Optical pre-screen of the loaded chip, apertures screened empty
+        # are skipped during collection
+        self.screened = np.zeros(APERTURE_SHAPE, dtype=bool)
+        self.filled = np.zeros(APERTURE_SHAPE, dtype=bool)
+
+    def bump(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def screened_empty(self) -> np.ndarray:
+        return self.screened & ~self.filled
+
+    def reset_chip(self):
+        """
+        Drops the per chip results that are not kept in the ledger
+        """
+        self.hits.fill(-1)
+        self.screened.fill(False)
+        self.filled.fill(False)
+
+    def hit_map(self, indices: Optional[np.ndarray] = None) -> HitMap:
+        """
+        Spot counts of the given aperture indices, of every analysed
+        aperture by default
+        """
+        if indices is None:
+            indices = np.flatnonzero(self.hits.ravel() >= 0)
+        indices = np.unique(indices)
+        return HitMap(
+            apertures=pack_indices(indices.tolist()),
+            spots=self.hits.ravel()[indices].tolist(),
+            min_spots=self.min_spots,
+        )
+
+    def snapshot(self) -> StateSnapshot:
+        return StateSnapshot(
+            seq=self.seq,
+            queue=list(self.queue),
+            running=self.running,
+            fiducials=dict(self.fiducials),
+            chip_name=self.ledger.chip_name,
+            exposed=self.ledger.exposed_mask(),
+            hits=self.hit_map(),
+            screened=pack_indices(np.flatnonzero(self.screened).tolist()),
+            filled=pack_indices(np.flatnonzero(self.filled).tolist()),
+            paused=self.paused,
+        )
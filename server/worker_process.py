@@ -0,0 +1,37 @@
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Any, Dict
+
+
+def run_worker(
+    conn: Connection, config: Dict[str, Any], proposal_config: Dict[str, Any], standby: bool
+):
+    # bluesky, ophyd and the devices are only ever imported here, in the
+    # worker process
+    from server.bluesky_env import RunEngineWorker
+
+    RunEngineWorker(
+        conn=conn, config=config, proposal_config=proposal_config, standby=standby
+    ).run()
+
+
+def start_worker(
+    conn: Connection,
+    config: Dict[str, Any],
+    proposal_config: Dict[str, Any],
+    standby: bool = False,
+) -> multiprocessing.Process:
+    """
+    Starts the RunEngine worker in a fresh interpreter. It is spawned
+    rather than forked, so that it shares no CA context, threads or sockets
+    with the web process, and the web process never loads the control
+    system libraries. A standby worker initialises everything and then
+    waits to be activated
+    """
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_worker,
+        args=(conn, config, proposal_config, standby),
+        name="run-engine-standby" if standby else "run-engine-worker",
+    )
+    process.start()
+    return process
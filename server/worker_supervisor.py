@@ -0,0 +1,268 @@
+import asyncio
+import time
+from multiprocessing import Pipe
+from typing import Any, Callable, Dict, List, Optional
+
+from model.comm_protocol import LoadChip
+
+
+class WorkerHandle:
+    """
+    One worker process and the web process end of its pipe
+    """
+
+    def __init__(self, start_worker: Callable, config, proposal_config, standby: bool):
+        self.conn, self.child_conn = Pipe()
+        self.standby = standby
+        self.process = start_worker(self.child_conn, config, proposal_config, standby=standby)
+        # The worker holds its own copy, a dead worker then reads as EOF
+        self.child_conn.close()
+        self.started = time.monotonic()
+        self.last_heartbeat: Optional[float] = None
+        # When the oldest unanswered status query was sent
+        self.query_sent: Optional[float] = None
+        # When the worker was asked to take over, until it reports activated
+        self.activating: Optional[float] = None
+        self.status: Dict[str, Any] = {}
+        self.closed = False
+
+    @property
+    def ready(self) -> bool:
+        # The control lane answers once the worker is initialised
+        return self.last_heartbeat is not None
+
+    def healthy(
+        self, now: float, timeout: float, startup_timeout: float, activation_timeout: float
+    ) -> bool:
+        if self.closed or not self.process.is_alive():
+            return False
+        if self.last_heartbeat is None:
+            return now - self.started < startup_timeout
+        if self.activating is not None:
+            return now - self.activating < activation_timeout
+        # Only a query left unanswered is a miss, not the time since the
+        # last reply, which a stalled web process would stretch
+        return self.query_sent is None or now - self.query_sent < timeout
+
+    def query_status(self, now: float):
+        if self.query_sent is None:
+            self.query_sent = now
+        self.send({"action": "status"})
+
+    def activate(self, message: Dict[str, Any]):
+        now = time.monotonic()
+        self.activating = now
+        if self.ready:
+            # Measured from now on, not from the standby's last reply
+            self.last_heartbeat = now
+        self.query_sent = None
+        self.send(message)
+
+    def send(self, message) -> bool:
+        try:
+            self.conn.send(message)
+            return True
+        except (OSError, ValueError):
+            self.closed = True
+            return False
+
+    def close(self, timeout: float = 5.0):
+        if not self.closed:
+            self.send("STOP")
+        self.closed = True
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1.0)
+        self.conn.close()
+
+    def kill(self):
+        self.closed = True
+        self.process.kill()
+        self.process.join(1.0)
+        self.conn.close()
+
+
+class WorkerSupervisor:
+    """
+    Runs the active RunEngine worker next to a standby worker that is
+    already fully initialised: RunEngine, metadata, databroker, logging,
+    device connections and fiducials. Both are sent a heartbeat (a status
+    query, answered by the worker's control lane even while a plan runs)
+    every heartbeat_interval seconds. When the active worker dies or leaves a
+    query unanswered for heartbeat_timeout seconds it is killed and the
+    standby is activated with the fiducials, loaded chip and data path of
+    the failed one, then a new standby is started. The standby is given
+    activation_timeout seconds to take over. The queue stays in the web
+    process and on_failover is called so that it can resume.
+    """
+
+    def __init__(
+        self,
+        start_worker: Callable,
+        config,
+        proposal_config,
+        on_message: Callable[[Any], None],
+        on_failover: Callable[[str], None],
+        standby: bool = True,
+        heartbeat_interval: Optional[float] = 0.2,
+        heartbeat_timeout: float = 0.8,
+        startup_timeout: float = 300.0,
+        activation_timeout: float = 10.0,
+    ):
+        self.start_worker = start_worker
+        self.config = config
+        self.proposal_config = proposal_config
+        self.on_message = on_message
+        self.on_failover = on_failover
+        self.use_standby = standby
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.activation_timeout = activation_timeout
+        # Handed over to the worker that takes over
+        self.fiducials: Optional[List[Any]] = None
+        self.chip_name: Optional[str] = None
+        self.filepath: Optional[str] = str(proposal_config["path"])
+        self.active = self.start(standby=False)
+        self.standby = self.start(standby=True) if standby else None
+        self.monitor_task: Optional[asyncio.Future] = None
+
+    def start(self, standby: bool) -> WorkerHandle:
+        return WorkerHandle(self.start_worker, self.config, self.proposal_config, standby)
+
+    def send(self, message):
+        """
+        Sends a message to the active worker, noting what a replacement
+        needs to know
+        """
+        if isinstance(message, LoadChip):
+            self.chip_name = message.name
+        elif isinstance(message, dict) and message.get("action") == "set_filepath":
+            self.filepath = message["path"]
+        self.active.send(message)
+
+    def start_listening(self):
+        for handle in (self.active, self.standby):
+            if handle is not None:
+                self.add_reader(handle)
+        if self.heartbeat_interval:
+            self.monitor_task = asyncio.ensure_future(self.monitor())
+
+    def stop_listening(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        for handle in (self.active, self.standby):
+            if handle is not None and not handle.closed:
+                self.remove_reader(handle)
+
+    def add_reader(self, handle: WorkerHandle):
+        asyncio.get_running_loop().add_reader(
+            handle.conn.fileno(), self.read_messages, handle
+        )
+
+    def remove_reader(self, handle: WorkerHandle):
+        try:
+            asyncio.get_running_loop().remove_reader(handle.conn.fileno())
+        except (OSError, ValueError):
+            pass
+
+    def read_messages(self, handle: WorkerHandle):
+        while True:
+            try:
+                if not handle.conn.poll():
+                    return
+                message = handle.conn.recv()
+            except (EOFError, OSError):
+                # Noticed by the next heartbeat
+                self.remove_reader(handle)
+                handle.closed = True
+                return
+            if isinstance(message, dict) and message.get("status") == "worker_status":
+                if handle.last_heartbeat is None and handle.activating is not None:
+                    # Started cold to take over, it is given the activation
+                    # timeout from the end of its start up
+                    handle.activating = time.monotonic()
+                handle.last_heartbeat = time.monotonic()
+                handle.query_sent = None
+                handle.status = message
+            elif isinstance(message, dict) and message.get("status") == "activated":
+                handle.activating = None
+                handle.query_sent = None
+            if handle is not self.active:
+                continue
+            if isinstance(message, dict) and message.get("status") == "fiducials":
+                self.fiducials = message.get("values")
+            self.on_message(message)
+
+    def healthy(self, handle: WorkerHandle, now: float) -> bool:
+        return handle.healthy(
+            now, self.heartbeat_timeout, self.startup_timeout, self.activation_timeout
+        )
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for handle in (self.active, self.standby):
+                if handle is None or handle.closed:
+                    continue
+                # Replies that arrived while the event loop was busy count
+                self.read_messages(handle)
+                # A worker still starting up announces itself when ready,
+                # one being activated answers once it has taken over
+                if handle.ready and handle.activating is None and not handle.closed:
+                    handle.query_status(now)
+            if not self.healthy(self.active, now):
+                reason = (
+                    "process exited"
+                    if not self.active.process.is_alive()
+                    else "missed heartbeats"
+                )
+                self.failover(reason)
+            elif self.standby is not None and not self.healthy(self.standby, now):
+                print("Standby worker failed, starting a new one")
+                self.remove_reader(self.standby)
+                self.standby.kill()
+                self.standby = self.start(standby=True)
+                self.add_reader(self.standby)
+
+    def failover(self, reason: str):
+        started = time.monotonic()
+        failed = self.active
+        was_running = failed.status.get("run_engine") not in (None, "idle")
+        self.remove_reader(failed)
+        failed.kill()
+        if self.standby is not None and self.standby.ready:
+            self.active, self.standby = self.standby, None
+        else:
+            # No standby ready, pays for a full start up
+            if self.standby is not None:
+                self.remove_reader(self.standby)
+                self.standby.kill()
+                self.standby = None
+            self.active = self.start(standby=True)
+            self.add_reader(self.active)
+        self.active.activate(
+            {
+                "action": "activate",
+                "fiducials": self.fiducials,
+                "chip_name": self.chip_name,
+                "filepath": self.filepath,
+                "emergency_stop": was_running,
+            }
+        )
+        print(
+            f"Worker failed ({reason}), promoted the standby in "
+            f"{(time.monotonic() - started) * 1000:.0f} ms"
+        )
+        if self.use_standby:
+            self.standby = self.start(standby=True)
+            self.add_reader(self.standby)
+        self.on_failover(reason)
+
+    def close(self):
+        self.stop_listening()
+        for handle in (self.active, self.standby):
+            if handle is not None:
+                handle.close()
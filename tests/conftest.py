@@ -0,0 +1,195 @@
+import importlib
+import sys
+import threading
+import time
+import types
+from multiprocessing import Pipe
+from unittest.mock import MagicMock
+
+import pytest
+
+from server.scan_sidecar import serpentine_apertures
+
+
+class StubChipScanner:
+    """
+    Stands in for server.chip_scanner_plans.chip_scanner without hardware.
+    A block scan is a number of gated lines of 20 frames, each a checkpoint and
+    a sleep, with the line bookkeeping of the real collection plans: a
+    resumed scan records the lines before the pause as a part of its own,
+    an aborted scan records the lines it exposed, the line under way
+    included and marked partial
+    """
+
+    def __init__(self, lines=20, line_time=0.03):
+        self.lines = lines
+        self.line_time = line_time
+        self.scans = []
+        self.rearm_pending = False
+        self.filepath = ""
+        self.chip_name = "Chip01"
+        self.lines_done = 0
+        self.part_line = 0
+        self.line_started = False
+        self.location = None
+        self.emergency_stops = []
+        self.jogs = []
+        self.moves = []
+        for name in ("F0", "F1", "F2", "F0_enc", "F1_enc", "F2_enc"):
+            setattr(self, name, None)
+
+    def ppmac_neighbourhood_scan(self, location, wait_time):
+        import bluesky.plan_stubs as bps
+
+        self.scans = []
+        self.lines_done = 0
+        self.part_line = 0
+        self.location = location
+        self.wait_time = wait_time
+        try:
+            for _ in range(self.lines):
+                yield from bps.checkpoint()
+                if self.rearm_pending:
+                    self.rearm_pending = False
+                    self.record_part()
+                self.line_started = True
+                yield from bps.sleep(self.line_time)
+                self.line_started = False
+                self.lines_done += 1
+        except BaseException:
+            self.record_part(aborted=True)
+            raise
+        self.record_part()
+
+    def record_part(self, aborted=False):
+        partial = aborted and self.line_started
+        if partial:
+            self.line_started = False
+            self.lines_done += 1
+        if self.lines_done == self.part_line:
+            return
+        apertures = serpentine_apertures(self.location)[
+            self.part_line * 20 : self.lines_done * 20
+        ]
+        self.scans.append(
+            {
+                "location": self.location,
+                "type": "neighbourhood",
+                "timestamp": time.time(),
+                "dwell": self.wait_time,
+                "transmission": 1.0,
+                "data_file": f"CHIP{self.location}_{self.part_line}",
+                "apertures": [int(index) for index in apertures],
+                "partial": partial,
+            }
+        )
+        self.part_line = self.lines_done
+
+    def nudge_by(self, x_delta, y_delta, z_delta):
+        import bluesky.plan_stubs as bps
+
+        self.moves.append((x_delta, y_delta, z_delta))
+        yield from bps.sleep(self.line_time)
+
+    def drive_to_position(self, x, y):
+        import bluesky.plan_stubs as bps
+
+        self.moves.append((x, y))
+        yield from bps.sleep(self.line_time)
+
+    def emergency_stop(self, ppmac_abort_pv=None):
+        self.emergency_stops.append(ppmac_abort_pv)
+        return {"shutter": 0.1}
+
+    def start_jog(self, axis, direction, velocity):
+        self.jogs.append((axis, direction, velocity))
+
+    def stop_jog(self):
+        pass
+
+
+@pytest.fixture
+def bluesky_env(monkeypatch):
+    """
+    server.bluesky_env imported with the beamline devices and databroker
+    replaced, the RunEngine and the worker lanes are the real ones
+    """
+    pytest.importorskip("bluesky")
+    plans = types.ModuleType("server.chip_scanner_plans")
+    plans.BL_calibration = MagicMock()
+    plans.chip_scanner = StubChipScanner()
+    plans.configure_hardware = MagicMock()
+    plans.governor_calls = []
+    # Seconds the governor takes to reach a state
+    plans.governor_time = 0.0
+
+    def govStateSet(state, configStr=None):
+        time.sleep(plans.governor_time)
+        plans.governor_calls.append(state)
+
+    plans.govStateSet = govStateSet
+    devices = types.ModuleType("server.devices")
+    devices.cam_7 = devices.cam_8 = MagicMock()
+    databroker = types.ModuleType("databroker")
+    databroker.Broker = MagicMock()
+    monkeypatch.setitem(sys.modules, "server.chip_scanner_plans", plans)
+    monkeypatch.setitem(sys.modules, "server.devices", devices)
+    monkeypatch.setitem(sys.modules, "databroker", databroker)
+    monkeypatch.delitem(sys.modules, "server.bluesky_env", raising=False)
+    yield importlib.import_module("server.bluesky_env")
+    sys.modules.pop("server.bluesky_env", None)
+
+
+def start_lanes(worker):
+    """
+    Runs the worker's control and plan lanes on threads, with a RunEngine
+    that does not need the main thread
+    """
+    from bluesky.run_engine import RunEngine
+
+    worker.RE = RunEngine({}, context_managers=[])
+    lanes = [
+        threading.Thread(target=worker.control_loop, daemon=True),
+        threading.Thread(target=worker.run_plans, daemon=True),
+    ]
+    for lane in lanes:
+        lane.start()
+    return lanes
+
+
+@pytest.fixture
+def worker(bluesky_env, tmp_path):
+    """
+    The web process end of a running RunEngineWorker's pipe, and the worker
+    """
+    conn, worker_conn = Pipe()
+    worker = bluesky_env.RunEngineWorker(
+        worker_conn,
+        {"fiducial_file": str(tmp_path / "fiducials.txt")},
+        {"path": str(tmp_path)},
+    )
+    lanes = start_lanes(worker)
+    yield conn, worker
+    conn.send("STOP")
+    for lane in lanes:
+        lane.join(5)
+
+
+def receive(conn, status, timeout=10.0):
+    """
+    Next worker message with the given status, earlier ones are skipped
+    """
+    deadline = time.monotonic() + timeout
+    while conn.poll(max(deadline - time.monotonic(), 0)):
+        message = conn.recv()
+        if isinstance(message, dict) and message.get("status") == status:
+            return message
+    raise TimeoutError(f"no {status} message from the worker")
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not reached")
+        time.sleep(0.005)
@@ -0,0 +1,78 @@
+import h5py
+import numpy as np
+
+from model.chip import aperture_index
+from server.chip_master import DATA_FILE_SUFFIX, DATA_PATH, ChipMaster
+from server.scan_sidecar import build_sidecar, serpentine_apertures, write_sidecar
+
+
+def write_scan(directory, name, location, first_value):
+    """
+    Writes the Eiger data and the sidecar of a scan whose frame k is filled
+    with first_value + k, returns the sidecar path
+    """
+    apertures = serpentine_apertures(location)
+    data_file = directory / name
+    with h5py.File(f"{data_file}{DATA_FILE_SUFFIX}", "w") as f:
+        frames = first_value + np.arange(len(apertures), dtype=np.uint32)
+        f.create_dataset(DATA_PATH, data=np.repeat(frames, 6).reshape(-1, 2, 3))
+    line = {"time": 0.0, "position": np.zeros(3), "encoder": np.zeros(3)}
+    line.update(position_step=np.zeros(3), encoder_step=np.zeros(3))
+    sidecar = directory / f"{name}_chipsight.h5"
+    lines = [line] * (len(apertures) // 20)
+    beamline = {"data_file": str(data_file)}
+    write_sidecar(sidecar, build_sidecar(location, "neighbourhood", 10, lines, 20, beamline))
+    return sidecar
+
+
+def test_apertures_map_onto_the_frames_of_their_scan(tmp_path):
+    master = ChipMaster(tmp_path / "Chip01_chip.h5", "Chip01")
+    master.add_scan(write_scan(tmp_path, "block", "B2", 1000))
+
+    with h5py.File(master.path, "r") as f:
+        data = f["data"]
+        assert data.shape == (160, 160, 2, 3)
+        assert f.attrs["chip_name"] == "Chip01"
+        # B2 starts at raster row 20, column 20, its first row left to right
+        assert data[20, 20:40, 0, 0].tolist() == list(range(1000, 1020))
+        # The second row is scanned right to left
+        assert data[21, 20:40, 0, 0].tolist() == list(range(1039, 1019, -1))
+        assert data[39, 20, 1, 2] == 1000 + 399
+        # Apertures never collected read as zeros
+        assert not data[0:20, 0:20].any()
+        assert f["scan_index"][0, 0] == -1
+
+
+def test_apertures_collected_again_map_to_their_latest_scan(tmp_path):
+    master = ChipMaster(tmp_path / "Chip01_chip.h5", "Chip01")
+    block = write_scan(tmp_path, "block", "A1", 1000)
+    master.add_scan(block)
+    row = write_scan(tmp_path, "row", "A1b", 5000)
+    master.add_scan(row)
+
+    with h5py.File(master.path, "r") as f:
+        data = f["data"]
+        assert data[0, 0:20, 0, 0].tolist() == list(range(1000, 1020))
+        # Row b of the block was collected again, left to right
+        assert data[1, 0:20, 0, 0].tolist() == list(range(5000, 5020))
+        assert data[2, 0:20, 0, 0].tolist() == list(range(1040, 1060))
+        assert f["scan_index"][1, 0] == 1
+        assert f["frame_index"][()].flat[aperture_index("A1bt")] == 19
+    assert master.sidecars() == [str(block), str(row)]
+
+    # A scan added again moves to the end of the list
+    master.add_scan(block)
+    assert master.sidecars() == [str(row), str(block)]
+    with h5py.File(master.path, "r") as f:
+        assert f["data"][1, 0, 0, 0] == 1000 + 39
+
+
+def test_virtual_dataset_waits_for_the_first_data_file(tmp_path):
+    sidecar = write_scan(tmp_path, "block", "A1", 0)
+    (tmp_path / f"block{DATA_FILE_SUFFIX}").unlink()
+    master = ChipMaster(tmp_path / "Chip01_chip.h5", "Chip01")
+    master.add_scan(sidecar)
+
+    with h5py.File(master.path, "r") as f:
+        assert "data" not in f
+        assert (f["scan_index"][0:20, 0:20] == 0).all()
@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+
+from model.comm_protocol import (
+    JSON_SUBPROTOCOL,
+    MSGPACK_SUBPROTOCOL,
+    CollectNeighborhood,
+    ExecuteRequest,
+    Message,
+    QueueRequest,
+    StagePosition,
+    decode_message,
+    encode_message,
+    select_subprotocol,
+)
+
+
+def messages():
+    return [
+        Message(
+            metadata=QueueRequest(client_id=uuid4(), user_id="user", seq=3),
+            payload=CollectNeighborhood(location="B2", wait_time=10),
+        ),
+        Message(
+            metadata=ExecuteRequest(
+                client_id=uuid4(),
+                timestamp=datetime(2024, 5, 1, 12, 30, 15, 250000, tzinfo=timezone.utc),
+            ),
+            payload=StagePosition(
+                x=1.5, y=-2.25, z=0.0, x_enc=15.0, y_enc=-22.5, z_enc=0.0, location="A1aa"
+            ),
+        ),
+    ]
+
+
+@pytest.mark.parametrize("subprotocol", [JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, None])
+@pytest.mark.parametrize("message", messages())
+def test_messages_round_trip(message, subprotocol):
+    assert decode_message(encode_message(message, subprotocol)) == message
+
+
+def test_msgpack_is_sent_as_binary_frames():
+    pytest.importorskip("msgpack")
+    message = messages()[0]
+    assert isinstance(encode_message(message, MSGPACK_SUBPROTOCOL), bytes)
+    assert isinstance(encode_message(message, JSON_SUBPROTOCOL), str)
+
+
+def test_clients_that_do_not_negotiate_get_json():
+    assert select_subprotocol([]) is None
+    assert select_subprotocol([JSON_SUBPROTOCOL]) == JSON_SUBPROTOCOL
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from model.chip import aperture_index
+from model.comm_protocol import LoadChip
+from server.exposure_ledger import ExposureLedger
+
+
+def test_log_is_replayed_after_a_crash(tmp_path):
+    ledger = ExposureLedger(tmp_path, "Chip01")
+    exposed = ledger.record("A1", dwell=10, transmission=0.5, data_file="A1.h5", timestamp=1.0)
+    ledger.record("B2a", dwell=20, transmission=1.0, data_file="B2a.h5", timestamp=2.0)
+    # A record cut short by the crash
+    with ledger.log_path.open("a") as f:
+        f.write('{"location": "C3", "dwell"')
+
+    replayed = ExposureLedger(tmp_path, "Chip01")
+    assert len(exposed) == 400
+    assert replayed.exposed.sum() == 420
+    assert replayed.is_exposed("A1") and replayed.is_exposed("B2a")
+    assert not replayed.is_exposed("C3")
+    assert replayed.dwell.flat[aperture_index("B2ac")] == 20
+    assert replayed.files == ["A1.h5", "B2a.h5"]
+
+
+def test_compaction_folds_the_log_into_the_arrays(tmp_path):
+    ledger = ExposureLedger(tmp_path, "Chip01", compact_every=2)
+    ledger.record("A1aa", dwell=10, transmission=1.0, data_file="one.h5")
+    assert ledger.log_path.exists() and not ledger.array_path.exists()
+    ledger.record("A1ab", dwell=10, transmission=1.0, data_file="two.h5")
+    assert ledger.array_path.exists() and not ledger.log_path.exists()
+    ledger.record("A1ac", dwell=10, transmission=1.0, data_file="three.h5")
+    ledger.close()
+
+    reloaded = ExposureLedger(tmp_path, "Chip01")
+    assert not reloaded.log_path.exists()
+    assert reloaded.exposed.sum() == 3
+    assert reloaded.files == ["one.h5", "two.h5", "three.h5"]
+
+
+def test_query_returns_the_exposed_apertures_of_a_rectangle(tmp_path):
+    ledger = ExposureLedger(tmp_path, "Chip01")
+    ledger.record("A1a", dwell=10, transmission=0.5, data_file="row.h5", timestamp=5.0)
+    ledger.record("B1", dwell=10, transmission=1.0, data_file="block.h5")
+
+    records = ledger.query("A1ae", "A1ba")
+    assert [record["location"] for record in records] == ["A1aa", "A1ab", "A1ac", "A1ad", "A1ae"]
+    assert records[0] == {
+        "location": "A1aa",
+        "timestamp": 5.0,
+        "dwell": 10.0,
+        "transmission": 0.5,
+        "data_file": "row.h5",
+        "partial": False,
+    }
+    # Reversed corners span the same rectangle
+    assert ledger.query("A1ba", "A1ae") == records
+
+
+def test_partial_scans_are_marked_until_collected_again(tmp_path):
+    ledger = ExposureLedger(tmp_path, "Chip01")
+    apertures = [aperture_index(location) for location in ("A1aa", "A1ab")]
+    ledger.record("A1aa", 10, 1.0, "stopped.h5", apertures=apertures, partial=True)
+    assert [record["partial"] for record in ledger.query("A1aa", "A1ab")] == [True, True]
+    assert ExposureLedger(tmp_path, "Chip01").partial.sum() == 2
+
+    ledger.record("A1ab", 10, 1.0, "again.h5")
+    assert [record["partial"] for record in ledger.query("A1aa", "A1ab")] == [True, False]
+    ledger.compact()
+    assert np.array_equal(ExposureLedger(tmp_path, "Chip01").partial, ledger.partial)
+
+
+@pytest.mark.parametrize("name", ["../../x", "chip/01", "", "Chip 01", "..", "chip.npz"])
+def test_chip_names_are_plain_file_names(name):
+    with pytest.raises(ValidationError):
+        LoadChip(name=name)
+
+
+def test_chip_name():
+    assert LoadChip(name="Chip_02-b").name == "Chip_02-b"
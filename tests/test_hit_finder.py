@@ -0,0 +1,134 @@
+import asyncio
+
+import h5py
+import numpy as np
+
+from server.chip_master import DATA_FILE_SUFFIX, DATA_PATH
+from server.hit_finder import HitFinder, find_spots, write_synthetic_scan
+from server.scan_sidecar import serpentine_apertures
+
+
+def background(seed=0, shape=(128, 128)):
+    return np.random.default_rng(seed).poisson(2.0, shape).astype(np.uint32)
+
+
+def test_background_has_no_spots():
+    spots, intensity = find_spots(background())
+    assert spots == 0
+    assert intensity == background().sum()
+
+
+def with_peaks():
+    frame = background()
+    for y, x in [(10, 10), (10, 70), (80, 50), (115, 100)]:
+        frame[y, x] += 300
+        # A shoulder next to the peak is not a spot of its own
+        frame[y, x + 1] += 100
+    return frame
+
+
+def test_isolated_peaks_are_counted_once():
+    assert find_spots(with_peaks())[0] == 4
+
+
+def test_bad_pixels_are_masked():
+    frame = background()
+    frame[20, 20] = np.iinfo(np.uint32).max
+    frame[30:33, 40] = np.iinfo(np.uint32).max
+    assert find_spots(frame)[0] == 0
+
+
+def test_binned_frames_find_the_same_peaks():
+    frame = with_peaks()
+    assert find_spots(frame, binning=2) == find_spots(frame)
+    # A bad pixel is left out of the intensity
+    frame[60, 60] = np.iinfo(np.uint32).max
+    spots, intensity = find_spots(frame, binning=2)
+    assert spots == 4
+    assert intensity == with_peaks().sum() - with_peaks()[60, 60]
+
+
+def follow(tmp_path, scenario, **options):
+    results = []
+
+    async def run():
+        finder = HitFinder(
+            tmp_path,
+            lambda *result: results.append(result),
+            processes=1,
+            chunk_frames=10,
+            poll_interval=0.05,
+            **options,
+        )
+        finder.start()
+        try:
+            await scenario(finder)
+        finally:
+            finder.stop()
+
+    asyncio.run(run())
+    return results
+
+
+async def until(condition, timeout=30.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.02)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_scans_are_analysed_as_they_are_written(tmp_path):
+    # Already there when the finder starts, left alone
+    write_synthetic_scan(tmp_path, "A2a", dwell=0, frame_shape=(128, 128), seed=1)
+    written = []
+
+    async def scenario(finder):
+        await asyncio.sleep(0.1)
+        data_file = await asyncio.to_thread(
+            write_synthetic_scan, tmp_path, "B1", 1, 0.5, (128, 128), seed=2
+        )
+        written.append(data_file)
+        await until(lambda: data_file in finder.finished)
+
+    results = follow(tmp_path, scenario)
+    apertures = np.concatenate([result[0] for result in results])
+    spots = np.concatenate([result[1] for result in results])
+    order = np.argsort(apertures)
+    assert np.array_equal(apertures[order], np.sort(serpentine_apertures("B1")))
+
+    with h5py.File(written[0], "r") as f:
+        frames = f[DATA_PATH][()]
+    expected = [find_spots(frame)[0] for frame in frames]
+    frame_of_aperture = np.argsort(serpentine_apertures("B1"))
+    assert spots[order].tolist() == [expected[i] for i in frame_of_aperture]
+    # About half of the frames are hits
+    assert 150 < (spots >= 5).sum() < 250
+
+
+def test_unreadable_frames_are_given_up_on(tmp_path):
+    data_file = tmp_path / f"CHIPA1a20240501120000{DATA_FILE_SUFFIX}"
+
+    async def scenario(finder):
+        await asyncio.sleep(0.1)
+        # Frames that are not images fail in find_spots on every attempt
+        with h5py.File(data_file, "w") as f:
+            f.create_dataset(DATA_PATH, data=np.zeros(20))
+        await until(lambda: data_file in finder.finished)
+
+    assert follow(tmp_path, scenario, max_retries=2) == []
+
+
+def test_scans_that_stop_growing_are_dropped(tmp_path):
+    data_file = tmp_path / f"CHIPA1a20240501120000{DATA_FILE_SUFFIX}"
+
+    async def scenario(finder):
+        await asyncio.sleep(0.1)
+        with h5py.File(data_file, "w") as f:
+            f.create_dataset(DATA_PATH, data=background(shape=(5, 64, 64)))
+        # Aborted after 5 of its 20 frames
+        await until(lambda: data_file in finder.finished)
+        assert not finder.scans
+
+    results = follow(tmp_path, scenario, stale_timeout=0.3)
+    assert sum(len(result[0]) for result in results) == 5
@@ -0,0 +1,82 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from model.comm_protocol import (
+    CollectNeighborhood,
+    ErrorResponse,
+    ExecuteActionResponse,
+    StartJog,
+    StopJog,
+)
+from server.manager import ConnectionManager
+from server.message_manager import ChipScannerMessageManager
+
+
+class RecordingConnectionManager(ConnectionManager):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    async def broadcast(self, message):
+        self.messages.append(message)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    connections = RecordingConnectionManager()
+    manager = ChipScannerMessageManager(
+        connections,
+        MagicMock(),
+        {"test": True, "exposure_ledger_dir": str(tmp_path)},
+        {"path": str(tmp_path)},
+    )
+    sent = []
+    manager.workers.send = sent.append
+    return manager, connections, sent
+
+
+def hold(manager, jog, times=3):
+    async def repeat():
+        for _ in range(times):
+            await manager.start_jog(ExecuteActionResponse(), jog)
+
+    asyncio.run(repeat())
+
+
+def test_held_jog_is_sent_on_every_refresh_and_broadcast_once(manager):
+    manager, connections, sent = manager
+    jog = StartJog(axis="x", direction=1, velocity=10.0)
+    hold(manager, jog)
+    assert sent == [jog] * 3
+    assert [message.payload for message in connections.messages] == [jog]
+
+
+def test_jog_refused_during_a_collection_runs_once_it_ends(manager):
+    manager, connections, sent = manager
+    jog = StartJog(axis="x", direction=1, velocity=10.0)
+    manager.state.running = CollectNeighborhood(location="A1", wait_time=10)
+    hold(manager, jog)
+    assert sent == []
+    assert len(connections.messages) == 1
+    assert isinstance(connections.messages[0].metadata, ErrorResponse)
+
+    manager.state.running = None
+    hold(manager, jog, times=2)
+    assert sent == [jog] * 2
+    assert connections.messages[-1].payload == jog
+    assert len(connections.messages) == 2
+
+
+def test_jog_held_again_during_a_collection_is_refused_again(manager):
+    manager, connections, sent = manager
+    jog = StartJog(axis="y", direction=-1, velocity=5.0)
+    manager.state.running = CollectNeighborhood(location="A1", wait_time=10)
+    hold(manager, jog)
+    asyncio.run(manager.stop_jog(ExecuteActionResponse(), StopJog()))
+    hold(manager, jog)
+    refusals = [
+        message for message in connections.messages if isinstance(message.metadata, ErrorResponse)
+    ]
+    assert len(refusals) == 2
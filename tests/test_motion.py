@@ -0,0 +1,88 @@
+import pytest
+
+from model.comm_protocol import MoveGonio, NudgeGonio
+from server.motion import MotionCoalescer
+
+from conftest import receive
+
+
+@pytest.fixture
+def motion():
+    sent = []
+    return MotionCoalescer(sent.append), sent
+
+
+def test_nudges_are_summed_while_a_move_is_in_flight(motion):
+    motion, sent = motion
+    motion.submit(NudgeGonio(x_delta=1, y_delta=0, z_delta=0))
+    for _ in range(3):
+        motion.submit(NudgeGonio(x_delta=1, y_delta=2, z_delta=0))
+    assert len(sent) == 1
+
+    motion.completed(sent[0].move_id)
+    assert sent[1] == NudgeGonio(x_delta=3, y_delta=6, z_delta=0, move_id=1)
+    motion.completed(sent[1].move_id)
+    assert len(sent) == 2 and not motion.in_flight
+
+
+def test_absolute_moves_replace_pending_nudges(motion):
+    motion, sent = motion
+    motion.submit(NudgeGonio(x_delta=1, y_delta=1, z_delta=0))
+    motion.submit(NudgeGonio(x_delta=5, y_delta=5, z_delta=0))
+    motion.submit(MoveGonio(x_pos=10, y_pos=20, z_pos=0))
+    # Nudges after the target are relative to it
+    motion.submit(NudgeGonio(x_delta=1, y_delta=-1, z_delta=0))
+
+    motion.completed(sent[0].move_id)
+    assert sent[1] == MoveGonio(x_pos=11, y_pos=19, z_pos=0, move_id=1)
+
+
+def test_moves_in_flight_are_bounded():
+    sent = []
+    motion = MotionCoalescer(sent.append, max_in_flight=2)
+    for _ in range(3):
+        motion.submit(NudgeGonio(x_delta=1, y_delta=0, z_delta=0))
+    assert [move.move_id for move in sent] == [0, 1]
+    motion.completed(1)
+    assert [move.move_id for move in sent] == [0, 1, 2]
+
+
+def test_late_completions_after_a_stale_reset_are_ignored(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr("server.motion.time.monotonic", lambda: clock[0])
+    sent = []
+    motion = MotionCoalescer(sent.append, stale_after=30.0)
+    motion.submit(NudgeGonio(x_delta=1, y_delta=0, z_delta=0))
+    clock[0] += 31
+    # The first move is given up on, the second is dispatched
+    motion.submit(NudgeGonio(x_delta=2, y_delta=0, z_delta=0))
+    motion.submit(NudgeGonio(x_delta=3, y_delta=0, z_delta=0))
+    assert [move.move_id for move in sent] == [0, 1]
+
+    motion.completed(0)
+    assert motion.in_flight == {1}
+    assert len(sent) == 2
+    motion.completed(1)
+    assert sent[2] == NudgeGonio(x_delta=3, y_delta=0, z_delta=0, move_id=2)
+
+
+def test_completions_from_a_replaced_worker_are_ignored(motion):
+    motion, sent = motion
+    motion.submit(NudgeGonio(x_delta=1, y_delta=0, z_delta=0))
+    motion.reset()
+    motion.submit(NudgeGonio(x_delta=2, y_delta=0, z_delta=0))
+    motion.completed(0)
+    motion.completed(None)
+    assert motion.in_flight == {1}
+
+
+def test_worker_reports_the_move_id(worker, bluesky_env):
+    conn, worker = worker
+    conn.send(NudgeGonio(x_delta=1, y_delta=2, z_delta=0, move_id=7))
+    result = receive(conn, "completed")
+    assert result["payload_type"] == "nudge_gonio"
+    assert result["move_id"] == 7
+
+    conn.send(MoveGonio(x_pos=1, y_pos=2, z_pos=0, move_id=8))
+    assert receive(conn, "completed")["move_id"] == 8
+    assert bluesky_env.chip_scanner.moves == [(1, 2, 0), (1, 2)]
@@ -0,0 +1,124 @@
+import asyncio
+import os
+from multiprocessing.connection import Connection
+
+import numpy as np
+import pytest
+
+from model.comm_protocol import (
+    CollectionStatus,
+    CollectNeighborhood,
+    ExecuteActionResponse,
+    PauseQueue,
+    ResumeQueue,
+)
+from server.manager import ConnectionManager
+from server.message_manager import ChipScannerMessageManager
+
+from conftest import start_lanes
+
+
+class RecordingConnectionManager(ConnectionManager):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    async def broadcast(self, message):
+        self.messages.append(message)
+
+
+class WorkerThreads:
+    """
+    The lanes of a worker run on threads, in place of its process
+    """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+
+    def is_alive(self):
+        return any(lane.is_alive() for lane in self.lanes)
+
+    def join(self, timeout=None):
+        for lane in self.lanes:
+            lane.join(timeout)
+
+    def kill(self):
+        pass
+
+
+@pytest.fixture
+def manager(bluesky_env, tmp_path):
+    workers = []
+
+    def start_worker(conn, config, proposal_config, standby=False):
+        # The supervisor closes its end of the worker's pipe once started
+        conn = Connection(os.dup(conn.fileno()))
+        worker = bluesky_env.RunEngineWorker(conn, config, proposal_config, standby=standby)
+        workers.append(worker)
+        return WorkerThreads(start_lanes(worker))
+
+    connections = RecordingConnectionManager()
+    manager = ChipScannerMessageManager(
+        connections,
+        start_worker,
+        {
+            "test": True,
+            "exposure_ledger_dir": str(tmp_path / "ledger"),
+            "fiducial_file": str(tmp_path / "fiducials.txt"),
+            "worker_supervisor": {"standby": False},
+        },
+        {"path": str(tmp_path)},
+    )
+    return manager, connections, workers[0]
+
+
+async def until(condition, timeout=10.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.005)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_pause_and_resume_queue(manager, bluesky_env):
+    manager, connections, worker = manager
+    scanner = bluesky_env.chip_scanner
+    first, second = (CollectNeighborhood(location=location, wait_time=10) for location in ("A1", "A2"))
+
+    async def collect():
+        manager.start_listening()
+        try:
+            manager.state.queue.extend([first, second])
+            await manager.collect_queue({}, "user")
+            await until(lambda: scanner.lines_done >= 1)
+            await manager.pause_queue(ExecuteActionResponse(), PauseQueue())
+            await until(lambda: worker.RE.state == "paused")
+            paused_at = scanner.lines_done
+            await manager.resume_queue(ExecuteActionResponse(), ResumeQueue())
+            await asyncio.wait_for(manager.queue_task, 10)
+            # The outbox is sent in the background
+            await asyncio.sleep(0.1)
+            return paused_at
+        finally:
+            manager.stop_listening()
+            manager.workers.close()
+
+    paused_at = asyncio.run(collect())
+
+    states = [
+        (message.payload.item.location, message.payload.state)
+        for message in connections.messages
+        if isinstance(message.payload, CollectionStatus)
+    ]
+    assert states == [("A1", "running"), ("A1", "completed"), ("A2", "running"), ("A2", "completed")]
+    statuses = [message.metadata.status_msg for message in connections.messages]
+    assert "Worker paused collect_neighborhood" in statuses
+    assert "Worker resumed collect_neighborhood" in statuses
+    # Both blocks exposed once, the first in two parts split at the pause
+    ledger = manager.state.ledger
+    assert ledger.exposed.sum() == 2 * 400
+    assert len(ledger.files) == 3
+    assert 0 < paused_at < scanner.lines
+    assert worker.RE.state == "idle"
+    assert not manager.state.paused and manager.state.running is None
+    assert np.all(ledger.dwell[ledger.exposed] == 10)
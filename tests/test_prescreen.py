@@ -0,0 +1,67 @@
+import numpy as np
+
+from server.prescreen import aperture_pixels, bimodal_threshold, classify_filled, patch_scores
+
+
+def two_groups(empty=300, filled=100, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.r_[rng.normal(0.05, 0.005, empty), rng.normal(0.5, 0.05, filled)]
+
+
+def test_threshold_splits_two_separated_groups():
+    scores = two_groups()
+    threshold = bimodal_threshold(scores)
+    assert 0.07 < threshold < 0.35
+    assert (scores > threshold).sum() == 100
+
+
+def test_no_threshold_without_a_clear_split():
+    rng = np.random.default_rng(0)
+    assert bimodal_threshold(rng.normal(0.3, 0.05, 400)) is None
+    assert bimodal_threshold(rng.uniform(0.1, 0.5, 400)) is None
+    assert bimodal_threshold(np.full(400, 0.2)) is None
+    assert bimodal_threshold(np.array([0.05, 0.5, 0.5])) is None
+
+
+def test_empty_apertures_of_a_bimodal_block_are_skipped():
+    filled = classify_filled(two_groups())
+    assert filled.tolist() == [False] * 300 + [True] * 100
+
+
+def test_every_aperture_counts_as_filled_without_a_clear_split():
+    scores = np.random.default_rng(0).normal(0.3, 0.05, 400)
+    assert classify_filled(scores).all()
+
+
+def test_calibrated_empty_score_is_used_as_given():
+    scores = np.array([0.04, 0.06, 0.08, np.nan, 0.5])
+    assert classify_filled(scores, ratio=1.5, empty_score=0.05).tolist() == [
+        False,
+        False,
+        True,
+        True,
+        True,
+    ]
+
+
+def test_unscored_apertures_are_never_skipped():
+    scores = two_groups()
+    scores[:10] = np.nan
+    filled = classify_filled(scores)
+    assert filled[:10].all()
+    assert not filled[10:300].any()
+
+
+def test_crystals_score_above_empty_apertures():
+    image = np.full((100, 100), 100.0)
+    # Edges of a crystal in the second aperture
+    image[45:55, 60:70] = 180.0
+    apertures = np.array([[-20.0, 0.0], [15.0, 0.0], [200.0, 0.0], [0.0, 10.0]])
+    pixels = aperture_pixels(apertures, [0, 0], (50, 50), 1.0)
+    # Motor y grows towards the top of the image
+    assert pixels.tolist() == [[30, 50], [65, 50], [250, 50], [50, 40]]
+    scores = patch_scores(image, pixels, half_size=8)
+    assert scores[0] == 0
+    assert scores[1] > 0.05
+    # Outside the image
+    assert np.isnan(scores[2])
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from model.chip import aperture_index
+from server.scan_sidecar import (
+    SidecarWriter,
+    aperture_segments,
+    build_sidecar,
+    read_aperture_index,
+    segment_apertures,
+    serpentine_apertures,
+)
+
+
+def line(time, x, y):
+    return {
+        "time": time,
+        "position": [x, y, 0.0],
+        "position_step": [0.5, 0.0, 0.0],
+        "encoder": [x * 10, y * 10, 0.0],
+        "encoder_step": [5.0, 0.0, 0.0],
+    }
+
+
+def test_neighbouring_apertures_share_a_segment():
+    assert aperture_segments([161, 2, 0, 1, 1]) == [(0, 0, 3, False), (1, 1, 1, True)]
+    assert aperture_segments([]) == []
+
+
+def test_segments_break_at_gaps_and_block_boundaries():
+    # Columns 18 to 21 cross from block A1 into A2
+    assert aperture_segments([18, 19, 20, 21, 23]) == [
+        (0, 18, 2, False),
+        (0, 20, 2, False),
+        (0, 23, 1, False),
+    ]
+
+
+def test_rows_alternate_direction():
+    segments = aperture_segments([0, 160, 161, 165, 166, 320])
+    assert segments == [(0, 0, 1, False), (1, 5, 2, True), (1, 0, 2, True), (2, 0, 1, False)]
+    assert segment_apertures(segments).tolist() == [0, 166, 165, 161, 160, 320]
+
+
+def test_segments_cover_a_block_like_its_serpentine_scan():
+    block = serpentine_apertures("B2")
+    assert np.array_equal(segment_apertures(aperture_segments(block)), block)
+    assert len(segment_apertures([])) == 0
+
+
+def test_sidecar_of_a_row():
+    datasets, attrs = build_sidecar(
+        "A1c", "row", 10, [line(100.0, 1.0, 2.0)], 20, {"energy": 12.7}
+    )
+    assert datasets["frames/aperture_index"].tolist() == list(range(320, 340))
+    assert datasets["frames/aperture"][0] == b"A1ca"
+    assert datasets["frames/position"][3].tolist() == [2.5, 2.0, 0.0]
+    assert datasets["frames/encoder"][3].tolist() == [25.0, 20.0, 0.0]
+    assert datasets["frames/timestamp"][3] == pytest.approx(100.03)
+    assert attrs == {"location": "A1c", "scan_type": "row", "dwell_ms": 10, "energy": 12.7}
+
+
+def test_sidecar_of_lines_of_different_lengths():
+    apertures = segment_apertures(aperture_segments([0, 1, 2, 161]))
+    datasets, _ = build_sidecar(
+        "A1", "apertures", 20, [line(0.0, 0, 0), line(5.0, 0, 1)], [3, 1], {}, apertures
+    )
+    assert datasets["frames/aperture"].tolist() == [b"A1aa", b"A1ab", b"A1ac", b"A1bb"]
+    assert datasets["frames/timestamp"].tolist() == pytest.approx([0.0, 0.02, 0.04, 5.0])
+    # Each line restarts from its own commanded start
+    assert datasets["frames/position"][:, 1].tolist() == [0, 0, 0, 1]
+    assert datasets["lines/start_time"].tolist() == [0.0, 5.0]
+
+
+def test_sidecars_are_written_in_the_background(tmp_path):
+    writer = SidecarWriter()
+    written = []
+    path = tmp_path / "A1.h5"
+    sidecar = build_sidecar("A1", "neighbourhood", 10, [line(0.0, 0, 0)] * 20, 20, {})
+    writer.submit(path, sidecar, written.append)
+    writer.flush()
+    writer.close()
+    assert written == [path]
+    assert not path.with_suffix(".tmp").exists()
+    indices = read_aperture_index(path)
+    assert indices[20] == aperture_index("A1bt")
+    assert np.array_equal(indices, serpentine_apertures("A1"))
@@ -0,0 +1,75 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from model.comm_protocol import (
+    CollectApertures,
+    CollectNeighborhood,
+    CollectRow,
+    CollectSelection,
+    pack_indices,
+    unpack_indices,
+)
+from server.manager import ConnectionManager
+from server.message_manager import SELECTION_SIZES, ChipScannerMessageManager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return ChipScannerMessageManager(
+        ConnectionManager(),
+        MagicMock(),
+        {"test": True, "exposure_ledger_dir": str(tmp_path)},
+        {"path": str(tmp_path)},
+    )
+
+
+@pytest.mark.parametrize(
+    "indices", [[], [0], [7], [8], [0, 1, 2, 161], [25599], list(range(0, 25600, 3))]
+)
+def test_indices_round_trip(indices):
+    assert unpack_indices(pack_indices(indices)) == indices
+
+
+def test_indices_are_unpacked_in_ascending_order():
+    assert unpack_indices(pack_indices([161, 2, 0, 2])) == [0, 2, 161]
+
+
+def test_mask_is_a_little_endian_bitmask():
+    # Bits 0 and 9, one byte per eight indices
+    assert pack_indices([0, 9]) == "AQI="
+    assert pack_indices([]) == ""
+
+
+def test_blocks_expand_to_neighbourhood_scans(manager):
+    items = manager.expand_selection(CollectSelection.from_indices("block", [0, 9, 63], 10))
+    assert items == [
+        CollectNeighborhood(location=location, wait_time=10) for location in ("A1", "B2", "H8")
+    ]
+
+
+def test_rows_expand_to_row_scans(manager):
+    items = manager.expand_selection(CollectSelection.from_indices("row", [0, 21, 1279], 20))
+    assert items == [
+        CollectRow(location=location, wait_time=20) for location in ("A1a", "A2b", "H8t")
+    ]
+
+
+def test_apertures_expand_to_a_single_scan(manager):
+    selection = CollectSelection.from_indices("aperture", [0, 1, 2, 161], 10)
+    items = manager.expand_selection(selection)
+    assert items == [CollectApertures(apertures=selection.mask, wait_time=10)]
+    assert items[0].indices() == [0, 1, 2, 161]
+
+
+@pytest.mark.parametrize("level", ["block", "row", "aperture"])
+def test_selections_past_the_chip_are_refused(manager, level):
+    with pytest.raises(ValueError, match="the chip has"):
+        manager.expand_selection(
+            CollectSelection.from_indices(level, [0, SELECTION_SIZES[level]], 10)
+        )
+
+
+def test_empty_selections_are_refused(manager):
+    with pytest.raises(ValueError, match="Nothing selected"):
+        manager.expand_selection(CollectSelection.from_indices("block", [], 10))
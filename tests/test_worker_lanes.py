@@ -0,0 +1,151 @@
+import sys
+import time
+
+from model.comm_protocol import CollectNeighborhood, SetGovernorState, StartJog
+
+from conftest import receive, wait_until
+
+
+def collect(conn, location="A1"):
+    conn.send(CollectNeighborhood(location=location, wait_time=10))
+
+
+def pause_after_first_line(conn, worker, scanner):
+    wait_until(lambda: scanner.lines_done >= 1)
+    conn.send({"action": "pause", "defer": True})
+    receive(conn, "paused")
+    assert worker.RE.state == "paused"
+
+
+def test_paused_plan_resumes_to_completion(worker, bluesky_env):
+    conn, worker = worker
+    scanner = bluesky_env.chip_scanner
+    collect(conn)
+    pause_after_first_line(conn, worker, scanner)
+    paused_at = scanner.lines_done
+
+    conn.send({"action": "resume"})
+    receive(conn, "resumed")
+    result = receive(conn, "completed")
+
+    assert worker.RE.state == "idle"
+    assert scanner.lines_done == scanner.lines
+    # The lines before the pause are a part of their own
+    assert [len(scan["apertures"]) for scan in result["scans"]] == [
+        paused_at * 20,
+        (scanner.lines - paused_at) * 20,
+    ]
+    assert not any(scan["partial"] for scan in result["scans"])
+
+    # The RunEngine takes the next plan
+    collect(conn, "A2")
+    assert len(receive(conn, "completed")["scans"]) == 1
+
+
+def test_resumed_plan_pauses_again(worker, bluesky_env):
+    conn, worker = worker
+    scanner = bluesky_env.chip_scanner
+    collect(conn)
+    pause_after_first_line(conn, worker, scanner)
+    conn.send({"action": "resume"})
+    receive(conn, "resumed")
+    # Running again, past the part recorded at the resume
+    wait_until(lambda: scanner.part_line > 0 and worker.RE.state == "running")
+    conn.send({"action": "pause", "defer": True})
+    receive(conn, "paused")
+    conn.send({"action": "resume"})
+
+    result = receive(conn, "completed")
+    assert sum(len(scan["apertures"]) for scan in result["scans"]) == scanner.lines * 20
+
+
+def test_paused_plan_aborts(worker, bluesky_env):
+    conn, worker = worker
+    scanner = bluesky_env.chip_scanner
+    collect(conn)
+    pause_after_first_line(conn, worker, scanner)
+    paused_at = scanner.lines_done
+
+    conn.send({"action": "abort", "reason": "operator"})
+    result = receive(conn, "failed")
+
+    assert "aborted: operator" in result["error"]
+    assert worker.RE.state == "idle"
+    # The plan was closed and recorded the lines it exposed
+    assert [len(scan["apertures"]) for scan in result["scans"]] == [paused_at * 20]
+
+    collect(conn, "A2")
+    receive(conn, "completed")
+
+
+def test_device_actions_wait_for_the_plan(worker):
+    conn, worker = worker
+    plans = sys.modules["server.chip_scanner_plans"]
+    collect(conn)
+    wait_until(lambda: worker.RE.state == "running")
+    conn.send(SetGovernorState(state="SA"))
+    conn.send(StartJog(axis="x", direction=1, velocity=10.0))
+
+    refused = receive(conn, "failed")
+    assert refused["payload_type"] == "start_jog"
+    assert plans.chip_scanner.jogs == []
+    assert plans.governor_calls == []
+    receive(conn, "completed")
+    # Run after the plan, reported like any device action
+    wait_until(lambda: plans.governor_calls == ["SA"])
+
+
+def test_plan_paused_before_it_starts(worker, bluesky_env):
+    conn, worker = worker
+    plans = sys.modules["server.chip_scanner_plans"]
+    scanner = bluesky_env.chip_scanner
+    plans.governor_time = 0.3
+    conn.send(SetGovernorState(state="SA"))
+    collect(conn)
+    # Waiting for the governor
+    wait_until(lambda: worker.current_plan is not None)
+    conn.send({"action": "pause", "defer": True})
+
+    receive(conn, "paused")
+    assert scanner.lines_done == 0
+    conn.send({"action": "resume"})
+    result = receive(conn, "completed")
+    assert [len(scan["apertures"]) for scan in result["scans"]] == [scanner.lines * 20]
+
+
+def test_plan_aborted_before_it_starts(worker, bluesky_env):
+    conn, worker = worker
+    plans = sys.modules["server.chip_scanner_plans"]
+    plans.governor_time = 0.3
+    conn.send(SetGovernorState(state="SA"))
+    collect(conn)
+    wait_until(lambda: worker.current_plan is not None)
+    conn.send({"action": "abort", "reason": "operator"})
+
+    result = receive(conn, "failed")
+    assert "aborted: operator" in result["error"]
+    assert result["scans"] == []
+    assert bluesky_env.chip_scanner.location is None
+    collect(conn)
+    receive(conn, "completed")
+
+
+def test_emergency_stop_aborts_the_running_plan(worker, bluesky_env):
+    conn, worker = worker
+    scanner = bluesky_env.chip_scanner
+    collect(conn)
+    wait_until(lambda: scanner.lines_done >= 1)
+    conn.send({"action": "emergency_stop", "sent": time.time()})
+
+    report = receive(conn, "emergency_stop")
+    assert report["steps"] == {"shutter": 0.1}
+    result = receive(conn, "failed")
+    assert "aborted: emergency stop" in result["error"]
+    assert worker.RE.state == "idle"
+    # The line under way when the stage stopped is recorded
+    assert result["scans"][-1]["partial"]
+    assert sum(len(scan["apertures"]) for scan in result["scans"]) == scanner.lines_done * 20
+    assert len(scanner.emergency_stops) == 1
+
+    collect(conn, "A2")
+    receive(conn, "completed")
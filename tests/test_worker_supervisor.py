@@ -0,0 +1,152 @@
+import asyncio
+import os
+import threading
+import time
+from multiprocessing.connection import Connection
+
+from server.worker_supervisor import WorkerSupervisor
+
+
+class StandInWorker:
+    """
+    Answers the supervisor like a worker's control lane, on a thread in
+    place of a process. A hung worker reads its pipe but answers nothing,
+    activation takes activate_time seconds
+    """
+
+    def __init__(self, conn, standby, activate_time):
+        # The supervisor closes its end of the worker's pipe once started
+        self.conn = Connection(os.dup(conn.fileno()))
+        self.standby = standby
+        self.activate_time = activate_time
+        self.activations = []
+        self.hung = threading.Event()
+        self.killed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except OSError:
+            pass
+
+    def run(self):
+        try:
+            self.send({"status": "worker_status", "run_engine": "idle"})
+            while not self.killed.is_set():
+                if not self.conn.poll(0.01):
+                    continue
+                message = self.conn.recv()
+                if message == "STOP":
+                    return
+                if self.hung.is_set():
+                    continue
+                if message["action"] == "status":
+                    self.send({"status": "worker_status", "run_engine": "idle"})
+                elif message["action"] == "activate":
+                    self.activations.append(message)
+                    time.sleep(self.activate_time)
+                    self.send({"status": "activated"})
+        except EOFError:
+            pass
+        finally:
+            self.conn.close()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def kill(self):
+        self.killed.set()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+
+def supervise(scenario, activate_time=0.0):
+    """
+    Runs a scenario against a supervisor of stand-in workers, returns the
+    workers in the order they were started and the failover reasons
+    """
+    workers = []
+    failovers = []
+
+    def start_worker(conn, config, proposal_config, standby=False):
+        workers.append(StandInWorker(conn, standby, activate_time))
+        return workers[-1]
+
+    async def run():
+        supervisor = WorkerSupervisor(
+            start_worker,
+            {},
+            {"path": ""},
+            on_message=lambda message: None,
+            on_failover=failovers.append,
+            heartbeat_interval=0.05,
+            heartbeat_timeout=0.3,
+            startup_timeout=5.0,
+            activation_timeout=3.0,
+        )
+        supervisor.start_listening()
+        try:
+            await until(lambda: supervisor.active.ready and supervisor.standby.ready)
+            await scenario(supervisor, workers, failovers)
+        finally:
+            supervisor.close()
+
+    asyncio.run(run())
+    return workers, failovers
+
+
+async def until(condition, timeout=5.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_a_stalled_web_process_keeps_its_worker():
+    async def scenario(supervisor, workers, failovers):
+        await asyncio.sleep(0.2)
+        # A blocking write in the web process, the worker answers meanwhile
+        time.sleep(1.0)
+        await asyncio.sleep(0.3)
+        assert supervisor.active.process is workers[0]
+
+    workers, failovers = supervise(scenario)
+    assert failovers == []
+    assert len(workers) == 2
+
+
+def test_a_hung_worker_is_replaced_by_the_standby():
+    async def scenario(supervisor, workers, failovers):
+        workers[0].hung.set()
+        await until(lambda: failovers)
+        assert failovers == ["missed heartbeats"]
+        assert workers[0].killed.is_set()
+        assert supervisor.active.process is workers[1]
+        # Slower to take over than the heartbeat timeout, it is kept
+        await asyncio.sleep(1.5)
+        assert supervisor.active.process is workers[1]
+        assert supervisor.active.activating is None
+        await until(lambda: supervisor.standby.ready)
+        await asyncio.sleep(0.3)
+
+    workers, failovers = supervise(scenario, activate_time=1.0)
+    assert failovers == ["missed heartbeats"]
+    assert len(workers) == 3
+    assert [worker.standby for worker in workers] == [False, True, True]
+    assert len(workers[1].activations) == 1
+    assert not workers[1].killed.is_set()
+    assert workers[2].activations == []
+
+
+def test_an_exited_worker_is_replaced_by_the_standby():
+    async def scenario(supervisor, workers, failovers):
+        workers[0].kill()
+        await until(lambda: failovers)
+        assert supervisor.active.process is workers[1]
+
+    workers, failovers = supervise(scenario)
+    assert failovers == ["process exited"]